@@ -15,8 +15,167 @@ EXT_TOOLS = {
     'REALITY_CAPTURE': r'C:\\Program Files\\Capturing Reality\\RealityCapture\\RealityCapture.exe',
 }
 
+# Machine-wide limits of external tools, keyed like `EXT_TOOLS`
+#   MAX_INSTANCES: processes of the tool allowed at once across all workers of the machine
+#   TIMEOUT: seconds before a process of the tool is killed, `None` to wait forever
+EXT_TOOL_LIMITS = {
+    'DNG_CONVERTER': {'MAX_INSTANCES': 4, 'TIMEOUT': 30 * 60},
+    # RealityCapture is single-instance per machine
+    'REALITY_CAPTURE': {'MAX_INSTANCES': 1, 'TIMEOUT': 12 * 60 * 60},
+}
+# Lock files of external tool slots, must be shared by all workers of the machine
+EXT_TOOL_LOCK_DIR = f'{osp.dirname(osp.abspath(__file__))}/.pslock'
+
+# Dramatiq queue of each kind of job, so that short jobs never wait behind long ones
+QUEUES = {
+    'INIT': 'ps_init',
+    'DNG': 'ps_dng',
+    'COLOR': 'ps_color',
+    'RC': 'ps_rc',
+}
+
+# Worker pools, started with `python worker.py <pool>`
+#   QUEUES: keys of `QUEUES` consumed by the pool
+#   PROCESSES, THREADS: dramatiq worker processes and threads per process
+WORKER_POOLS = {
+    'default': {'QUEUES': ['INIT', 'DNG', 'COLOR', 'RC'], 'PROCESSES': 1, 'THREADS': 8},
+    'image': {'QUEUES': ['INIT', 'DNG', 'COLOR'], 'PROCESSES': 2, 'THREADS': 4},
+    # Only on machines with a RealityCapture licence
+    'rc': {'QUEUES': ['RC'], 'PROCESSES': 1, 'THREADS': 1},
+}
+
+# Jobs of each queue of `QUEUES` the coordinator keeps in flight across all tasks, 0 for
+# no limit. Should match worker threads consuming the queue, jobs beyond it wait in the
+# coordinator and go to the task with highest priority ( then earliest deadline ) first
+SCHEDULER_CAPACITY = {
+    'INIT': 4,
+    'DNG': 8,
+    'COLOR': 8,
+    'RC': 1,
+}
+
+# Retries of failed worker jobs, with exponential backoff between attempts
+#   MAX_RETRIES: retries after the first attempt
+#   MIN_BACKOFF, MAX_BACKOFF: seconds before the first retry, and at most between retries
+#   RETRY_ON: names of retryable exceptions, built-in or from `process_runner`
+# Images still failing afterwards are given up and the task goes on without them
+RETRY_POLICIES = {
+    'init_task_job': {
+        'MAX_RETRIES': 0,
+        'MIN_BACKOFF': 10,
+        'MAX_BACKOFF': 60,
+        'RETRY_ON': [],
+    },
+    'dng_conversion_job': {
+        'MAX_RETRIES': 3,
+        'MIN_BACKOFF': 10,
+        'MAX_BACKOFF': 300,
+        'RETRY_ON': ['OSError', 'ToolTimeoutError'],
+    },
+    'color_correction_job': {
+        'MAX_RETRIES': 3,
+        'MIN_BACKOFF': 10,
+        'MAX_BACKOFF': 300,
+        'RETRY_ON': ['OSError'],
+    },
+    'color_correction_single_job': {
+        'MAX_RETRIES': 1,
+        'MIN_BACKOFF': 10,
+        'MAX_BACKOFF': 300,
+        'RETRY_ON': ['OSError'],
+    },
+    'prepare_rc_job': {
+        'MAX_RETRIES': 1,
+        'MIN_BACKOFF': 60,
+        'MAX_BACKOFF': 600,
+        'RETRY_ON': ['ToolTimeoutError'],
+    },
+    'mesh_construction_job': {
+        'MAX_RETRIES': 1,
+        'MIN_BACKOFF': 60,
+        'MAX_BACKOFF': 600,
+        'RETRY_ON': ['ToolTimeoutError'],
+    },
+}
+
+# Running jobs hold a lease renewed by their worker every `HEARTBEAT_INTERVAL` seconds.
+# A lease not renewed within the horizon of its queue ( key of `QUEUES` ) is considered
+# abandoned by a dead worker, and the unfinished work of its job is dispatched again
+LEASES = {
+    'HEARTBEAT_INTERVAL': 30,
+    'HORIZONS': {
+        'INIT': 5 * 60,
+        'DNG': 5 * 60,
+        'COLOR': 5 * 60,
+        'RC': 2 * 60 * 60,
+    },
+}
+
+# Time limit of worker jobs (seconds), a job is interrupted when exceeding it
+JOB_TIME_LIMITS = {
+    'init_task_job': 10 * 60,
+    'dng_conversion_job': 60 * 60,
+    'color_correction_job': 60 * 60,
+    'color_correction_single_job': 6 * 60 * 60,
+    'prepare_rc_job': 13 * 60 * 60,
+    'mesh_construction_job': 13 * 60 * 60,
+}
+
 TEMPLATE_FILES = {
     'RC_SETTING': f'{osp.dirname(osp.abspath(__file__))}/template/rc_setting',
     'BLACK': f'{osp.dirname(osp.abspath(__file__))}/template/black.dng',
     'COLOR_CHECKER': f'{osp.dirname(osp.abspath(__file__))}/template/color_checker.dng',
 }
+
+# Worker processes run color correction in a pool of
+# this many processes, 0 to process in dramatiq worker threads
+WORKER_PROCESS_POOL_SIZE = 0
+
+PIPELINE = {
+    # Color correct raw images of `1_RAW` directly with rawpy, DNG conversion step is skipped
+    'RAW_DIRECT_DECODE': False,
+    # Number of raw images converted by one DNG converter process
+    'DNG_CONVERSION_BATCH_SIZE': 16,
+    # Fan color correction out as one `color_correction_job` per batch of images
+    # instead of a single `color_correction_single_job` for the whole task
+    'COLOR_CORRECTION_PARALLEL': True,
+    'COLOR_CORRECTION_BATCH_SIZE': 8,
+    # Color correct each batch of images as soon as its DNG conversion job finished,
+    # always fanned out as `color_correction_job`
+    'STREAMING': True,
+    # Go on with the images that succeeded when some images of a step still fail after
+    # all retries of `RETRY_POLICIES`, they are listed in `failed_images` of the task.
+    # Otherwise the task is paused
+    'COMPLETE_WITH_FAILED_IMAGES': True,
+    # Also save the prepared color checker as `color_checker_blur.tiff` in cache, to
+    # inspect what the color checker detection sees
+    'COLOR_CHECKER_DEBUG_TIFF': False,
+}
+
+# Outputs of DNG conversion and color correction are cached by content of their input
+# image and step parameters, so that identical images of re-submitted or restarted tasks
+# are linked into place instead of processed again
+#   ROOT: cache folder, `None` to disable. It must be on the same volume as task
+#       locations (e.g. `<NAS share>/.psresult`) so that outputs are hard linked, otherwise
+#       every output is copied into it
+#   MAX_SIZE: bytes, least recently used outputs are evicted beyond it
+RESULT_CACHE = {
+    'ROOT': None,
+    'MAX_SIZE': 50 * 2 ** 30,
+}
+
+# Coordinate a task as soon as files are added to its location, instead of waiting for
+# the periodic pass over all active tasks
+#   DEBOUNCE: seconds a folder must stay quiet, e.g. after an upload, before coordinating.
+#       The color checker is also used only once unchanged for this long
+#   POLL_PATHS: locations under these paths are polled by listing their folders every
+#       `POLL_INTERVAL` seconds, for network mounts which deliver no native events.
+#       All locations are polled when `watchdog` is not installed
+#   RESCAN_INTERVAL: seconds between periodic passes while watching
+FS_WATCHER = {
+    'ENABLED': True,
+    'DEBOUNCE': 2,
+    'POLL_PATHS': [],
+    'POLL_INTERVAL': 10,
+    'RESCAN_INTERVAL': 60,
+}
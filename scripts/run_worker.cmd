@@ -1 +1 @@
-"venv/Scripts/dramatiq" worker
\ No newline at end of file
+"venv/Scripts/python" worker.py %*
\ No newline at end of file
@@ -1 +1 @@
-venv/bin/dramatiq worker
\ No newline at end of file
+venv/bin/python worker.py "$@"
\ No newline at end of file
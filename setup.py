@@ -16,9 +16,11 @@ deps = {
         'Flask',
         'pymongo',
         'scikit-image',
+        'scipy',
         'flask-cors',
+        'psutil',
     ],
-    'test': [],
+    'test': ['pytest', 'mongomock'],
     'dev': ['pylint', 'flake8', 'autopep8', 'rope', 'black'],
 }
 deps['dev'] = deps['photogrammetry-service'] + deps['dev']
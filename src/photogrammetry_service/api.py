@@ -4,6 +4,8 @@ from flask import Flask, request
 from flask_cors import cross_origin
 
 from .task import (
+    DEADLINE_KEY,
+    PRIORITY_KEY,
     TASK_ID_KEY,
     TASK_LOCATION_KEY,
     TASK_STEP_KEY,
@@ -20,6 +22,40 @@ from .task import (
 from .task_coordinator import Status, DatabaseAdapter
 
 
+def _bool_arg(value: str) -> bool:
+    return value.lower() in ('1', 'true', 'yes')
+
+
+def _scheduling_args() -> dict:
+    """Optional `priority` ( higher first ) and `deadline` ( Unix time ) request parameters"""
+    fields = {}
+    if PRIORITY_KEY in request.args:
+        fields[PRIORITY_KEY] = request.args.get(PRIORITY_KEY, type=int)
+    if DEADLINE_KEY in request.args:
+        fields[DEADLINE_KEY] = request.args.get(DEADLINE_KEY, type=float)
+    return fields
+
+
+def _new_task_data(task_location: str, priority: int = 0, deadline: float = None) -> dict:
+    """Data of a new task, `task_id` is allocated when it is added to database"""
+    return {
+        TASK_LOCATION_KEY: task_location,
+        PRIORITY_KEY: priority,
+        DEADLINE_KEY: deadline,
+        TASK_STEP_KEY: StepIndex.NOT_STARTED.value,
+        STEP_IN_PROGRESS_KEY: False,
+        REQUIRE_KEY: {
+            REQ_COLOR_CHECKER_KEY: True,
+            REQ_RAW_IMAGE_KEY: True,
+        },
+        PAUSED_KEY: True,
+        IMG_PROGRESS_KEY: {
+            IMG_PROGRESS_COMPLETED_KEY: 0,
+            IMG_PROGRESS_TOTAL_KEY: 0,
+        },
+    }
+
+
 class ApiHandler(object):
     """Handle public APIs."""
 
@@ -46,24 +82,9 @@ class ApiHandler(object):
             self._server.logger.debug(f'--Task location: {task_location}')
 
             if task_location:
-                new_task_id = self._db_adaptor.get_latest_task_id() + 1
-                task_data = {
-                    TASK_ID_KEY: new_task_id,
-                    TASK_LOCATION_KEY: task_location,
-                    TASK_STEP_KEY: StepIndex.NOT_STARTED.value,
-                    STEP_IN_PROGRESS_KEY: False,
-                    REQUIRE_KEY: {
-                        REQ_COLOR_CHECKER_KEY: True,
-                        REQ_RAW_IMAGE_KEY: True,
-                    },
-                    PAUSED_KEY: True,
-                    IMG_PROGRESS_KEY: {
-                        IMG_PROGRESS_COMPLETED_KEY: 0,
-                        IMG_PROGRESS_TOTAL_KEY: 0,
-                    },
-                }
-
-                status, data, message = self._db_adaptor.add_task(task_data)
+                status, data, message = self._db_adaptor.add_task(
+                    _new_task_data(task_location, **_scheduling_args())
+                )
 
             else:
                 status = Status.ERROR.value
@@ -72,6 +93,28 @@ class ApiHandler(object):
 
             return {'status': status, 'data': data, 'message': message}
 
+        @self._server.route('/add_tasks', methods=['POST'])
+        @cross_origin()
+        def add_tasks():
+            """Add a task for each `task_location` parameter, under consecutive task IDs"""
+            task_locations = request.args.getlist(TASK_LOCATION_KEY, type=str)
+            self._server.logger.debug('Added tasks:')
+            self._server.logger.debug(f'--Task locations: {task_locations}')
+
+            if task_locations and all(task_locations):
+                status, data, message = self._db_adaptor.add_tasks(
+                    [
+                        _new_task_data(task_location, **_scheduling_args())
+                        for task_location in task_locations
+                    ]
+                )
+            else:
+                status = Status.ERROR.value
+                data = {}
+                message = 'Please provide task location directories'
+
+            return {'status': status, 'data': data, 'message': message}
+
         @self._server.route('/get_task')
         @cross_origin()
         def get_task():
@@ -88,16 +131,38 @@ class ApiHandler(object):
 
             return {'status': status, 'data': task_data, 'message': message}
 
+        @self._server.route('/ls_task_images')
+        @cross_origin()
+        def ls_task_images():
+            """Return per-image state of a task, optionally only of `step` and/or `state`"""
+            task_id = request.args.get(TASK_ID_KEY, type=int)
+            step = request.args.get(TASK_STEP_KEY, type=int)
+            state = request.args.get('state', type=str)
+
+            if task_id or task_id == 0:
+                status, data, message = self._db_adaptor.ls_images(task_id, step, state)
+            else:
+                status = Status.ERROR.value
+                data = []
+                message = 'Please provide task ID'
+
+            return {'status': status, 'data': data, 'message': message}
+
         @self._server.route('/update_task', methods=['POST'])
         @cross_origin()
         def update_task():
-            """Update task"""
+            """Update task from `task_data`, or only `priority`/`deadline` of `task_id`"""
             task_data = request.args.get('task_data', type=str)
             self._server.logger.debug('Update task:')
             self._server.logger.debug(f'--Task data: {task_data}')
 
-            if task_data:
-                status, data, message = self._db_adaptor.update_task(json.loads(task_data))
+            task_data = json.loads(task_data) if task_data else {}
+            if TASK_ID_KEY in request.args:
+                task_data[TASK_ID_KEY] = request.args.get(TASK_ID_KEY, type=int)
+            task_data.update(_scheduling_args())
+
+            if TASK_ID_KEY in task_data:
+                status, data, message = self._db_adaptor.update_task(task_data)
             else:
                 status = Status.ERROR.value
                 data = {}
@@ -124,20 +189,61 @@ class ApiHandler(object):
         @self._server.route('/ls_tasks')
         @cross_origin()
         def ls_tasks():
-            """Return a list of task IDs"""
-            status, data, message = self._db_adaptor.ls_tasks()
-            return {'status': status, 'data': data, 'message': message}
+            """Return a list of tasks
+
+            Optional query parameters:
+                step: only tasks at these steps, can be repeated
+                paused, step_in_progress: only tasks with this state
+                fields: comma separated task fields to return
+                sort: task field to sort by, prefix with "-" for descending order
+                limit: page size, `next_cursor` of response fetches the next page
+                cursor: `next_cursor` of the previous page
+            """
+            filters = {}
+            steps = request.args.getlist(TASK_STEP_KEY, type=int)
+            if steps:
+                filters[TASK_STEP_KEY] = {'$in': steps}
+            for key in (PAUSED_KEY, STEP_IN_PROGRESS_KEY):
+                if key in request.args:
+                    filters[key] = request.args.get(key, type=_bool_arg)
+
+            fields = request.args.get('fields', type=str)
+            fields = [f for f in fields.split(',') if f] if fields else None
+            sort_key = request.args.get('sort', type=str, default=TASK_ID_KEY)
+            descending = sort_key.startswith('-')
+            sort_key = sort_key.lstrip('-')
+            limit = request.args.get('limit', type=int, default=0)
+            cursor = request.args.get('cursor', type=str)
+
+            status, data, message = self._db_adaptor.query_tasks(
+                filters, fields, sort_key, descending, limit, cursor
+            )
+            return {
+                'status': status,
+                'data': data['tasks'],
+                'next_cursor': data['next_cursor'],
+                'message': message,
+            }
 
         @self._server.route('/restart_task', methods=['POST'])
         @cross_origin()
         def restart_task():
-            """Force process a specific task or all tasks"""
+            """Force process a specific task or all tasks, from scratch or from `step`
+
+            Outputs of `step` and later steps are deleted, with `all_tasks` only tasks which
+            reached `step` are restarted
+            """
             task_id = request.args.get('task_id', type=int)
             all_tasks = request.args.get('all_tasks', type=bool, default=False)
-            self._server.logger.debug(f'Process task: {task_id}, all tasks: {all_tasks}')
+            step = request.args.get(TASK_STEP_KEY, type=int)
+            self._server.logger.debug(
+                f'Process task: {task_id}, all tasks: {all_tasks}, from step: {step}'
+            )
 
             if task_id or task_id == 0 or all_tasks:
-                status, task_data, message = self._db_adaptor.restart_task(task_id, all_tasks)
+                status, task_data, message = self._db_adaptor.restart_task(
+                    task_id, all_tasks, step
+                )
             else:
                 status = Status.ERROR.value
                 task_data = {}
@@ -151,12 +257,7 @@ class ApiHandler(object):
             task_id = request.args.get('task_id', type=int)
 
             if task_id or task_id == 0:
-                status, task_data, message = self._db_adaptor.get_task(task_id)
-                task_data[PAUSED_KEY] = True
-                task_data[STEP_IN_PROGRESS_KEY] = False
-                status, task_data, message = self._db_adaptor.update_task(task_data)
-                task_data = None
-                message = f'Paused task: {task_id}'
+                status, task_data, message = self._db_adaptor.pause_task(task_id)
             else:
                 status = Status.ERROR.value
                 task_data = {}
@@ -170,11 +271,7 @@ class ApiHandler(object):
             task_id = request.args.get('task_id', type=int)
 
             if task_id or task_id == 0:
-                status, task_data, message = self._db_adaptor.get_task(task_id)
-                task_data[PAUSED_KEY] = False
-                status, task_data, message = self._db_adaptor.update_task(task_data)
-                task_data = None
-                message = f'Started task: {task_id}'
+                status, task_data, message = self._db_adaptor.start_task(task_id)
             else:
                 status = Status.ERROR.value
                 task_data = {}
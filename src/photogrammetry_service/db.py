@@ -1,19 +1,60 @@
-from typing import List
+import base64
+import json
+import logging
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
-from bson.objectid import ObjectId
 from flask import Flask
-from pymongo import MongoClient
-from pymongo.results import DeleteResult, UpdateResult
+from pymongo import ASCENDING, DESCENDING, MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from pymongo.results import BulkWriteResult, DeleteResult, UpdateResult
 
 from .task import (
+    DEADLINE_KEY,
+    FAILED_IMAGES_KEY,
+    IMAGE_ATTEMPTS_KEY,
+    IMAGE_DURATION_KEY,
+    IMAGE_ERROR_KEY,
+    IMAGE_NAME_KEY,
+    IMAGE_STARTED_KEY,
+    IMAGE_STATE_KEY,
+    IMAGE_WORKER_KEY,
+    IMG_PROGRESS_KEY,
+    IMG_PROGRESS_COMPLETED_KEY,
+    INVALIDATE_STEP_KEY,
+    JOB_MESSAGE_ID_KEY,
+    LEASE_EXPIRES_KEY,
+    LEASE_MESSAGE_ID_KEY,
+    LEASE_WORKER_KEY,
     STEP_IN_PROGRESS_KEY,
     LATEST_TASK_ID_KEY,
+    PAUSED_KEY,
+    PRIORITY_KEY,
+    REQUIRE_KEY,
+    REQ_COLOR_CHECKER_KEY,
+    REQ_RAW_IMAGE_KEY,
+    ImageState,
     StepIndex,
     TASK_ID_KEY,
     TASK_STEP_KEY,
 )
 
 
+# Task fields usable to filter and sort `DB.find_tasks()`
+INDEXED_TASK_KEYS = (
+    TASK_ID_KEY,
+    TASK_STEP_KEY,
+    PAUSED_KEY,
+    STEP_IN_PROGRESS_KEY,
+    PRIORITY_KEY,
+    DEADLINE_KEY,
+)
+
+
+class InvalidCursor(Exception):
+    pass
+
+
 class DB(object):
     """Database."""
 
@@ -21,15 +62,101 @@ class DB(object):
         super(DB, self).__init__()
         self._db = MongoClient(mongo_uri).photogrammetry_service
         self._server = server
+        self._ensure_state()
+        self._ensure_indexes()
 
-    def add_task(self, task_data: dict) -> ObjectId:
-        res = self._db.tasks.insert_one(task_data)
+    def _ensure_state(self):
+        """Create the state document holding the latest allocated task ID, if missing,
+        never behind IDs of existing tasks
+        """
+        self._db.state.update_one({}, {'$setOnInsert': {LATEST_TASK_ID_KEY: -1}}, upsert=True)
+        last_task = self._db.tasks.find_one({}, {TASK_ID_KEY: 1}, sort=[(TASK_ID_KEY, DESCENDING)])
+        if last_task and TASK_ID_KEY in last_task:
+            self._db.state.update_one({}, {'$max': {LATEST_TASK_ID_KEY: last_task[TASK_ID_KEY]}})
 
-        if self._db.state.find_one():
-            self._db.state.update_one({}, {'$set': {LATEST_TASK_ID_KEY: task_data['task_id']}})
-        else:
-            self._db.state.insert_one({LATEST_TASK_ID_KEY: task_data['task_id']})
-        return res
+    def _fix_duplicate_task_ids(self):
+        """Give new IDs to tasks sharing an ID, left by non-atomic ID allocation of older
+        versions, so that the unique index can be built. The oldest task keeps the ID
+
+        Safe to run from several processes at once, a task already moved by another one is
+        left alone
+        """
+        duplicates = self._db.tasks.aggregate(
+            [
+                {'$sort': {'_id': ASCENDING}},
+                {'$group': {'_id': f'${TASK_ID_KEY}', 'ids': {'$push': '$_id'}}},
+                {'$match': {'ids.1': {'$exists': True}}},
+            ]
+        )
+        for duplicate in duplicates:
+            for _id in duplicate['ids'][1:]:
+                task_id = self.allocate_task_ids()
+                res = self._db.tasks.update_one(
+                    {'_id': _id, TASK_ID_KEY: duplicate['_id']}, {'$set': {TASK_ID_KEY: task_id}}
+                )
+                if not res.modified_count:
+                    continue
+                logging.getLogger(__name__).warning(
+                    f'Duplicated task ID {duplicate["_id"]}, task {_id} moved to ID {task_id}'
+                )
+
+    def _ensure_indexes(self):
+        task_id_index = self._db.tasks.index_information().get(f'{TASK_ID_KEY}_1')
+        if not (task_id_index and task_id_index.get('unique')):
+            if task_id_index:
+                try:
+                    self._db.tasks.drop_index(f'{TASK_ID_KEY}_1')
+                except OperationFailure:
+                    # Already dropped by another process migrating at the same time
+                    pass
+            self._fix_duplicate_task_ids()
+        try:
+            self._db.tasks.create_index(TASK_ID_KEY, unique=True)
+        except DuplicateKeyError:
+            # Another process dropped the index and is still moving duplicates
+            self._fix_duplicate_task_ids()
+            self._db.tasks.create_index(TASK_ID_KEY, unique=True)
+        for key in INDEXED_TASK_KEYS[1:]:
+            self._db.tasks.create_index(key)
+        self._db.images.create_index(
+            [(TASK_ID_KEY, ASCENDING), (TASK_STEP_KEY, ASCENDING), (IMAGE_NAME_KEY, ASCENDING)],
+            unique=True,
+        )
+        self._db.images.create_index(
+            [(TASK_ID_KEY, ASCENDING), (TASK_STEP_KEY, ASCENDING), (IMAGE_STATE_KEY, ASCENDING)]
+        )
+        self._db.leases.create_index(LEASE_MESSAGE_ID_KEY, unique=True)
+        self._db.leases.create_index(LEASE_EXPIRES_KEY)
+        self._db.jobs.create_index(JOB_MESSAGE_ID_KEY, unique=True)
+
+    def allocate_task_ids(self, count: int = 1) -> int:
+        """Atomically reserve `count` consecutive task IDs, return the first one"""
+        state = self._db.state.find_one_and_update(
+            {},
+            {'$inc': {LATEST_TASK_ID_KEY: count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return state[LATEST_TASK_ID_KEY] - count + 1
+
+    def add_task(self, task_data: dict) -> int:
+        """Insert a new task under a newly allocated ID, return that ID"""
+        task_data[TASK_ID_KEY] = self.allocate_task_ids()
+        self._db.tasks.insert_one(task_data)
+        task_data.pop('_id', None)
+        return task_data[TASK_ID_KEY]
+
+    def add_tasks(self, tasks: List[dict]) -> List[int]:
+        """Insert new tasks under a contiguous range of newly allocated IDs, return the IDs"""
+        if not tasks:
+            return []
+        first_task_id = self.allocate_task_ids(len(tasks))
+        for i, task_data in enumerate(tasks):
+            task_data[TASK_ID_KEY] = first_task_id + i
+        self._db.tasks.insert_many(tasks)
+        for task_data in tasks:
+            task_data.pop('_id', None)
+        return [task_data[TASK_ID_KEY] for task_data in tasks]
 
     def get_latest_task_id(self) -> int:
         state = self._db.state.find_one()
@@ -49,13 +176,376 @@ class DB(object):
         res = self._db.tasks.update_one({TASK_ID_KEY: task_data[TASK_ID_KEY]}, {'$set': task_data})
         return res
 
+    @staticmethod
+    def _partial_update(
+        task_id: int,
+        set_fields: dict = None,
+        unset_fields: List[str] = None,
+        inc_fields: dict = None,
+        expected: dict = None,
+    ) -> Tuple[dict, dict]:
+        query = {TASK_ID_KEY: task_id}
+        query.update(expected or {})
+        update = {}
+        if set_fields:
+            update['$set'] = set_fields
+        if unset_fields:
+            update['$unset'] = {field: '' for field in unset_fields}
+        if inc_fields:
+            update['$inc'] = inc_fields
+        return query, update
+
+    def task_update(
+        self,
+        task_id: int,
+        set_fields: dict = None,
+        unset_fields: List[str] = None,
+        inc_fields: dict = None,
+        expected: dict = None,
+    ) -> UpdateOne:
+        """Partial update of a task, to be applied by `bulk_update_tasks()`
+
+        Args:
+            set_fields: values to `$set`, keys can be dotted paths (e.g. "image_progress.total")
+            unset_fields: fields to `$unset`
+            inc_fields: values to `$inc`
+            expected: compare-and-set, only update if the task still has these values
+        """
+        return UpdateOne(
+            *self._partial_update(task_id, set_fields, unset_fields, inc_fields, expected)
+        )
+
+    def set_task_fields(self, task_id: int, set_fields: dict, expected: dict = None) -> bool:
+        """Set only the given fields of a task, return False if `expected` values didn't match"""
+        res = self._db.tasks.update_one(
+            *self._partial_update(task_id, set_fields, expected=expected)
+        )
+        return res.matched_count == 1
+
+    def image_progress_update(
+        self, task_id: int, completed: int, expected: dict = None
+    ) -> UpdateOne:
+        """`$inc` completed images of a task, to be applied by `bulk_update_tasks()`"""
+        return self.task_update(
+            task_id,
+            inc_fields={f'{IMG_PROGRESS_KEY}.{IMG_PROGRESS_COMPLETED_KEY}': completed},
+            expected=expected,
+        )
+
+    def bulk_update_tasks(self, operations: List[UpdateOne]) -> Optional[BulkWriteResult]:
+        """Apply partial updates in a single round-trip, in order"""
+        if not operations:
+            return None
+        return self._db.tasks.bulk_write(operations, ordered=True)
+
+    def restart_tasks(self, task_ids: Optional[List[int]], step_id: int = None) -> int:
+        """Rewind tasks in a single update, return the number of restarted tasks
+
+        Args:
+            task_ids: only these tasks, all tasks if `None`
+            step_id: rerun from this step, only tasks which reached it, are not running a
+                step and hold no lease of a running job are rewound, and outputs from this
+                step on are invalidated. Without it, tasks rerun from `NOT_STARTED` and
+                outputs are kept
+        """
+        query = {}
+        task_id_query = {}
+        if task_ids is not None:
+            task_id_query['$in'] = list(task_ids)
+        if step_id is not None:
+            busy_task_ids = self.leased_task_ids(task_ids)
+            if busy_task_ids:
+                task_id_query['$nin'] = list(busy_task_ids)
+        if task_id_query:
+            query[TASK_ID_KEY] = task_id_query
+        set_fields = {STEP_IN_PROGRESS_KEY: False, PAUSED_KEY: False}
+        unset_fields = {}
+        if step_id is None:
+            set_fields[TASK_STEP_KEY] = StepIndex.NOT_STARTED.value
+            set_fields[FAILED_IMAGES_KEY] = {}
+        else:
+            query[TASK_STEP_KEY] = {'$gte': step_id}
+            # Running jobs would write outputs of the old run into the invalidated folders
+            query[STEP_IN_PROGRESS_KEY] = False
+            set_fields[TASK_STEP_KEY] = step_id
+            set_fields[INVALIDATE_STEP_KEY] = step_id
+            for step in StepIndex:
+                if step.value >= step_id:
+                    unset_fields[f'{FAILED_IMAGES_KEY}.{step.name}'] = ''
+        update = {'$set': set_fields}
+        if unset_fields:
+            update['$unset'] = unset_fields
+        return self._db.tasks.update_many(query, update).matched_count
+
+    def delete_images(self, task_id: int, from_step_id: int = None):
+        """Forget per-image states of a task, only of `from_step_id` and later steps if set"""
+        query = {TASK_ID_KEY: task_id}
+        if from_step_id is not None:
+            query[TASK_STEP_KEY] = {'$gte': from_step_id}
+        self._db.images.delete_many(query)
+
     def delete_task(self, task_id: int) -> DeleteResult:
         res = self._db.tasks.delete_one({TASK_ID_KEY: task_id})
+        self._db.images.delete_many({TASK_ID_KEY: task_id})
         return res
 
+    @staticmethod
+    def _image_query(
+        task_id: int, step_id: int = None, image_names: List[str] = None, state: ImageState = None
+    ) -> dict:
+        query = {TASK_ID_KEY: task_id}
+        if step_id is not None:
+            query[TASK_STEP_KEY] = step_id
+        if image_names is not None:
+            query[IMAGE_NAME_KEY] = {'$in': list(image_names)}
+        if state is not None:
+            query[IMAGE_STATE_KEY] = state.value
+        return query
+
+    def images_started(self, task_id: int, step_id: int, image_names: List[str], worker_id: str):
+        """Mark images as being processed by `worker_id`, count one more attempt"""
+        operations = [
+            UpdateOne(
+                {TASK_ID_KEY: task_id, TASK_STEP_KEY: step_id, IMAGE_NAME_KEY: image_name},
+                {
+                    '$set': {
+                        IMAGE_STATE_KEY: ImageState.RUNNING.value,
+                        IMAGE_WORKER_KEY: worker_id,
+                        IMAGE_STARTED_KEY: time.time(),
+                    },
+                    '$unset': {IMAGE_DURATION_KEY: '', IMAGE_ERROR_KEY: ''},
+                    '$inc': {IMAGE_ATTEMPTS_KEY: 1},
+                },
+                upsert=True,
+            )
+            for image_name in image_names
+        ]
+        if operations:
+            self._db.images.bulk_write(operations, ordered=False)
+
+    def images_finished(
+        self, task_id: int, step_id: int, errors: Dict[str, Optional[str]], duration: float
+    ):
+        """Record outcome of processed images
+
+        Args:
+            errors: error of every processed image, `None` if it succeeded
+            duration: processing time of each image (seconds)
+        """
+        operations = []
+        for image_name, error in errors.items():
+            state = ImageState.DONE if error is None else ImageState.FAILED
+            operations.append(
+                UpdateOne(
+                    {TASK_ID_KEY: task_id, TASK_STEP_KEY: step_id, IMAGE_NAME_KEY: image_name},
+                    {
+                        '$set': {
+                            IMAGE_STATE_KEY: state.value,
+                            IMAGE_DURATION_KEY: duration,
+                            IMAGE_ERROR_KEY: error,
+                        }
+                    },
+                )
+            )
+        if operations:
+            self._db.images.bulk_write(operations, ordered=False)
+
+    def find_images(
+        self,
+        task_id: int,
+        step_id: int = None,
+        image_names: List[str] = None,
+        state: ImageState = None,
+    ) -> List[dict]:
+        query = self._image_query(task_id, step_id, image_names, state)
+        sort = [(TASK_STEP_KEY, ASCENDING), (IMAGE_NAME_KEY, ASCENDING)]
+        return list(self._db.images.find(query, {'_id': 0}).sort(sort))
+
+    def count_images(self, task_id: int, step_id: int = None, state: ImageState = None) -> int:
+        return self._db.images.count_documents(self._image_query(task_id, step_id, state=state))
+
+    def renew_lease(
+        self, message_id: str, task_id: int, step_id: int, worker_id: str, horizon: float
+    ):
+        """Hold the lease of a running job for `horizon` more seconds"""
+        self._db.leases.update_one(
+            {LEASE_MESSAGE_ID_KEY: message_id},
+            {
+                '$set': {
+                    TASK_ID_KEY: task_id,
+                    TASK_STEP_KEY: step_id,
+                    LEASE_WORKER_KEY: worker_id,
+                    LEASE_EXPIRES_KEY: time.time() + horizon,
+                }
+            },
+            upsert=True,
+        )
+
+    def release_lease(self, message_id: str):
+        self._db.leases.delete_one({LEASE_MESSAGE_ID_KEY: message_id})
+
+    def leased_task_ids(self, task_ids: Optional[Iterable[int]] = None) -> Set[int]:
+        """Tasks with running jobs, i.e. holding a lease not expired yet"""
+        query = {LEASE_EXPIRES_KEY: {'$gte': time.time()}}
+        if task_ids is not None:
+            query[TASK_ID_KEY] = {'$in': list(task_ids)}
+        return set(self._db.leases.distinct(TASK_ID_KEY, query))
+
+    def expired_leases(self) -> List[dict]:
+        """Leases not renewed in time, their worker is presumably dead"""
+        query = {LEASE_EXPIRES_KEY: {'$lt': time.time()}}
+        return list(self._db.leases.find(query, {'_id': 0}))
+
+    def add_jobs(self, jobs: List[dict]):
+        """Record jobs sent to workers, so that a restarted coordinator still gets their results"""
+        if jobs:
+            self._db.jobs.insert_many(jobs)
+
+    def delete_jobs(self, message_ids: Iterable[str]):
+        message_ids = list(message_ids)
+        if message_ids:
+            self._db.jobs.delete_many({JOB_MESSAGE_ID_KEY: {'$in': message_ids}})
+
+    def ls_jobs(self) -> List[dict]:
+        return list(self._db.jobs.find({}, {'_id': 0}))
+
     def ls_tasks(self) -> List[dict]:
         tasks = []
         for t in self._db.tasks.find():
             t.pop('_id')
             tasks.append(t)
         return tasks
+
+    def find_tasks(
+        self,
+        filters: dict = None,
+        fields: List[str] = None,
+        sort_key: str = TASK_ID_KEY,
+        descending: bool = False,
+        limit: int = 0,
+        cursor: str = None,
+    ) -> Tuple[List[dict], Optional[str]]:
+        """Query a page of tasks
+
+        Args:
+            filters: MongoDB query on task fields
+            fields: only return these fields (`task_id` is always returned)
+            sort_key: one of `INDEXED_TASK_KEYS`, ties are ordered by `task_id`
+            descending: sort direction
+            limit: max number of tasks in the page, 0 for no limit
+            cursor: `next_cursor` returned with the previous page
+
+        Returns:
+            Tasks of the page, and cursor of the next page (`None` if this is the last one)
+        """
+        if sort_key not in INDEXED_TASK_KEYS:
+            raise ValueError(f'Cannot sort tasks by "{sort_key}"')
+        if limit < 0:
+            raise ValueError(f'Invalid limit: {limit}')
+
+        query = dict(filters or {})
+        if cursor:
+            query = {'$and': [query, self._cursor_query(cursor, sort_key, descending)]}
+
+        projection = {'_id': 0}
+        if fields:
+            projection.update({field: 1 for field in fields})
+            projection[TASK_ID_KEY] = 1
+            projection[sort_key] = 1
+
+        direction = DESCENDING if descending else ASCENDING
+        sort = [(sort_key, direction)]
+        if sort_key != TASK_ID_KEY:
+            sort.append((TASK_ID_KEY, direction))
+
+        tasks = list(self._db.tasks.find(query, projection).sort(sort).limit(limit))
+
+        next_cursor = None
+        if limit and len(tasks) == limit:
+            last = tasks[-1]
+            next_cursor = self._encode_cursor(last.get(sort_key), last[TASK_ID_KEY])
+        if fields and sort_key not in fields and sort_key != TASK_ID_KEY:
+            for t in tasks:
+                t.pop(sort_key, None)
+        return tasks, next_cursor
+
+    @staticmethod
+    def _encode_cursor(sort_value: Any, task_id: int) -> str:
+        return base64.urlsafe_b64encode(json.dumps([sort_value, task_id]).encode()).decode()
+
+    @staticmethod
+    def _cursor_query(cursor: str, sort_key: str, descending: bool) -> dict:
+        """Query of tasks positioned after `cursor` in the sort order"""
+        try:
+            sort_value, task_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except Exception:
+            raise InvalidCursor(f'Invalid cursor: {cursor}')
+
+        op = '$lt' if descending else '$gt'
+        if sort_key == TASK_ID_KEY:
+            return {TASK_ID_KEY: {op: task_id}}
+        # Null or missing values sort before all others, e.g. tasks without deadline
+        if sort_value is None:
+            same = {sort_key: None, TASK_ID_KEY: {op: task_id}}
+            if descending:
+                return same
+            return {'$or': [{sort_key: {'$ne': None}}, same]}
+        after = [
+            {sort_key: {op: sort_value}},
+            {sort_key: sort_value, TASK_ID_KEY: {op: task_id}},
+        ]
+        if descending:
+            after.append({sort_key: None})
+        return {'$or': after}
+
+    def ls_active_tasks(self, task_ids: Optional[Iterable[int]] = None) -> List[dict]:
+        """Tasks the coordinator has to look at: not completed, and either not paused
+        or still waiting for user's input files
+
+        Args:
+            task_ids: only these tasks, all active tasks if `None`
+        """
+        query = {
+            TASK_STEP_KEY: {'$lt': StepIndex.COMPLETED.value},
+            '$or': [
+                {PAUSED_KEY: False},
+                {f'{REQUIRE_KEY}.{REQ_COLOR_CHECKER_KEY}': True},
+                {f'{REQUIRE_KEY}.{REQ_RAW_IMAGE_KEY}': True},
+            ],
+        }
+        if task_ids is not None:
+            query[TASK_ID_KEY] = {'$in': list(task_ids)}
+
+        tasks = []
+        for t in self._db.tasks.find(query, {'_id': 0}).sort(TASK_ID_KEY):
+            tasks.append(t)
+        return tasks
+
+    def watch_tasks(self) -> Iterator[int]:
+        """Yield task ID whenever a task is added, or its step/paused state is changed
+
+        Raise `pymongo.errors.OperationFailure` if MongoDB is not a replica set
+        """
+        pipeline = [
+            {
+                '$match': {
+                    '$or': [
+                        {'operationType': {'$in': ['insert', 'replace']}},
+                        {f'updateDescription.updatedFields.{TASK_STEP_KEY}': {'$exists': True}},
+                        {f'updateDescription.updatedFields.{PAUSED_KEY}': {'$exists': True}},
+                        {f'updateDescription.updatedFields.{PRIORITY_KEY}': {'$exists': True}},
+                        {f'updateDescription.updatedFields.{DEADLINE_KEY}': {'$exists': True}},
+                        {
+                            f'updateDescription.updatedFields.{INVALIDATE_STEP_KEY}': {
+                                '$exists': True
+                            }
+                        },
+                    ]
+                }
+            }
+        ]
+        with self._db.tasks.watch(pipeline, full_document='updateLookup') as stream:
+            for change in stream:
+                task_data = change.get('fullDocument')
+                if task_data:
+                    yield task_data[TASK_ID_KEY]
@@ -1,60 +1,78 @@
+from logging import Logger
 from pathlib import Path
-import subprocess
+from typing import List, Union
+
+from .process_runner import run_tool
 
 PREPARE_RC_MARKER = 'project.rcproj'
 MESH_CONSTRUCTION_MARKER = 'output.fbx'
 
+DNG_CONVERTER = 'DNG_CONVERTER'
+REALITY_CAPTURE = 'REALITY_CAPTURE'
+
+# Compressed lossless DNG
+DNG_CONVERSION_OPTIONS = ['-c']
 
-def run_dng_conversion(input_file: Path, output_dir: Path, ext_tool_exe: Path):
-    output_dir.mkdir(parents=True, exist_ok=True)
-    cmd = f'"{ext_tool_exe}" -c -d "{output_dir}" "{input_file}"'
-    print(cmd)
-    sts = subprocess.Popen(
-        cmd,
-        shell=True,
-    ).wait()
-    return sts
 
+def tool_version(ext_tool_exe: Path) -> str:
+    """Identify the installed build of a tool from its executable, without running it"""
+    st = ext_tool_exe.stat()
+    return f'{ext_tool_exe.name}:{st.st_size}:{st.st_mtime_ns}'
 
-def run_prepare_rc(input_dir: Path, output_dir: Path, ext_tool_exe: Path):
+
+def run_dng_conversion(
+    input_file: Union[Path, List[Path]], output_dir: Path, ext_tool_exe: Path, logger: Logger = None
+):
+    """Convert one or many raw images to DNG in `output_dir` with a single converter process"""
     output_dir.mkdir(parents=True, exist_ok=True)
+    input_files = input_file if isinstance(input_file, list) else [input_file]
+    cmd = [ext_tool_exe] + DNG_CONVERSION_OPTIONS + ['-d', output_dir] + input_files
+    return run_tool(DNG_CONVERTER, cmd, logger).returncode
 
-    rc_project = output_dir.joinpath(PREPARE_RC_MARKER)
 
-    command = '"{}" -newScene -addFolder "{}" -align \
-        -setReconstructionRegionAuto -save "{}" -quit'.format(
-        ext_tool_exe, input_dir, rc_project
-    )
+def run_prepare_rc(input_dir: Path, output_dir: Path, ext_tool_exe: Path, logger: Logger = None):
+    output_dir.mkdir(parents=True, exist_ok=True)
 
-    sts = subprocess.Popen(
-        command,
-        shell=True,
-    ).wait()
+    rc_project = output_dir.joinpath(PREPARE_RC_MARKER)
 
-    return sts
+    cmd = [
+        ext_tool_exe,
+        '-newScene',
+        '-addFolder',
+        input_dir,
+        '-align',
+        '-setReconstructionRegionAuto',
+        '-save',
+        rc_project,
+        '-quit',
+    ]
+    return run_tool(REALITY_CAPTURE, cmd, logger).returncode
 
 
-def run_mesh_construction(input_dir: Path, output_dir: Path, ext_tool_exe: Path, rc_setting: Path):
+def run_mesh_construction(
+    input_dir: Path, output_dir: Path, ext_tool_exe: Path, rc_setting: Path, logger: Logger = None
+):
     output_dir.mkdir(parents=True, exist_ok=True)
 
     rc_project = input_dir.joinpath(PREPARE_RC_MARKER)
     output_mesh = output_dir.joinpath(MESH_CONSTRUCTION_MARKER)
 
-    command = '"{}" -load "{}" -calculateNormalModel -unwrap "{}" -calculateTexture \
-    -exportSelectedModel "{}" "{}" -exportLod "{}" "{}" -save "{}" -quit'.format(
+    cmd = [
         ext_tool_exe,
+        '-load',
         rc_project,
+        '-calculateNormalModel',
+        '-unwrap',
         rc_setting.joinpath("RC_UV_16K_Optimal.xml"),
+        '-calculateTexture',
+        '-exportSelectedModel',
         output_mesh,
         rc_setting.joinpath("RC_ExportFBX_VC_noTEX.xml"),
+        '-exportLod',
         output_dir.joinpath("RC_LOD.obj"),
         rc_setting.joinpath("RC_ExportLOD_TEX_noVC.xml"),
+        '-save',
         rc_project,
-    )
-
-    sts = subprocess.Popen(
-        command,
-        shell=True,
-    ).wait()
-
-    return sts
+        '-quit',
+    ]
+    return run_tool(REALITY_CAPTURE, cmd, logger).returncode
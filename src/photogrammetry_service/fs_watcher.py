@@ -0,0 +1,246 @@
+"""
+Watch task locations for new files
+
+Files created, written and closed, or moved into a task location are reported per task,
+once their directory stayed quiet for a debounce delay, so that an upload of many images
+results in a single notification. Native events come from `watchdog` (inotify, FSEvents,
+ReadDirectoryChangesW) when it is installed. Locations under `POLL_PATHS`, e.g. network
+mounts which deliver no native events, or all of them without `watchdog`, are polled by
+diffing directory listings instead.
+"""
+
+import os
+import threading
+import time
+from logging import Logger
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Optional, Tuple, Union
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+# Event types of `watchdog` which may bring a new or completed file
+WATCHED_EVENT_TYPES = {'created', 'closed', 'moved'}
+
+# Name -> (size, mtime_ns) of the entries of a directory, sub-directories are only
+# listed by name, their own listing reports files added to them
+Listing = Dict[str, Tuple[int, int]]
+
+
+def _key(path: Union[str, Path]) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+def _list_dir(directory: str) -> Listing:
+    listing = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        listing[entry.name] = (0, 0)
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue
+                listing[entry.name] = (st.st_size, st.st_mtime_ns)
+    except OSError:
+        pass
+    return listing
+
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, watcher: 'TaskWatcher'):
+        super(_EventHandler, self).__init__()
+        self._watcher = watcher
+
+    def on_any_event(self, event):
+        if event.event_type not in WATCHED_EVENT_TYPES:
+            return
+        path = getattr(event, 'dest_path', None) or event.src_path
+        directory = path if event.is_directory else os.path.dirname(path)
+        self._watcher.touch(directory)
+
+
+class TaskWatcher(object):
+    """Report changed directories of watched task locations to `on_change`
+
+    Args:
+        on_change: called from the watcher thread with the task ID and changed directory
+        debounce: seconds a directory must stay quiet before it is reported
+        poll_interval: seconds between listings of polled locations
+        poll_paths: locations under these paths are always polled
+    """
+
+    def __init__(
+        self,
+        on_change: Callable[[int, Path], None],
+        debounce: float = 2,
+        poll_interval: float = 10,
+        poll_paths: Iterable[str] = (),
+        logger: Logger = None,
+    ):
+        super(TaskWatcher, self).__init__()
+        self._on_change = on_change
+        self._debounce = debounce
+        self._poll_interval = poll_interval
+        self._poll_paths = [_key(p) for p in poll_paths]
+        self._logger = logger
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._observer = None
+        # Task ID -> location key, and location key -> watchdog watch of native locations
+        self._locations: Dict[int, str] = {}
+        self._watches: Dict[str, object] = {}
+        # Location key -> directory key -> listing, of polled locations
+        self._listings: Dict[str, Dict[str, Listing]] = {}
+        # Directory key -> (task ID, time of its last event) not yet reported
+        self._pending: Dict[str, Tuple[int, float]] = {}
+
+    @property
+    def native(self) -> bool:
+        """Whether `watchdog` is available for native events"""
+        return Observer is not None
+
+    def start(self):
+        if self._thread:
+            return
+        if self.native:
+            self._observer = Observer()
+            self._observer.start()
+        elif self._logger:
+            self._logger.info('watchdog is not installed, polling task locations')
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='task-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._observer:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _polled(self, location: str) -> bool:
+        if not self._observer:
+            return True
+        return any(location == p or location.startswith(p + os.sep) for p in self._poll_paths)
+
+    def watch(self, task_id: int, location: Union[str, Path]):
+        """Start watching a task location, no-op if already watched"""
+
+        location = _key(location)
+        with self._lock:
+            if self._locations.get(task_id) == location:
+                return
+        self.unwatch(task_id)
+
+        if self._polled(location):
+            listings = self._list_location(location)
+            with self._lock:
+                self._listings[location] = listings
+        elif os.path.isdir(location):
+            try:
+                watch = self._observer.schedule(_EventHandler(self), location, recursive=True)
+            except OSError as e:
+                if self._logger:
+                    self._logger.warning(f'Failed to watch {location} :: {str(e)}')
+                return
+            with self._lock:
+                self._watches[location] = watch
+        else:
+            # Not created yet, picked up again by the next `sync()`
+            return
+
+        with self._lock:
+            self._locations[task_id] = location
+
+    def unwatch(self, task_id: int):
+        with self._lock:
+            location = self._locations.pop(task_id, None)
+            if location is None or location in self._locations.values():
+                return
+            self._listings.pop(location, None)
+            watch = self._watches.pop(location, None)
+        if watch and self._observer:
+            self._observer.unschedule(watch)
+
+    def sync(self, locations: Dict[int, Union[str, Path]]):
+        """Watch exactly these task locations, keyed by task ID"""
+
+        with self._lock:
+            task_ids = set(self._locations)
+        for task_id in task_ids - set(locations):
+            self.unwatch(task_id)
+        for task_id, location in locations.items():
+            self.watch(task_id, location)
+
+    def touch(self, directory: Union[str, Path]):
+        """Record an event in `directory`, it is reported once quiet for `debounce` seconds"""
+
+        directory = _key(directory)
+        with self._lock:
+            for task_id, location in self._locations.items():
+                if directory == location or directory.startswith(location + os.sep):
+                    self._pending[directory] = (task_id, time.monotonic())
+                    return
+
+    @staticmethod
+    def _list_location(location: str) -> Dict[str, Listing]:
+        """Listings of a task location and of its step folders"""
+
+        listings = {location: _list_dir(location)}
+        for name in listings[location]:
+            sub_directory = os.path.join(location, name)
+            if os.path.isdir(sub_directory):
+                listings[sub_directory] = _list_dir(sub_directory)
+        return listings
+
+    def _poll(self):
+        with self._lock:
+            polled = dict(self._listings)
+        for location, old_listings in polled.items():
+            listings = self._list_location(location)
+            for directory, listing in listings.items():
+                old_listing = old_listings.get(directory, {})
+                # Only new or grown/rewritten entries, deletions bring nothing to process
+                if any(old_listing.get(name) != entry for name, entry in listing.items()):
+                    self.touch(directory)
+            with self._lock:
+                if location in self._listings:
+                    self._listings[location] = listings
+
+    def _flush(self):
+        now = time.monotonic()
+        with self._lock:
+            ready = [
+                (directory, task_id)
+                for directory, (task_id, last_event) in self._pending.items()
+                if now - last_event >= self._debounce
+            ]
+            for directory, _ in ready:
+                self._pending.pop(directory)
+        for directory, task_id in ready:
+            try:
+                self._on_change(task_id, Path(directory))
+            except Exception as e:
+                if self._logger:
+                    self._logger.error(f'Task watcher error, task: {task_id} :: {str(e)}')
+
+    def _run(self):
+        next_poll = time.monotonic() + self._poll_interval
+        tick = max(min(self._debounce, self._poll_interval) / 4, 0.1)
+        while not self._stop.wait(tick):
+            if time.monotonic() >= next_poll:
+                self._poll()
+                next_poll = time.monotonic() + self._poll_interval
+            self._flush()
@@ -4,16 +4,18 @@ Image processing utilities
 
 import os
 from pathlib import Path
+from typing import Union
+from uuid import uuid4
 
 import colour
 import imageio
+import numpy as np
 import rawpy
-import skimage
 from colour_checker_detection import detect_colour_checkers_segmentation
 from colour_checker_detection.detection.segmentation import ColourCheckerSwatchesData
 
 from PIL import Image
-from skimage import data, filters, io
+from scipy import ndimage
 
 D65 = colour.CCS_ILLUMINANTS['CIE 1931 2 Degree Standard Observer']['D65']
 REF_COLOUR_CHECKER = colour.CCS_COLOURCHECKERS['ColorChecker24 - After November 2014']
@@ -24,35 +26,54 @@ REF_SWATCHES = colour.XYZ_to_RGB(
     colour.RGB_COLOURSPACES['sRGB'].matrix_XYZ_to_RGB,
 )
 
+# Degree of the root-polynomial expansion used by 'Finlayson 2015' colour correction
+CCM_DEGREE = 1
+# Number of expanded terms -> root-polynomial degree
+CCM_TERMS_DEGREE = {3: 1, 6: 2, 13: 3, 22: 4}
 
-def dng_to_png(src: Path, tg: Path):
-    with rawpy.imread(src.as_posix()) as raw:
-        rgb = raw.postprocess(
-            highlight_mode=0, no_auto_bright=False, use_camera_wb=True, gamma=(2.4, 12.92)
-        )
-    imageio.imsave(tg.as_posix(), rgb)
+# Quality of color corrected JPG images
+JPEG_QUALITY = 95
 
+# Gaussian blur of the color checker image, in pixels of the full resolution image
+CC_BLUR_SIGMA = 10
+# Box filter passes approximating the gaussian blur
+CC_BLUR_PASSES = 3
+
+
+def box_blur(image: np.ndarray, sigma: float, passes: int = CC_BLUR_PASSES) -> np.ndarray:
+    """Approximate a gaussian blur of `sigma` with repeated separable box filters"""
+    # Width of a box filter whose `passes` repetitions have the variance of the gaussian
+    width = max(int(round(np.sqrt(12 * sigma ** 2 / passes + 1))), 1)
+    for _ in range(passes):
+        for axis in (0, 1):
+            image = ndimage.uniform_filter1d(image, width, axis=axis, mode='reflect')
+    return image
 
-def dng_to_tif(src: Path, tg: Path):
-    with rawpy.imread(src.as_posix()) as raw:
-        rgb = raw.postprocess(
-            highlight_mode=0, no_auto_bright=True, use_camera_wb=True, gamma=(2.4, 12.92)
-        )
-    imageio.imsave(tg.as_posix(), rgb)
 
+def prepare_color_checker(src: Path) -> np.ndarray:
+    """Decode a color checker raw image (DNG/ARW) at half size and blur it, in memory
 
-def blur(src: Path, tg: Path):
-    """Blur image
-    WARNING: does not work with TIFF
+    Auto brightness is kept on so that swatches are detected on dark shots. Returns a linear
+    float32 RGB buffer for `compute_swatch()`.
     """
-    image = skimage.io.imread(fname=src.as_posix(), plugin='pil')
-    blurred = skimage.filters.gaussian(image, sigma=(10, 10), truncate=3.5, multichannel=True)
-    skimage.io.imsave(tg.as_posix(), blurred)
+    with rawpy.imread(src.as_posix()) as raw:
+        rgb = raw.postprocess(
+            half_size=True,
+            highlight_mode=0,
+            no_auto_bright=False,
+            use_camera_wb=True,
+            gamma=(2.4, 12.92),
+        )
+    image = rgb.astype(np.float32)
+    image *= 1 / 255
+    image = box_blur(image, CC_BLUR_SIGMA / 2)
+    return colour.cctf_decoding(image).astype(np.float32, copy=False)
 
 
-def png_to_tif(src: Path, tg: Path):
-    im = Image.open(src.as_posix())
-    im.save(tg.as_posix())
+def write_color_checker(image: np.ndarray, tg: Path):
+    """Save a prepared color checker as TIFF, for debugging only"""
+    encoded = np.clip(colour.cctf_encoding(image), 0, 1)
+    imageio.imsave(tg.as_posix(), np.around(encoded * 255).astype(np.uint8))
 
 
 def verify_color_swatches(swatches):
@@ -98,41 +119,97 @@ def verify_color_swatches(swatches):
     return result, swatches[min_i]
 
 
-def compute_swatch(color_checker: Path) -> ColourCheckerSwatchesData:
+def compute_swatch(color_checker: Union[Path, np.ndarray]) -> ColourCheckerSwatchesData:
     """
     Args:
-        color_checker (Path): blurry TIFF color checker
+        color_checker (Path | np.ndarray): blurry TIFF color checker, or linear image from
+            `prepare_color_checker()`
     """
-    color_checker_img = colour.cctf_decoding(colour.io.read_image(color_checker.as_posix()))
+    if isinstance(color_checker, np.ndarray):
+        color_checker_img = color_checker
+    else:
+        color_checker_img = colour.cctf_decoding(colour.io.read_image(color_checker.as_posix()))
     swatches = detect_colour_checkers_segmentation(color_checker_img)
     vresult, swatch = verify_color_swatches(swatches)
     return swatch
 
 
-def color_correct(src: Path, tg: Path, swatch: ColourCheckerSwatchesData, cache_dir: Path = None):
+def decode_raw(src: Path) -> np.ndarray:
+    """Demosaic a raw image (DNG/ARW) into a linear float32 RGB buffer in [0, 1]
+
+    Decoded with sRGB CCTF, without auto brightness so that all images of a task share
+    the same exposure.
     """
-    Args:
-        src (Path): DNG image
-        tg (Path): JPG image
+    with rawpy.imread(src.as_posix()) as raw:
+        rgb = raw.postprocess(
+            highlight_mode=0, no_auto_bright=True, use_camera_wb=True, gamma=(2.4, 12.92)
+        )
+    image = rgb.astype(np.float32)
+    image *= 1 / 255
+    return colour.cctf_decoding(image).astype(np.float32, copy=False)
+
+
+def write_jpeg(image: np.ndarray, tg: Path, quality: int = JPEG_QUALITY):
+    """Encode a linear float RGB buffer with sRGB CCTF and save it as JPG
+
+    The file is written next to `tg` then renamed, so `tg` is never partially written
     """
+    encoded = colour.cctf_encoding(image)
+    np.clip(encoded, 0, 1, out=encoded)
+    encoded *= 255
+    rgb = np.around(encoded, out=encoded).astype(np.uint8)
+    tmp = tg.parent.joinpath(f'.{tg.name}.{uuid4().hex}.tmp')
+    try:
+        Image.fromarray(rgb).save(tmp.as_posix(), format='JPEG', quality=quality, subsampling=0)
+        os.replace(tmp, tg)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def compute_color_correction_matrix(
+    swatch: ColourCheckerSwatchesData, degree: int = CCM_DEGREE
+) -> np.ndarray:
+    """Fit the 'Finlayson 2015' root-polynomial colour correction matrix of `swatch`
+
+    Returns a `(3, terms)` float32 matrix mapping expanded RGB terms to `REF_SWATCHES`
+    """
+    expanded = colour.characterisation.polynomial_expansion_Finlayson2015(
+        swatch, degree, root_polynomial_expansion=True
+    )
+    ccm = np.dot(np.transpose(REF_SWATCHES), np.linalg.pinv(np.transpose(expanded)))
+    return ccm.astype(np.float32)
 
-    cache_dir = cache_dir if cache_dir else tg.parent
 
-    # Convert source image to temp TIFF
-    tmp_tif = cache_dir.joinpath(f'{tg.stem}_tmp.tiff')
-    dng_to_tif(src, tmp_tif)
+def save_color_correction_matrix(ccm: np.ndarray, tg: Path):
+    with open(tg.as_posix(), 'wb') as f:
+        np.save(f, ccm)
 
-    # Correct color of that temp TIFF
-    image = colour.cctf_decoding(colour.io.read_image(tmp_tif.as_posix()))
-    cc_image = colour.colour_correction(image, swatch, REF_SWATCHES, 'Finlayson 2015')
-    cc_tmp_tif = cache_dir.joinpath(f'{tg.stem}_cc.tiff')
-    colour.io.write_image(colour.cctf_encoding(cc_image), cc_tmp_tif.as_posix(), bit_depth='uint8')
 
-    # Save color corrected TIFF as JPG
-    final_cc_jpg = tg.parent.joinpath(f'{tg.stem}.jpg')
-    img = Image.open(cc_tmp_tif.as_posix())
-    img.save(final_cc_jpg.as_posix(), quality=95, subsampling=0)
+def load_color_correction_matrix(src: Path) -> np.ndarray:
+    return np.load(src.as_posix())
+
+
+def apply_color_correction_matrix(image: np.ndarray, ccm: np.ndarray) -> np.ndarray:
+    """Apply a matrix from `compute_color_correction_matrix()` to every pixel of `image`"""
+    ccm = np.asarray(ccm, dtype=np.float32)
+    degree = CCM_TERMS_DEGREE[ccm.shape[1]]
+    pixels = image.reshape(-1, 3)
+    if degree > 1:
+        pixels = colour.characterisation.polynomial_expansion_Finlayson2015(
+            pixels, degree, root_polynomial_expansion=True
+        ).astype(np.float32)
+    return np.dot(pixels, ccm.T).reshape(image.shape)
+
+
+def color_correct(src: Path, tg: Path, ccm: np.ndarray):
+    """
+    Args:
+        src (Path): DNG image, or raw image readable by `rawpy`
+        tg (Path): JPG image
+        ccm (np.ndarray): matrix from `compute_color_correction_matrix()`
+    """
 
-    # Clean tmp files
-    os.remove(tmp_tif.as_posix())
-    os.remove(cc_tmp_tif.as_posix())
+    image = decode_raw(src)
+    cc_image = apply_color_correction_matrix(image, ccm)
+    write_jpeg(cc_image, tg.parent.joinpath(f'{tg.stem}.jpg'))
@@ -0,0 +1,39 @@
+"""
+Process pool for CPU-bound image processing inside a worker
+"""
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from threading import Lock
+from typing import Callable, List, Optional, Sequence
+
+
+class ImageProcessPool(object):
+    """A lazily started `ProcessPoolExecutor` shared by all threads of a worker process"""
+
+    def __init__(self, size: Optional[int] = None):
+        super(ImageProcessPool, self).__init__()
+        self._size = size
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = Lock()
+
+    @property
+    def size(self) -> Optional[int]:
+        return self._size
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self._size)
+            return self._executor
+
+    def submit_batch(self, fn: Callable, args_list: Sequence[tuple]) -> List[Future]:
+        """Submit `fn(*args)` for every `args` of `args_list`, return futures in the same order"""
+        executor = self.executor
+        return [executor.submit(fn, *args) for args in args_list]
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
@@ -0,0 +1,247 @@
+"""
+Managed execution of external tools
+
+Every invocation runs from an argument list (no shell), holds one of the machine-wide
+slots of its tool for its whole lifetime, is killed when it exceeds the tool's timeout,
+and streams its output line by line into the given logger.
+"""
+
+import tempfile
+import threading
+import time
+from logging import Logger
+from pathlib import Path
+import subprocess
+from typing import IO, Dict, List, NamedTuple, Optional, Union
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Per tool options, keyed like `EXT_TOOLS` of config
+#   MAX_INSTANCES: number of processes of the tool allowed at once on this machine
+#   TIMEOUT: seconds before a process of the tool is killed, `None` to wait forever
+DEFAULT_LIMITS = {'MAX_INSTANCES': 1, 'TIMEOUT': None}
+TOOL_LIMITS: Dict[str, dict] = {}
+
+LOCK_DIR = Path(tempfile.gettempdir()).joinpath('photogrammetry_service', 'locks')
+LOCK_POLL_INTERVAL = 0.5
+MONITOR_INTERVAL = 1
+
+
+class ToolTimeoutError(RuntimeError):
+    pass
+
+
+class RunResult(NamedTuple):
+    returncode: int
+    wall_time: float
+    # CPU seconds and peak resident memory (bytes) of the process tree, `None` when
+    # `psutil` is not installed
+    cpu_time: Optional[float]
+    peak_memory: Optional[int]
+
+
+def configure(tool_limits: Dict[str, dict], lock_dir: Union[str, Path] = None):
+    """Set limits of tools, from `EXT_TOOL_LIMITS` of config"""
+    global LOCK_DIR
+
+    TOOL_LIMITS.clear()
+    TOOL_LIMITS.update(tool_limits or {})
+    if lock_dir:
+        LOCK_DIR = Path(lock_dir)
+
+
+def tool_limits(tool: str) -> dict:
+    return {**DEFAULT_LIMITS, **TOOL_LIMITS.get(tool, {})}
+
+
+def _try_lock(f: IO) -> bool:
+    try:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        return True
+    except OSError:
+        return False
+
+
+def _unlock(f: IO):
+    if fcntl:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class ToolSlot(object):
+    """One of `MAX_INSTANCES` slots of a tool, shared by all worker processes of the machine.
+
+    Slots are lock files, so a slot is released by the OS if its holder dies.
+    """
+
+    def __init__(self, tool: str, max_instances: int, logger: Logger = None):
+        super(ToolSlot, self).__init__()
+        self._tool = tool
+        self._max_instances = max(1, max_instances)
+        self._logger = logger
+        self._file: Optional[IO] = None
+
+    def acquire(self):
+        LOCK_DIR.mkdir(parents=True, exist_ok=True)
+        waiting = False
+        while True:
+            for i in range(self._max_instances):
+                f = open(LOCK_DIR.joinpath(f'{self._tool}.{i}.lock'), 'a+')
+                if _try_lock(f):
+                    self._file = f
+                    return
+                f.close()
+            if not waiting and self._logger:
+                self._logger.info(f'Waiting for a free {self._tool} slot')
+                waiting = True
+            time.sleep(LOCK_POLL_INTERVAL)
+
+    def release(self):
+        if self._file:
+            _unlock(self._file)
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def _stream_output(stream: IO, tool: str, logger: Optional[Logger]):
+    for line in stream:
+        line = line.rstrip()
+        if line and logger:
+            logger.info(f'[{tool}] {line}')
+    stream.close()
+
+
+class _Usage(object):
+    """Sample CPU time and memory of a process and its children"""
+
+    def __init__(self, pid: int):
+        super(_Usage, self).__init__()
+        self.cpu_time = None
+        self.peak_memory = None
+        self._cpu_times = {}
+        self._process = None
+        if psutil:
+            try:
+                self._process = psutil.Process(pid)
+                self.cpu_time = 0.0
+                self.peak_memory = 0
+            except psutil.Error:
+                pass
+
+    def sample(self):
+        if not self._process:
+            return
+        try:
+            processes = [self._process] + self._process.children(recursive=True)
+        except psutil.Error:
+            return
+        memory = 0
+        for p in processes:
+            try:
+                cpu = p.cpu_times()
+                self._cpu_times[p.pid] = cpu.user + cpu.system
+                memory += p.memory_info().rss
+            except psutil.Error:
+                pass
+        self.cpu_time = sum(self._cpu_times.values())
+        self.peak_memory = max(self.peak_memory, memory)
+
+
+def run_tool(tool: str, args: List[Union[str, Path]], logger: Logger = None) -> RunResult:
+    """Run `args` as a process of `tool` within its limits
+
+    Raises:
+        ToolTimeoutError: process was killed after `TIMEOUT` seconds
+    """
+
+    limits = tool_limits(tool)
+    timeout = limits['TIMEOUT']
+    args = [str(a) for a in args]
+
+    with ToolSlot(tool, limits['MAX_INSTANCES'], logger):
+        if logger:
+            logger.info(f'Running {tool}: {subprocess.list2cmdline(args)}')
+        start = time.monotonic()
+        proc = subprocess.Popen(
+            args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL,
+            text=True,
+            errors='replace',
+        )
+        try:
+            reader = threading.Thread(
+                target=_stream_output, args=(proc.stdout, tool, logger), daemon=True
+            )
+            reader.start()
+            usage = _Usage(proc.pid)
+
+            timed_out = False
+            while proc.poll() is None:
+                usage.sample()
+                if timeout is not None and time.monotonic() - start > timeout:
+                    timed_out = True
+                    _kill(proc)
+                    break
+                try:
+                    proc.wait(MONITOR_INTERVAL)
+                except subprocess.TimeoutExpired:
+                    pass
+            proc.wait()
+        finally:
+            # Interrupted, e.g. by the job time limit or worker shutdown. The slot is only
+            # released once the process is gone
+            if proc.poll() is None:
+                _kill(proc)
+                proc.wait()
+        reader.join(MONITOR_INTERVAL)
+        wall_time = time.monotonic() - start
+
+    result = RunResult(proc.returncode, wall_time, usage.cpu_time, usage.peak_memory)
+    if logger:
+        logger.info(f'{tool} exited with {result.returncode}: {_format_usage(result)}')
+    if timed_out:
+        raise ToolTimeoutError(f'{tool} killed after {timeout}s')
+    return result
+
+
+def _kill(proc: subprocess.Popen):
+    """Kill a process together with its children"""
+    if psutil:
+        try:
+            for child in psutil.Process(proc.pid).children(recursive=True):
+                child.kill()
+        except psutil.Error:
+            pass
+    proc.kill()
+
+
+def _format_usage(result: RunResult) -> str:
+    usage = f'wall {result.wall_time:.1f}s'
+    if result.cpu_time is not None:
+        usage += f', cpu {result.cpu_time:.1f}s'
+    if result.peak_memory is not None:
+        usage += f', peak memory {result.peak_memory / 2 ** 20:.0f}MB'
+    return usage
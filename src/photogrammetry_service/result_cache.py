@@ -0,0 +1,163 @@
+"""
+Content-addressed cache of image step outputs
+
+An output is stored under a key hashed from the content of its input image and the
+parameters of the step which produced it, so that the same image of another task, or of
+a restarted task, is linked into place instead of processed again. Entries are hard
+links when the cache and task locations share a volume, copies otherwise. The least
+recently used entries, by mtime, are evicted when the cache exceeds `MAX_SIZE`.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+from collections import OrderedDict
+from pathlib import Path
+from threading import Lock
+from typing import Optional, Tuple, Union
+from uuid import uuid4
+
+ROOT: Optional[Path] = None
+MAX_SIZE = 0
+
+# Seconds between evictions by a process, each lists the whole cache
+EVICT_INTERVAL = 60
+HASH_CHUNK_SIZE = 2 ** 20
+# Digests of recently hashed files, by (path, size, mtime_ns)
+DIGEST_CACHE_SIZE = 4096
+
+_digests: 'OrderedDict[Tuple[str, int, int], str]' = OrderedDict()
+_lock = Lock()
+_last_evict = 0.0
+
+
+def configure(root: Union[str, Path, None], max_size: int):
+    """Set cache folder and size from `RESULT_CACHE` of config, `None` root disables it"""
+    global ROOT, MAX_SIZE
+
+    ROOT = Path(root) if root else None
+    MAX_SIZE = max_size
+
+
+def enabled() -> bool:
+    return ROOT is not None
+
+
+def file_digest(path: Path) -> str:
+    """SHA-256 of the content of `path`, remembered while the file is unchanged"""
+
+    st = os.stat(path)
+    file_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _lock:
+        if file_key in _digests:
+            _digests.move_to_end(file_key)
+            return _digests[file_key]
+
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+
+    with _lock:
+        _digests[file_key] = digest
+        while len(_digests) > DIGEST_CACHE_SIZE:
+            _digests.popitem(last=False)
+    return digest
+
+
+def key(input_file: Path, params: dict) -> str:
+    """Cache key of the output of `input_file` processed with `params`"""
+    payload = json.dumps({'input': file_digest(input_file), **params}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _entry(cache_key: str, suffix: str) -> Path:
+    return ROOT.joinpath(cache_key[:2], f'{cache_key}{suffix.lower()}')
+
+
+def _link_or_copy(src: Path, tg: Path):
+    """Put `src` at `tg` through a temporary file, so `tg` is never partially written"""
+
+    tmp = tg.parent.joinpath(f'.{tg.name}.{uuid4().hex}.tmp')
+    try:
+        try:
+            os.link(src, tmp)
+        except OSError:
+            # Other volume, or no hard link support
+            shutil.copyfile(src, tmp)
+        os.replace(tmp, tg)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def fetch(cache_key: str, tg: Path) -> bool:
+    """Put the cached output of `cache_key` at `tg`, return False on a miss"""
+
+    if not enabled():
+        return False
+    entry = _entry(cache_key, tg.suffix)
+    try:
+        tg.parent.mkdir(parents=True, exist_ok=True)
+        _link_or_copy(entry, tg)
+        # Mark the entry as recently used, and the output as newer than its input
+        os.utime(tg)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def store(cache_key: str, src: Path):
+    """Cache `src` as the output of `cache_key`"""
+
+    if not enabled():
+        return
+    entry = _entry(cache_key, src.suffix)
+    if entry.exists():
+        return
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    _link_or_copy(src, entry)
+    _evict_if_due()
+
+
+def _evict_if_due():
+    global _last_evict
+
+    with _lock:
+        if time.monotonic() - _last_evict < EVICT_INTERVAL:
+            return
+        _last_evict = time.monotonic()
+    evict()
+
+
+def evict():
+    """Remove least recently used entries until the cache fits in `MAX_SIZE`"""
+
+    if not enabled() or not ROOT.exists():
+        return
+    entries = []
+    total = 0
+    for directory in os.scandir(ROOT):
+        if not directory.is_dir():
+            continue
+        for entry in os.scandir(directory.path):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, entry.path))
+            total += st.st_size
+
+    for _, size, path in sorted(entries):
+        if total <= MAX_SIZE:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
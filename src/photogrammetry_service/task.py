@@ -1,16 +1,24 @@
 import distutils.dir_util
+import hashlib
+import os
 import re
 import shutil
 import time
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 from enum import Enum
 from logging import Logger
 from pathlib import Path
-from typing import Any, List, Optional, Pattern, Tuple, Union
+from threading import Lock
+from typing import Any, Dict, List, NamedTuple, Optional, Pattern, Set, Tuple, Union
+from uuid import uuid4
+
+import numpy as np
 
 from . import ext_tool_adaptor as ext_tool
 from . import img_util
-from .img_util import ColourCheckerSwatchesData
+from . import result_cache
+from .process_pool import ImageProcessPool
 
 LATEST_TASK_ID_KEY = 'latest_task_id'
 TASK_ID_KEY = 'task_id'
@@ -24,13 +32,38 @@ PAUSED_KEY = 'paused'
 IMG_PROGRESS_KEY = 'image_progress'
 IMG_PROGRESS_COMPLETED_KEY = 'completed'
 IMG_PROGRESS_TOTAL_KEY = 'total'
+PRIORITY_KEY = 'priority'
+DEADLINE_KEY = 'deadline'
+CC_MATRIX_KEY = 'color_correction_matrix'
+ERROR_KEY = 'error'
+JOB_SUCCEEDED_KEY = 'succeeded'
+JOB_IMAGES_KEY = 'images'
+JOB_ERROR_KEY = 'error'
+# Jobs sent to workers, documents of `jobs` collection keyed by message ID
+JOB_MESSAGE_ID_KEY = 'message_id'
+JOB_MESSAGE_KEY = 'message'
+# Per-image state, documents of `images` collection keyed by task ID, step and image name
+IMAGE_NAME_KEY = 'image'
+IMAGE_STATE_KEY = 'state'
+IMAGE_ATTEMPTS_KEY = 'attempts'
+IMAGE_WORKER_KEY = 'worker'
+IMAGE_STARTED_KEY = 'started_at'
+IMAGE_DURATION_KEY = 'duration'
+IMAGE_ERROR_KEY = 'error'
+# Leases of running jobs, documents of `leases` collection keyed by message ID
+LEASE_MESSAGE_ID_KEY = 'message_id'
+LEASE_WORKER_KEY = 'worker'
+LEASE_EXPIRES_KEY = 'expires_at'
+# Images given up after all retries, by `StepIndex` name
+FAILED_IMAGES_KEY = 'failed_images'
+# Set on restart from a step, outputs from this step on are deleted by the coordinator
+INVALIDATE_STEP_KEY = 'invalidate_step'
 
 BLACK_DNG = 'black.dng'
 CC_BLUR_TIFF = 'color_checker_blur.tiff'
+CC_MATRIX = 'color_correction_matrix.npy'
 CC_ARW = 'color_checker.ARW'
 CC_DNG = 'color_checker.dng'
-CC_PNG = 'color_checker.png'
-CC_BLUR_PNG = 'color_checker_blur.png'
 RC_SETTING = 'rc_setting'
 
 
@@ -43,6 +76,12 @@ class StepIndex(Enum):
     COMPLETED = 5
 
 
+class ImageState(Enum):
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
 class TaskResource(Enum):
     CACHE = 'cache'
     RAW = '1_RAW'
@@ -53,6 +92,12 @@ class TaskResource(Enum):
 
 
 IMAGE_PATTERN = r'\w*\d*'
+# `IMAGE_PATTERN` followed by an extension, stem and extension as groups
+IMAGE_FILE_RE: Pattern = re.compile(rf'({IMAGE_PATTERN})\.(\w+)')
+# Directory mtime on network shares can be as coarse as 2 seconds
+INVENTORY_MTIME_RESOLUTION = 2
+# Directory inventories kept by a process, the least recently used are dropped beyond it
+INVENTORY_CACHE_SIZE = 512
 STEP_METADATA = {
     StepIndex.NOT_STARTED.value: {
         'name': 'Not Started',
@@ -99,6 +144,133 @@ STEP_METADATA = {
 }
 
 
+class ImageFile(NamedTuple):
+    path: Path
+    size: int
+    mtime_ns: int
+
+    @classmethod
+    def stat(cls, path: Path) -> Optional['ImageFile']:
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return cls(path, st.st_size, st.st_mtime_ns)
+
+
+def is_valid_output(input_file: Optional[ImageFile], output_file: Optional[ImageFile]) -> bool:
+    """Whether `output_file` is a complete result of `input_file`
+
+    Empty outputs are truncated writes, outputs older than their input are stale
+    """
+    if not output_file:
+        return False
+    if output_file.size <= 0:
+        return False
+    return not input_file or output_file.mtime_ns >= input_file.mtime_ns
+
+
+class DirectoryInventory(object):
+    """Image files of a directory, grouped by extension.
+
+    The directory is listed again only when its mtime changed, inventories are shared
+    by all `Step`s of a process through `DirectoryInventory.of()`, up to
+    `INVENTORY_CACHE_SIZE` of them.
+    """
+
+    _inventories: 'OrderedDict[str, DirectoryInventory]' = OrderedDict()
+    _inventories_lock = Lock()
+
+    def __init__(self, directory: Path):
+        super(DirectoryInventory, self).__init__()
+        self._directory = directory
+        self._mtime_ns: Optional[int] = None
+        self._listed_at = 0.0
+        self._images: Dict[str, Dict[str, ImageFile]] = {}
+        self._lock = Lock()
+
+    @classmethod
+    def of(cls, directory: Path) -> 'DirectoryInventory':
+        key = os.path.normcase(os.path.abspath(directory))
+        with cls._inventories_lock:
+            if key in cls._inventories:
+                cls._inventories.move_to_end(key)
+                return cls._inventories[key]
+            inventory = cls._inventories[key] = cls(Path(key))
+            while len(cls._inventories) > INVENTORY_CACHE_SIZE:
+                cls._inventories.popitem(last=False)
+            return inventory
+
+    @classmethod
+    def invalidate(cls, directory: Path):
+        """Force listing `directory` again on next access"""
+        key = os.path.normcase(os.path.abspath(directory))
+        with cls._inventories_lock:
+            cls._inventories.pop(key, None)
+
+    @property
+    def directory(self) -> Path:
+        return self._directory
+
+    def _refresh(self):
+        try:
+            mtime_ns = os.stat(self._directory).st_mtime_ns
+        except OSError:
+            self._mtime_ns = None
+            self._images = {}
+            return
+
+        # Entries created within mtime resolution of the last listing may not bump mtime
+        settled = self._listed_at - mtime_ns / 1e9 > INVENTORY_MTIME_RESOLUTION
+        if mtime_ns == self._mtime_ns and settled:
+            return
+
+        listed_at = time.time()
+        images = {}
+        with os.scandir(self._directory) as entries:
+            for entry in entries:
+                match = IMAGE_FILE_RE.fullmatch(entry.name)
+                if match and entry.is_file():
+                    stem, ext = match.groups()
+                    st = entry.stat()
+                    images.setdefault(ext, {})[stem] = ImageFile(
+                        Path(entry.path), st.st_size, st.st_mtime_ns
+                    )
+        self._images = images
+        self._mtime_ns = mtime_ns
+        self._listed_at = listed_at
+
+    def images(self, ext: str) -> Dict[str, Path]:
+        """Image name -> path of images with extension `ext`"""
+        return {name: f.path for name, f in self.files(ext).items()}
+
+    def files(self, ext: str) -> Dict[str, ImageFile]:
+        """Image name -> `ImageFile` of images with extension `ext`"""
+        with self._lock:
+            self._refresh()
+            return dict(self._images.get(ext, {}))
+
+    def names(self, ext: str) -> Set[str]:
+        with self._lock:
+            self._refresh()
+            return set(self._images.get(ext, {}))
+
+    def count(self, ext: str) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._images.get(ext, {}))
+
+
+class ImageProcessingError(Exception):
+    """Some images of a batch failed, raised after the whole batch was processed"""
+
+    def __init__(self, errors: Dict[str, Exception]):
+        super(ImageProcessingError, self).__init__(
+            '; '.join(f'{image_name}: {str(e)}' for image_name, e in errors.items())
+        )
+        self.errors = errors
+
+
 class Step(ABC):
     """Base class for `Step` in a `Task`."""
 
@@ -118,6 +290,10 @@ class Step(ABC):
     def step_id(self) -> int:
         return self._step_id
 
+    @property
+    def name(self) -> str:
+        return STEP_METADATA[self._step_id]['name']
+
     @property
     def task(self) -> 'Task':
         return self._task
@@ -152,53 +328,95 @@ class Step(ABC):
             p = None
         return p
 
+    @property
+    def input_image_ext(self) -> Optional[str]:
+        return STEP_METADATA[self.step_id]['input_image_ext']
+
+    @property
+    def output_image_ext(self) -> Optional[str]:
+        return STEP_METADATA[self.step_id]['output_image_ext']
+
     @property
     def input_images_count(self) -> int:
-        return len(self.ls_input_images())
+        if not (self.input_dir and self.input_image_ext):
+            return 0
+        return DirectoryInventory.of(self.input_dir).count(self.input_image_ext)
 
     @property
     def output_images_count(self) -> int:
-        return len(self.ls_output_images())
+        if not (self.output_dir and self.output_image_ext):
+            return 0
+        return DirectoryInventory.of(self.output_dir).count(self.output_image_ext)
 
     def ls_input_images(self, image_name_only=True) -> List[Union[Path, str]]:
         """List of images in input data folder, if any"""
 
-        images = []
-        if not self.input_dir:
-            return images
-        if not self.input_dir.exists():
-            return images
-
-        pattern = self.full_image_file_name(
-            IMAGE_PATTERN, STEP_METADATA[self.step_id]['input_image_ext']
-        )
-        if pattern:
-            images = [
-                p.stem if image_name_only else p
-                for p in self.input_dir.iterdir()
-                if re.match(pattern, p.name)
-            ]
-        return images
+        if not (self.input_dir and self.input_image_ext):
+            return []
+        images = DirectoryInventory.of(self.input_dir).images(self.input_image_ext)
+        return list(images) if image_name_only else list(images.values())
 
     def ls_output_images(self, image_name_only=True) -> List[Union[Path, str]]:
         """List of images in output data folder, if any"""
 
-        images = []
-        if not self.output_dir:
-            return images
-        if not self.output_dir.exists():
-            return images
-
-        pattern = self.full_image_file_name(
-            IMAGE_PATTERN, STEP_METADATA[self.step_id]['output_image_ext']
+        if not (self.output_dir and self.output_image_ext):
+            return []
+        images = DirectoryInventory.of(self.output_dir).images(self.output_image_ext)
+        return list(images) if image_name_only else list(images.values())
+
+    def pending_images(self) -> List[str]:
+        """Names of input images that have no valid output image yet"""
+
+        if not (self.input_dir and self.input_image_ext):
+            return []
+        inputs = DirectoryInventory.of(self.input_dir).files(self.input_image_ext)
+        if not (self.output_dir and self.output_image_ext):
+            return sorted(inputs)
+        outputs = DirectoryInventory.of(self.output_dir).files(self.output_image_ext)
+        return sorted(
+            name for name, f in inputs.items() if not is_valid_output(f, outputs.get(name))
         )
-        if pattern:
-            images = [
-                p.stem if image_name_only else p
-                for p in self.output_dir.iterdir()
-                if re.match(pattern, p.name)
-            ]
-        return images
+
+    def is_image_done(self, image_name: str) -> bool:
+        """Whether `image_name` already has a valid output, checked on disk"""
+
+        in_img_path, out_img_path = self.image_paths(image_name)
+        return is_valid_output(ImageFile.stat(in_img_path), ImageFile.stat(out_img_path))
+
+    def cache_params(self, *args) -> Optional[dict]:
+        """Parameters which, with content of an input image, determine its output image
+
+        `None` if outputs of this `Step` are not kept in the result cache
+        """
+        return None
+
+    def _cache_key(self, input_image: Path, *args) -> Optional[str]:
+        params = self.cache_params(*args)
+        if params is None or not result_cache.enabled():
+            return None
+        return result_cache.key(input_image, {'step': self.name, **params})
+
+    def restore_cached(self, input_image: Path, output_image: Path, *args) -> bool:
+        """Put the output of an identical input image from the result cache, if any"""
+
+        try:
+            cache_key = self._cache_key(input_image, *args)
+            if cache_key and result_cache.fetch(cache_key, output_image):
+                self.logger.info(f'Restored from result cache: {output_image}')
+                return True
+        except OSError as e:
+            self.logger.warning(f'Result cache error: {input_image.name} :: {str(e)}')
+        return False
+
+    def store_cached(self, input_image: Path, output_image: Path, *args):
+        """Keep a new output image in the result cache"""
+
+        try:
+            cache_key = self._cache_key(input_image, *args)
+            if cache_key and output_image.exists():
+                result_cache.store(cache_key, output_image)
+        except OSError as e:
+            self.logger.warning(f'Result cache error: {output_image.name} :: {str(e)}')
 
     def full_image_file_name(self, *args) -> str:
         """Full image file names from parts"""
@@ -212,7 +430,8 @@ class Step(ABC):
 
     @abstractmethod
     def _process_image(self, input_image: Path, output_image: Path, *args) -> bool:
-        """Process a single atomic element (e.g. individual images) of this `Step`
+        """Process a single atomic element (e.g. individual images) of this `Step`,
+        raise on failure
 
         Apply for `Step`s that output multiple images
         """
@@ -228,13 +447,46 @@ class Step(ABC):
         if not (self.input_dir and self.output_dir):
             return
 
+        in_img_path, out_img_path = self.image_paths(image_name)
+        if self.is_image_done(image_name):
+            # Duplicated or re-delivered job
+            self.logger.info(f'Skipped, already processed: {out_img_path}')
+            return 1
+        if self.restore_cached(in_img_path, out_img_path, *args):
+            return 1
+        succeed = self._process_image(in_img_path, out_img_path, *args)
+        if succeed:
+            self.store_cached(in_img_path, out_img_path, *args)
+        return succeed
+
+    def image_paths(self, image_name: str) -> Tuple[Path, Path]:
+        """Input and output image path from `image_name`"""
+
         in_img_path = self.input_dir.joinpath(
-            self.full_image_file_name(image_name, STEP_METADATA[self.step_id]['input_image_ext'])
+            self.full_image_file_name(image_name, self.input_image_ext)
         )
         out_img_path = self.output_dir.joinpath(
-            self.full_image_file_name(image_name, STEP_METADATA[self.step_id]['output_image_ext'])
+            self.full_image_file_name(image_name, self.output_image_ext)
         )
-        return self._process_image(in_img_path, out_img_path, *args)
+        return in_img_path, out_img_path
+
+    def process_images(self, image_names: List[str], *args) -> bool:
+        """Run `self.process_image()` over a batch of images
+
+        Raises:
+            ImageProcessingError: some images failed, the others were still processed
+        """
+
+        errors = {}
+        for image_name in image_names:
+            try:
+                self.process_image(image_name, *args)
+            except Exception as e:
+                self.logger.error(f'{self.name} error: {image_name} :: {str(e)}')
+                errors[image_name] = e
+        if errors:
+            raise ImageProcessingError(errors)
+        return 1
 
     @abstractmethod
     def _process(self) -> bool:
@@ -249,6 +501,16 @@ class Step(ABC):
 
         return self._process()
 
+    def clear_outputs(self):
+        """Delete output folder of this `Step`, so that it is processed again"""
+
+        output_dir = self.output_dir
+        if not output_dir or not output_dir.exists():
+            return
+        shutil.rmtree(output_dir)
+        DirectoryInventory.invalidate(output_dir)
+        self.logger.info(f'Deleted outputs of step {self.name}: {output_dir}')
+
 
 ##########################################################################################
 ###############################################################################
@@ -260,71 +522,65 @@ class NotStartedStep(Step):
 
     @property
     def is_finished(self) -> bool:
-        cc_blur = self.task.cache_dir.joinpath(CC_BLUR_TIFF)
+        cc_matrix = self.task.cache_dir.joinpath(CC_MATRIX)
         rc_setting = self.task.cache_dir.joinpath(RC_SETTING)
-        return cc_blur.exists() and rc_setting.exists()
+        return cc_matrix.exists() and rc_setting.exists()
 
     def _process_image(self, input_image: Path, output_image: Path) -> bool:
         return
 
-    def _process(self) -> bool:
-        """Create initial cache files"""
-        succeed = 1
-        done = 0
-        try:
-            while not done:
-                time.sleep(2)
-
-                # Copy Reality Capture setting
-                src_rc = Path(self.task.template_files['RC_SETTING'])
-                tg_rc = self.task.cache_dir.joinpath(RC_SETTING)
-                if src_rc.exists() and not tg_rc.exists():
-                    distutils.dir_util.copy_tree(src_rc.as_posix(), tg_rc.as_posix())
-
-                # Copy black image from template to cache folder
-                src_black = Path(self.task.template_files['BLACK'])
-                tg_black = self.task.cache_dir.joinpath(BLACK_DNG)
-                if src_black.exists() and not tg_black.exists():
-                    tg_black.parent.mkdir(parents=True, exist_ok=True)
-                    shutil.copyfile(src_black, tg_black)
-                    self.logger.info(f'Cloned black image: {tg_black}')
-
-                # Convert user's color checker raw image to dng
-                raw_cc = self.task.cache_dir.joinpath(CC_ARW)
-                if raw_cc.exists():
-                    ext_tool.run_dng_conversion(
-                        raw_cc, self.task.cache_dir, Path(self.task.ext_tools['DNG_CONVERTER'])
-                    )
-                    self.logger.info(f'Converted {raw_cc.name} to DNG')
-                else:
-                    self.logger.debug(
-                        f'{raw_cc.name} not found, please put it in {self.task.cache_dir}'
-                    )
-                    continue
-
-                # Blur color checker and save as tiff
-                dng_cc = self.task.cache_dir.joinpath(CC_DNG)
-                png_cc = self.task.cache_dir.joinpath(CC_PNG)
-                png_cc_blur = self.task.cache_dir.joinpath(CC_BLUR_PNG)
-                tif_cc_blur = self.task.cache_dir.joinpath(CC_BLUR_TIFF)
-                if dng_cc.exists():
-                    img_util.dng_to_png(dng_cc, png_cc)
-                    self.logger.info(f'Converted {dng_cc.name} to PNG')
+    def clear_outputs(self):
+        """Delete files derived from the color checker, user's raw images are kept"""
 
-                    img_util.blur(png_cc, png_cc_blur)
-                    self.logger.info(f'Generated blur {png_cc_blur.name} from {png_cc.name}')
+        for name in (CC_MATRIX, CC_DNG, CC_BLUR_TIFF):
+            self.task.cache_dir.joinpath(name).unlink(missing_ok=True)
+        self.logger.info(f'Deleted color correction matrix of task "{self.task.task_id}"')
 
-                    img_util.png_to_tif(png_cc_blur, tif_cc_blur)
-                    self.logger.info(f'Converted {png_cc_blur.name} to TIFF')
+    def _process(self) -> bool:
+        """Create initial cache files
 
-                    done = 1
-                    self.logger.info(f'Finished blurring process: {tif_cc_blur}')
+        Return at once, failed, when user's color checker is missing. The coordinator only
+        dispatches this step after `color_checker.ARW` appears in cache folder
+        """
+        succeed = 1
+        try:
+            # Copy Reality Capture setting
+            src_rc = Path(self.task.template_files['RC_SETTING'])
+            tg_rc = self.task.cache_dir.joinpath(RC_SETTING)
+            if src_rc.exists() and not tg_rc.exists():
+                distutils.dir_util.copy_tree(src_rc.as_posix(), tg_rc.as_posix())
+
+            # Copy black image from template to cache folder
+            src_black = Path(self.task.template_files['BLACK'])
+            tg_black = self.task.cache_dir.joinpath(BLACK_DNG)
+            if src_black.exists() and not tg_black.exists():
+                tg_black.parent.mkdir(parents=True, exist_ok=True)
+                shutil.copyfile(src_black, tg_black)
+                self.logger.info(f'Cloned black image: {tg_black}')
+
+            # Convert user's color checker raw image to dng
+            raw_cc = self.task.cache_dir.joinpath(CC_ARW)
+            if not raw_cc.exists():
+                raise FileNotFoundError(
+                    f'{raw_cc.name} not found, please put it in {self.task.cache_dir}'
+                )
+            if not self.task.raw_direct_decode:
+                ext_tool.run_dng_conversion(
+                    raw_cc,
+                    self.task.cache_dir,
+                    Path(self.task.ext_tools['DNG_CONVERTER']),
+                    self.logger,
+                )
+                self.logger.info(f'Converted {raw_cc.name} to DNG')
+
+            # Fit color correction matrix from the color checker, prepared in memory
+            cc_file = self.task.color_checker_file
+            if not cc_file.exists():
+                raise FileNotFoundError(f'{cc_file.name} not found, failed to fit color matrix')
+            self.task.color_correction_matrix(refit=True)
 
-                    self.output_dir.mkdir(parents=True, exist_ok=True)
-                    self.logger.info(f'Initialized task "{self.task.task_id}" successfully')
-                else:
-                    self.logger.warning(f'{dng_cc.name} not found, failed to do blurring')
-                    continue
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            self.logger.info(f'Initialized task "{self.task.task_id}" successfully')
 
         except Exception as e:
             self.logger.error(f'Init task error :: {str(e)}')
@@ -336,23 +592,77 @@ class DngConversionStep(Step):
     def __init__(self, *args):
         super(DngConversionStep, self).__init__(*args)
 
+    @property
+    def skipped(self) -> bool:
+        """No DNG is needed when color correction decodes raw images directly"""
+        return self.task.raw_direct_decode
+
     @property
     def is_finished(self) -> bool:
-        a = len(self.ls_output_images()) >= len(self.ls_input_images())
-        b = len(self.ls_output_images()) > 0
-        return a and b
+        if self.skipped:
+            return self.input_images_count > 0
+        return self.output_images_count > 0 and not self.pending_images()
+
+    def cache_params(self) -> Optional[dict]:
+        converter = Path(self.task.ext_tools['DNG_CONVERTER'])
+        if not converter.exists():
+            return None
+        return {
+            'converter': ext_tool.tool_version(converter),
+            'options': ext_tool.DNG_CONVERSION_OPTIONS,
+        }
 
     def _process_image(self, input_image: Path, output_image: Path) -> bool:
-        succeed = 1
+        return self._convert([(input_image, output_image)])
+
+    def process_images(self, image_names: List[str]) -> bool:
+        """Convert a batch of images with a single DNG converter invocation"""
+
+        paths = [
+            self.image_paths(image_name)
+            for image_name in image_names
+            if not self.is_image_done(image_name)
+        ]
+        paths = [
+            (input_image, output_image)
+            for input_image, output_image in paths
+            if not self.restore_cached(input_image, output_image)
+        ]
+        if not paths:
+            return 1
+        return self._convert(paths)
+
+    def _convert(self, paths: List[Tuple[Path, Path]]) -> bool:
+        errors = {}
+        # Convert into a private folder then move into place, so that a partially written
+        # DNG is never seen in output folder
+        tmp_dir = self.output_dir.joinpath(f'.{paths[0][1].stem}.{uuid4().hex}.tmp')
         try:
             ext_tool.run_dng_conversion(
-                input_image, self.output_dir, Path(self.task.ext_tools['DNG_CONVERTER'])
+                [input_image for input_image, _ in paths],
+                tmp_dir,
+                Path(self.task.ext_tools['DNG_CONVERTER']),
+                self.logger,
             )
-            self.logger.info(f'Converted to DNG: {output_image}')
+            for input_image, output_image in paths:
+                tmp_output = tmp_dir.joinpath(output_image.name)
+                if tmp_output.exists():
+                    os.replace(tmp_output, output_image)
+                    self.logger.info(f'Converted to DNG: {output_image}')
+                    self.store_cached(input_image, output_image)
+                else:
+                    error = FileNotFoundError(f'{output_image.name} was not created')
+                    self.logger.error(f'DNG conversion error: {input_image} :: {str(error)}')
+                    errors[output_image.stem] = error
         except Exception as e:
-            self.logger.error(f'DNG conversion error: {input_image} :: {str(e)}')
-            succeed = 0
-        return succeed
+            input_images = [input_image.name for input_image, _ in paths]
+            self.logger.error(f'DNG conversion error: {input_images} :: {str(e)}')
+            errors = {output_image.stem: e for _, output_image in paths}
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if errors:
+            raise ImageProcessingError(errors)
+        return 1
 
     def _process(self) -> bool:
         return
@@ -362,38 +672,71 @@ class ColorCorrectionStep(Step):
     def __init__(self, *args):
         super(ColorCorrectionStep, self).__init__(*args)
 
+    @property
+    def input_dir(self) -> Optional[Path]:
+        if self.task.raw_direct_decode:
+            return self.task_location.joinpath(TaskResource.RAW.value)
+        return super(ColorCorrectionStep, self).input_dir
+
+    @property
+    def input_image_ext(self) -> Optional[str]:
+        if self.task.raw_direct_decode:
+            return STEP_METADATA[StepIndex.DNG_CONVERSION.value]['input_image_ext']
+        return super(ColorCorrectionStep, self).input_image_ext
+
     @property
     def is_finished(self) -> bool:
-        a = len(self.ls_output_images()) >= len(self.ls_input_images())
-        b = len(self.ls_output_images()) > 0
-        return a and b
+        return self.output_images_count > 0 and not self.pending_images()
 
-    def _process_image(
-        self, input_image: Path, output_image: Path, swatch: ColourCheckerSwatchesData
-    ) -> bool:
-        succeed = 1
-        try:
-            self.output_dir.mkdir(parents=True, exist_ok=True)
-            img_util.color_correct(input_image, output_image, swatch, self.task.cache_dir)
-            self.logger.info(f'Color corrected: {output_image}')
-        except Exception as e:
-            self.logger.error(f'Color correction error: {input_image} :: {str(e)}')
-            succeed = 0
-        return succeed
+    def cache_params(self, ccm: np.ndarray) -> Optional[dict]:
+        return {
+            'ccm': hashlib.sha256(np.asarray(ccm, dtype=np.float32).tobytes()).hexdigest(),
+            'jpeg_quality': img_util.JPEG_QUALITY,
+        }
+
+    def _process_image(self, input_image: Path, output_image: Path, ccm: np.ndarray) -> bool:
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        img_util.color_correct(input_image, output_image, np.asarray(ccm, dtype=np.float32))
+        self.logger.info(f'Color corrected: {output_image}')
+        return 1
+
+    def process_images(self, image_names: List[str], ccm: np.ndarray) -> bool:
+        """Color correct a batch of images, in the task's process pool if it has one"""
+
+        if not self.task.process_pool:
+            return super(ColorCorrectionStep, self).process_images(image_names, ccm)
+
+        errors = {}
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        ccm = np.asarray(ccm, dtype=np.float32)
+        paths = [
+            self.image_paths(image_name)
+            for image_name in image_names
+            if not self.is_image_done(image_name)
+        ]
+        paths = [
+            (input_image, output_image)
+            for input_image, output_image in paths
+            if not self.restore_cached(input_image, output_image, ccm)
+        ]
+        futures = self.task.process_pool.submit_batch(
+            img_util.color_correct, [(in_img, out_img, ccm) for in_img, out_img in paths]
+        )
+        for (input_image, output_image), future in zip(paths, futures):
+            try:
+                future.result()
+                self.logger.info(f'Color corrected: {output_image}')
+                self.store_cached(input_image, output_image, ccm)
+            except Exception as e:
+                self.logger.error(f'Color correction error: {input_image} :: {str(e)}')
+                errors[output_image.stem] = e
+        if errors:
+            raise ImageProcessingError(errors)
+        return 1
 
     def _process(self) -> bool:
-        succeed = 1
-        try:
-            swatch = img_util.compute_swatch(self.task.cache_dir.joinpath(CC_BLUR_TIFF))
-            for image_name in sorted(self.ls_input_images()):
-                try:
-                    self.process_image(image_name, swatch)
-                except Exception as e:
-                    self.logger.error(f'Color correction error: {image_name} :: {str(e)}')
-        except Exception as e:
-            self.logger.error(f'Color correction error :: {str(e)}')
-            succeed = 0
-        return succeed
+        ccm = self.task.color_correction_matrix()
+        return self.process_images(self.pending_images(), ccm)
 
 
 class PrepareRcStep(Step):
@@ -412,18 +755,20 @@ class PrepareRcStep(Step):
         return
 
     def _process(self) -> bool:
-        succeed = 1
         try:
             ext_tool.run_prepare_rc(
                 self.input_dir,
                 self.output_dir,
                 ext_tool_exe=self.task.ext_tools['REALITY_CAPTURE'],
+                logger=self.logger,
             )
+            if not self.is_finished:
+                raise FileNotFoundError(f'{self.marker_file.name} was not created')
             self.logger.info(f'Ran RC preparation: {self.output_dir}')
         except Exception as e:
             self.logger.error(f'RC preparation error :: {str(e)}')
-            succeed = 0
-        return succeed
+            raise
+        return 1
 
 
 class MeshConstructionStep(Step):
@@ -442,19 +787,21 @@ class MeshConstructionStep(Step):
         return
 
     def _process(self) -> bool:
-        succeed = 1
         try:
             ext_tool.run_mesh_construction(
                 self.input_dir,
                 self.output_dir,
                 self.task.ext_tools['REALITY_CAPTURE'],
                 self.task.cache_dir.joinpath(RC_SETTING),
+                self.logger,
             )
+            if not self.is_finished:
+                raise FileNotFoundError(f'{self.marker_file.name} was not created')
             self.logger.info(f'Ran mesh construction: {self.output_dir}')
         except Exception as e:
             self.logger.error(f'Mesh construction error :: {str(e)}')
-            succeed = 0
-        return succeed
+            raise
+        return 1
 
 
 class CompletedStep(Step):
@@ -488,12 +835,22 @@ STEP_CLASS_MAP = {
 class Task(object):
     """A photogrammetry task."""
 
-    def __init__(self, task_data: dict, logger: Logger, ext_tools: dict, template_files: dict):
+    def __init__(
+        self,
+        task_data: dict,
+        logger: Logger,
+        ext_tools: dict,
+        template_files: dict,
+        process_pool: ImageProcessPool = None,
+        pipeline: dict = None,
+    ):
         super(Task, self).__init__()
         self._task_data = task_data
         self._logger = logger
         self._ext_tools = ext_tools
         self._template_files = template_files
+        self._process_pool = process_pool
+        self._pipeline = pipeline or {}
 
     @property
     def logger(self) -> Logger:
@@ -507,6 +864,26 @@ class Task(object):
     def template_files(self) -> dict:
         return self._template_files
 
+    @property
+    def process_pool(self) -> Optional[ImageProcessPool]:
+        """Pool for CPU-bound image processing, `None` to process in the calling thread"""
+        return self._process_pool
+
+    @property
+    def pipeline(self) -> dict:
+        """`PIPELINE` options from config"""
+        return self._pipeline
+
+    @property
+    def raw_direct_decode(self) -> bool:
+        """Color correct raw images of `1_RAW` directly, without DNG conversion"""
+        return bool(self._pipeline.get('RAW_DIRECT_DECODE'))
+
+    @property
+    def streaming(self) -> bool:
+        """Color correct images while DNG conversion of other images is still running"""
+        return bool(self._pipeline.get('STREAMING')) and not self.raw_direct_decode
+
     @property
     def task_data(self) -> dict:
         """
@@ -515,6 +892,7 @@ class Task(object):
             "task_location": str, # E.g. "/path/to/some/folder"
             "step": int,
             "step_in_progress": bool,
+            "color_correction_matrix": list, # Set when color correction is fanned out
         }
         """
         return self._task_data
@@ -534,9 +912,46 @@ class Task(object):
     @property
     def cur_step(self) -> Step:
         """The current step."""
-        step_id = self._task_data[TASK_STEP_KEY]
+        return self.get_step(self._task_data[TASK_STEP_KEY])
+
+    def get_step(self, step_id: int) -> Step:
         return STEP_CLASS_MAP[step_id](step_id, self)
 
     @property
     def paused(self) -> bool:
         return self._task_data[PAUSED_KEY]
+
+    @property
+    def matrix_file(self) -> Path:
+        return self.cache_dir.joinpath(CC_MATRIX)
+
+    @property
+    def color_checker_file(self) -> Path:
+        """Color checker image the color correction matrix is fitted from
+
+        Its DNG, or the raw image itself when raw images are decoded directly
+        """
+        if self.raw_direct_decode:
+            return self.cache_dir.joinpath(CC_ARW)
+        return self.cache_dir.joinpath(CC_DNG)
+
+    def color_correction_matrix(self, refit: bool = False) -> np.ndarray:
+        """Color correction matrix of this task
+
+        Fitted once from the blurred color checker, then reused from `CC_MATRIX` in cache
+        """
+        if self.matrix_file.exists() and not refit:
+            return img_util.load_color_correction_matrix(self.matrix_file)
+
+        color_checker = img_util.prepare_color_checker(self.color_checker_file)
+        self.logger.info(f'Prepared color checker from {self.color_checker_file.name}')
+        if self._pipeline.get('COLOR_CHECKER_DEBUG_TIFF'):
+            cc_tiff = self.cache_dir.joinpath(CC_BLUR_TIFF)
+            img_util.write_color_checker(color_checker, cc_tiff)
+            self.logger.info(f'Saved prepared color checker: {cc_tiff}')
+
+        swatch = img_util.compute_swatch(color_checker)
+        ccm = img_util.compute_color_correction_matrix(swatch)
+        img_util.save_color_correction_matrix(ccm, self.matrix_file)
+        self.logger.info(f'Saved color correction matrix: {self.matrix_file}')
+        return ccm
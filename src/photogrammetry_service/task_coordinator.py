@@ -1,35 +1,72 @@
+import copy
 import logging
 import pprint
 import time
+from collections import Counter
 from enum import Enum
 from logging.config import dictConfig
+from queue import Empty, Queue
+from threading import Thread, Timer
 from types import ModuleType
-from typing import Any, Tuple
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
 
 from pathlib import Path
-from photogrammetry_service import img_util
+from dramatiq import Actor, Message
+from dramatiq.results import ResultMissing
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
 
 from . import worker
 from .db import DB
+from .fs_watcher import TaskWatcher
 from .task import (
     CC_ARW,
-    CC_BLUR_TIFF,
+    CC_MATRIX_KEY,
+    DEADLINE_KEY,
+    ERROR_KEY,
+    FAILED_IMAGES_KEY,
+    IMAGE_ERROR_KEY,
+    IMAGE_NAME_KEY,
+    INVALIDATE_STEP_KEY,
+    JOB_ERROR_KEY,
+    JOB_IMAGES_KEY,
+    JOB_MESSAGE_ID_KEY,
+    JOB_MESSAGE_KEY,
+    JOB_SUCCEEDED_KEY,
+    LEASE_MESSAGE_ID_KEY,
+    LEASE_WORKER_KEY,
     STEP_IN_PROGRESS_KEY,
     REQUIRE_KEY,
     REQ_COLOR_CHECKER_KEY,
     REQ_RAW_IMAGE_KEY,
     STEP_METADATA,
     TASK_ID_KEY,
+    TASK_LOCATION_KEY,
     TASK_STEP_KEY,
     PAUSED_KEY,
+    PRIORITY_KEY,
     IMG_PROGRESS_KEY,
     IMG_PROGRESS_COMPLETED_KEY,
     IMG_PROGRESS_TOTAL_KEY,
+    DirectoryInventory,
+    ImageState,
+    Step,
     StepIndex,
     Task,
 )
 
 
+# Task fields guarded by compare-and-set, changed concurrently by API (pause, restart)
+STEP_STATE_KEYS = (TASK_STEP_KEY, STEP_IN_PROGRESS_KEY, PAUSED_KEY)
+
+# Step of the images processed by each image actor
+ACTOR_IMAGE_STEPS = {
+    'dng_conversion_job': StepIndex.DNG_CONVERSION.value,
+    'color_correction_job': StepIndex.COLOR_CORRECTION.value,
+    'color_correction_single_job': StepIndex.COLOR_CORRECTION.value,
+}
+
+
 class Status(Enum):
     SUCCESS = 'success'
     ERROR = 'error'
@@ -50,15 +87,33 @@ class DatabaseAdapter(object):
     def get_latest_task_id(self) -> int:
         return self._db.get_latest_task_id()
 
-    def add_task(self, task_data: dict) -> Tuple[Status, None, str]:
-        message = f'Added task: {task_data[TASK_ID_KEY]}'
+    def add_task(self, task_data: dict) -> Tuple[Status, dict, str]:
+        """Add a task, its ID is allocated by database"""
+
         status = Status.SUCCESS.value
+        data = {}
         try:
-            self._db.add_task(task_data)
+            task_id = self._db.add_task(task_data)
+            data = {TASK_ID_KEY: task_id}
+            message = f'Added task: {task_id}'
         except Exception as e:
             message = str(e)
             status = Status.ERROR.value
-        return status, None, message
+        return status, data, message
+
+    def add_tasks(self, tasks: List[dict]) -> Tuple[Status, dict, str]:
+        """Add a batch of tasks under consecutive IDs"""
+
+        status = Status.SUCCESS.value
+        data = {}
+        try:
+            task_ids = self._db.add_tasks(tasks)
+            data = {'task_ids': task_ids}
+            message = f'Added tasks: {task_ids}'
+        except Exception as e:
+            message = str(e)
+            status = Status.ERROR.value
+        return status, data, message
 
     def get_task(self, task_id: int) -> Tuple[Status, dict, str]:
         message = 'Returned task data'
@@ -91,6 +146,23 @@ class DatabaseAdapter(object):
             status = Status.ERROR.value
         return status, None, message
 
+    def ls_images(
+        self, task_id: int, step_id: int = None, state: str = None
+    ) -> Tuple[Status, list, str]:
+        """Per-image state of a task: attempts, worker, duration and error"""
+
+        message = 'Returned image list'
+        status = Status.SUCCESS.value
+        images = []
+        try:
+            images = self._db.find_images(
+                task_id, step_id, state=ImageState(state) if state else None
+            )
+        except Exception as e:
+            message = str(e)
+            status = Status.ERROR.value
+        return status, images, message
+
     def ls_tasks(self) -> Tuple[Status, list, str]:
         """List tasks from database"""
 
@@ -104,29 +176,197 @@ class DatabaseAdapter(object):
             status = Status.ERROR.value
         return status, tasks, message
 
-    def restart_task(self, task_id: int, all_tasks: bool = False) -> Tuple[Status, None, str]:
-        """Update DB to trigger tasks re-processing"""
+    def query_tasks(
+        self,
+        filters: dict = None,
+        fields: List[str] = None,
+        sort_key: str = TASK_ID_KEY,
+        descending: bool = False,
+        limit: int = 0,
+        cursor: str = None,
+    ) -> Tuple[Status, dict, str]:
+        """Query a page of tasks from database, see `DB.find_tasks()`
+
+        Data format: `{"tasks": list, "next_cursor": str}`
+        """
+
+        message = 'Returned task list'
+        status = Status.SUCCESS.value
+        data = {'tasks': [], 'next_cursor': None}
+        try:
+            tasks, next_cursor = self._db.find_tasks(
+                filters, fields, sort_key, descending, limit, cursor
+            )
+            data = {'tasks': tasks, 'next_cursor': next_cursor}
+        except Exception as e:
+            message = str(e)
+            status = Status.ERROR.value
+        return status, data, message
+
+    def restart_task(
+        self, task_id: int, all_tasks: bool = False, step_id: int = None
+    ) -> Tuple[Status, None, str]:
+        """Update DB to trigger tasks re-processing
+
+        Args:
+            step_id: rerun from this step instead of from scratch, outputs of this step
+                and later ones are deleted. Tasks running a step must be paused first and
+                their running jobs finished, with `all_tasks` only idle tasks which reached
+                this step are restarted
+        """
 
         message = 'Requested to process task'
         status = Status.SUCCESS.value
 
         try:
+            if step_id is not None and step_id not in range(StepIndex.COMPLETED.value):
+                raise ValueError(f'Invalid step: {step_id}')
+            restarted = self._db.restart_tasks(None if all_tasks else [task_id], step_id)
             if all_tasks:
-                tasks = self._db.ls_tasks()
-            else:
-                tasks = [self._db.get_task(task_id)]
+                message = f'Requested to process {restarted} tasks'
+            elif not restarted:
+                task_data = self._db.get_task(task_id)
+                if not task_data:
+                    message = f'Task {task_id} not found'
+                elif task_data[STEP_IN_PROGRESS_KEY]:
+                    message = f'Task {task_id} is running a step, pause it first'
+                elif self._db.leased_task_ids([task_id]):
+                    message = f'Task {task_id} still has running jobs, retry once they finished'
+                else:
+                    step_name = STEP_METADATA[step_id]['name']
+                    message = f'Task {task_id} is not at step {step_name} yet'
+                status = Status.ERROR.value
+        except Exception as e:
+            message = str(e)
+            status = Status.ERROR.value
+        return status, None, message
 
-            for task_data in tasks:
-                task_data[TASK_STEP_KEY] = StepIndex.NOT_STARTED.value
-                task_data[STEP_IN_PROGRESS_KEY] = False
-                task_data[PAUSED_KEY] = False
-                self._db.update_task(task_data)
+    def pause_task(self, task_id: int) -> Tuple[Status, None, str]:
+        message = f'Paused task: {task_id}'
+        status = Status.SUCCESS.value
+        try:
+            if not self._db.set_task_fields(
+                task_id, {PAUSED_KEY: True, STEP_IN_PROGRESS_KEY: False}
+            ):
+                raise KeyError(f'Task not found: {task_id}')
+        except Exception as e:
+            message = str(e)
+            status = Status.ERROR.value
+        return status, None, message
+
+    def start_task(self, task_id: int) -> Tuple[Status, None, str]:
+        message = f'Started task: {task_id}'
+        status = Status.SUCCESS.value
+        try:
+            if not self._db.set_task_fields(task_id, {PAUSED_KEY: False}):
+                raise KeyError(f'Task not found: {task_id}')
         except Exception as e:
             message = str(e)
             status = Status.ERROR.value
         return status, None, message
 
 
+def _changed_fields(old: dict, new: dict, prefix: str = '') -> Tuple[dict, List[str]]:
+    """Fields to `$set` and `$unset` to turn `old` into `new`, nested dicts as dotted paths"""
+
+    set_fields = {}
+    unset_fields = [f'{prefix}{key}' for key in old if key not in new]
+    for key, value in new.items():
+        if key in old and old[key] == value:
+            continue
+        if isinstance(value, dict) and isinstance(old.get(key), dict):
+            sub_set, sub_unset = _changed_fields(old[key], value, f'{prefix}{key}.')
+            set_fields.update(sub_set)
+            unset_fields.extend(sub_unset)
+        else:
+            set_fields[f'{prefix}{key}'] = value
+    return set_fields, unset_fields
+
+
+def _task_order(task_data: dict) -> tuple:
+    """Scheduling order of a task: highest priority, then earliest deadline, then oldest"""
+    deadline = task_data.get(DEADLINE_KEY)
+    return (
+        -(task_data.get(PRIORITY_KEY) or 0),
+        float('inf') if deadline is None else deadline,
+        task_data[TASK_ID_KEY],
+    )
+
+
+class PendingJob(NamedTuple):
+    """A job admitted by the coordinator, waiting for capacity of its resource class"""
+
+    actor: Actor
+    args: tuple
+    step_id: int
+    image_names: List[str]
+
+    @property
+    def resource(self) -> str:
+        return worker.ACTOR_QUEUES[self.actor.actor_name]
+
+
+class Job(object):
+    """A message sent to `worker`, with the actor's result once it finished."""
+
+    def __init__(self, message: Message, step_id: int, image_names: List[str] = None):
+        super(Job, self).__init__()
+        self._message = message
+        self._step_id = step_id
+        self._image_names = image_names or []
+        self._result: Optional[dict] = None
+        self.counted = False
+        # Its images were passed on to the next image stage
+        self.chained = False
+
+    @property
+    def message(self) -> Message:
+        return self._message
+
+    @property
+    def step_id(self) -> int:
+        return self._step_id
+
+    @property
+    def resource(self) -> str:
+        """Resource class, i.e. key of `QUEUES` of config, the job occupies"""
+        return worker.ACTOR_QUEUES[self._message.actor_name]
+
+    @property
+    def image_names(self) -> List[str]:
+        return self._image_names
+
+    @property
+    def result(self) -> Optional[dict]:
+        return self._result
+
+    @property
+    def finished(self) -> bool:
+        return self._result is not None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.finished and self._result[JOB_SUCCEEDED_KEY]
+
+    def fetch_result(self) -> bool:
+        """Fetch the actor's result without blocking, return True if it just became available"""
+
+        if self.finished:
+            return False
+        try:
+            self._result = self._message.get_result()
+        except ResultMissing:
+            return False
+        except Exception as e:
+            # Actor raised, or its message was dead-lettered
+            self._result = {
+                JOB_SUCCEEDED_KEY: False,
+                JOB_IMAGES_KEY: self._image_names,
+                JOB_ERROR_KEY: str(e),
+            }
+        return True
+
+
 class Coordinator(object):
     """
     Task coordinator.
@@ -140,7 +380,36 @@ class Coordinator(object):
         self._db = DB(self._mongo_uri)
         self._ext_tools: dict = cfg.EXT_TOOLS
         self._template_files: dict = cfg.TEMPLATE_FILES
+        self._pipeline: dict = cfg.PIPELINE
+        self._capacity: Dict[str, int] = cfg.SCHEDULER_CAPACITY
+        self._events: Queue = Queue()
+        self._jobs: Dict[int, List[Job]] = {}
+        # Message IDs of tracked jobs recorded in DB
+        self._persisted_jobs: Set[str] = set()
+        self._backlog: Dict[int, List[PendingJob]] = {}
+        self._task_orders: Dict[int, tuple] = {}
+        self._result_interval: float = 1
+        self._updates: List[UpdateOne] = []
+        self._moved_task_ids: Set[int] = set()
+        # Step state written for tasks whose jobs were admitted in this pass, their jobs
+        # are only sent once DB confirms it
+        self._admitted: Dict[int, dict] = {}
         self.setup_logger(cfg)
+        worker.setup_queues(cfg)
+
+        self._watcher: Optional[TaskWatcher] = None
+        self._rescan_interval: float = cfg.FS_WATCHER['RESCAN_INTERVAL']
+        # Seconds an uploaded file must keep its size and mtime before it is used
+        self._settle_time: float = cfg.FS_WATCHER['DEBOUNCE']
+        self._file_stats: Dict[str, Tuple[Tuple[int, int], float]] = {}
+        if cfg.FS_WATCHER['ENABLED']:
+            self._watcher = TaskWatcher(
+                self._on_files_changed,
+                cfg.FS_WATCHER['DEBOUNCE'],
+                cfg.FS_WATCHER['POLL_INTERVAL'],
+                cfg.FS_WATCHER['POLL_PATHS'],
+                self.logger,
+            )
 
     def setup_logger(self, cfg: ModuleType):
         Path(cfg.COORDINATOR_LOG).parent.mkdir(parents=True, exist_ok=True)
@@ -174,138 +443,653 @@ class Coordinator(object):
         )
         self.logger = logging.getLogger()
 
+    def _watch_task_changes(self):
+        """Feed IDs of inserted, restarted, paused or resumed tasks to the event queue
+
+        Change streams need a replica set, otherwise only periodic polling is used
+        """
+
+        def watch():
+            try:
+                for task_id in self._db.watch_tasks():
+                    self._events.put(task_id)
+            except PyMongoError as e:
+                self.logger.warning(f'Task change stream unavailable, polling only :: {str(e)}')
+
+        Thread(target=watch, name='task-change-stream', daemon=True).start()
+
+    def notify(self, task_id: int):
+        """Request coordinating a task as soon as possible"""
+        self._events.put(task_id)
+
+    def _on_files_changed(self, task_id: int, directory: Path):
+        """Called by `TaskWatcher` when files were added to a folder of a task"""
+        DirectoryInventory.invalidate(directory)
+        self.notify(task_id)
+
+    def _watch_tasks(self, tasks: List[dict], all_tasks: bool):
+        """Watch locations of active tasks, also stop watching others if `all_tasks`"""
+
+        if not self._watcher:
+            return
+        locations = {t[TASK_ID_KEY]: t[TASK_LOCATION_KEY] for t in tasks}
+        if all_tasks:
+            self._watcher.sync(locations)
+        else:
+            for task_id, location in locations.items():
+                self._watcher.watch(task_id, location)
+
+    def _wait_events(self, timeout: float) -> Set[int]:
+        """Block until some tasks need coordinating or `timeout` expired"""
+
+        task_ids = set()
+        try:
+            task_ids.add(self._events.get(timeout=max(timeout, 0)))
+            while 1:
+                task_ids.add(self._events.get_nowait())
+        except Empty:
+            pass
+        return task_ids
+
+    def _collect_results(self) -> Set[int]:
+        """Fetch results of dispatched jobs, return IDs of tasks having newly finished jobs"""
+
+        task_ids = set()
+        for task_id, jobs in self._jobs.items():
+            for job in jobs:
+                if job.fetch_result():
+                    task_ids.add(task_id)
+        return task_ids
+
+    def _send(self, task_id: int, job: Job):
+        self._jobs.setdefault(task_id, []).append(job)
+
+    def _sync_jobs(self):
+        """Record newly sent jobs in DB, and forget jobs no longer tracked"""
+
+        tracked = {
+            job.message.message_id: (task_id, job)
+            for task_id, jobs in self._jobs.items()
+            for job in jobs
+        }
+        new_jobs = [
+            {
+                JOB_MESSAGE_ID_KEY: message_id,
+                TASK_ID_KEY: task_id,
+                TASK_STEP_KEY: job.step_id,
+                JOB_IMAGES_KEY: job.image_names,
+                JOB_MESSAGE_KEY: job.message.encode(),
+            }
+            for message_id, (task_id, job) in tracked.items()
+            if message_id not in self._persisted_jobs
+        ]
+        dropped = self._persisted_jobs - set(tracked)
+        try:
+            self._db.add_jobs(new_jobs)
+            self._persisted_jobs.update(job[JOB_MESSAGE_ID_KEY] for job in new_jobs)
+            self._db.delete_jobs(dropped)
+            self._persisted_jobs -= dropped
+        except PyMongoError as e:
+            self.logger.error(f'Recording jobs error :: {str(e)}')
+
+    def reattach_jobs(self):
+        """Track again jobs sent before the coordinator restarted, their results are kept by
+        the result backend for `RESULT_TTL` of `worker`
+        """
+
+        for job_data in self._db.ls_jobs():
+            message = Message.decode(bytes(job_data[JOB_MESSAGE_KEY]))
+            job = Job(message, job_data[TASK_STEP_KEY], job_data[JOB_IMAGES_KEY])
+            self._send(job_data[TASK_ID_KEY], job)
+            self._persisted_jobs.add(message.message_id)
+        if self._persisted_jobs:
+            self.logger.info(f'Reattached {len(self._persisted_jobs)} jobs')
+
+    def _queue(
+        self, task_id: int, actor: Actor, args: tuple, step_id: int, image_names: List[str] = None
+    ):
+        """Admit a job of a task, it is sent by `dispatch()` once its resource class has room"""
+        pending = PendingJob(actor, args, step_id, image_names or [])
+        self._backlog.setdefault(task_id, []).append(pending)
+
+    def _drop_backlog(self, task_id: int) -> Optional[int]:
+        """Forget jobs of a task not yet sent, return the step they belonged to"""
+        backlog = self._backlog.pop(task_id, None)
+        self._task_orders.pop(task_id, None)
+        return backlog[0].step_id if backlog else None
+
+    def _confirm_admitted(self):
+        """Drop newly admitted jobs of tasks whose step state update did not apply, e.g.
+        because the task was paused or restarted concurrently
+
+        Must run after `flush_updates()`
+        """
+
+        admitted, self._admitted = self._admitted, {}
+        if not admitted:
+            return
+        fields = list(next(iter(admitted.values())))
+        try:
+            tasks, _ = self._db.find_tasks({TASK_ID_KEY: {'$in': list(admitted)}}, fields)
+            states = {t[TASK_ID_KEY]: {key: t.get(key) for key in fields} for t in tasks}
+        except PyMongoError as e:
+            self.logger.error(f'Confirming admitted jobs error :: {str(e)}')
+            states = {}
+        for task_id, state in admitted.items():
+            if states.get(task_id) != state:
+                self._drop_backlog(task_id)
+                self.logger.warning(f'Step state changed concurrently, task: {task_id}')
+
+    def dispatch(self):
+        """Send admitted jobs while their resource class has capacity, by task priority
+
+        Every resource class is filled independently, so tasks at different steps overlap
+        and e.g. RealityCapture jobs never wait behind color correction of other tasks.
+        Must run after `flush_updates()`, jobs of a newly admitted step are only sent once
+        the step is marked as in progress in DB
+        """
+
+        self._confirm_admitted()
+        in_flight = Counter(
+            job.resource for jobs in self._jobs.values() for job in jobs if not job.finished
+        )
+        for task_id in sorted(self._backlog, key=lambda t: self._task_orders[t]):
+            remaining = []
+            for pending in self._backlog[task_id]:
+                capacity = self._capacity.get(pending.resource)
+                if capacity and in_flight[pending.resource] >= capacity:
+                    remaining.append(pending)
+                    continue
+                message = pending.actor.send(*pending.args)
+                self._send(task_id, Job(message, pending.step_id, pending.image_names))
+                in_flight[pending.resource] += 1
+                log = f'Sent {pending.actor.actor_name}, task: {task_id}'
+                if pending.image_names:
+                    log += f', images: {pending.image_names}'
+                self.logger.info(log)
+
+            if remaining:
+                self._backlog[task_id] = remaining
+            else:
+                self._drop_backlog(task_id)
+        self._sync_jobs()
+
+    def _recover_lost_jobs(self):
+        """Dispatch again the work of jobs whose lease expired
+
+        A tracked job is admitted again as is, its already processed images are skipped by
+        the worker. Otherwise the job is not tracked, so its step is no longer in progress
+        and pending images of the step are dispatched again.
+        """
+
+        for lease in self._db.expired_leases():
+            message_id = lease[LEASE_MESSAGE_ID_KEY]
+            task_id = lease[TASK_ID_KEY]
+            self._db.release_lease(message_id)
+            self.logger.warning(
+                f'Lease of job {message_id} expired, worker: {lease[LEASE_WORKER_KEY]}, '
+                f'task: {task_id}'
+            )
+
+            jobs = self._jobs.get(task_id, [])
+            lost_jobs = [job for job in jobs if job.message.message_id == message_id]
+            if lost_jobs:
+                job = lost_jobs[0]
+                jobs.remove(job)
+                if job.finished:
+                    continue
+                actor = worker.redis_broker.get_actor(job.message.actor_name)
+                self._queue(task_id, actor, tuple(job.message.args), job.step_id, job.image_names)
+                self._task_orders[task_id] = _task_order(job.message.args[0])
+            else:
+                self._updates.append(
+                    self._db.task_update(
+                        task_id,
+                        {STEP_IN_PROGRESS_KEY: False},
+                        expected={TASK_STEP_KEY: lease[TASK_STEP_KEY], STEP_IN_PROGRESS_KEY: True},
+                    )
+                )
+
+    def _release_inactive(self, task_ids: Set[int]):
+        """Drop not yet sent jobs of paused, completed or deleted tasks
+
+        Their step is no longer in progress, so that it is dispatched again on resume
+        """
+
+        for task_id in task_ids & set(self._backlog):
+            step_id = self._drop_backlog(task_id)
+            self._updates.append(
+                self._db.task_update(
+                    task_id,
+                    {STEP_IN_PROGRESS_KEY: False},
+                    expected={TASK_STEP_KEY: step_id, STEP_IN_PROGRESS_KEY: True},
+                )
+            )
+
     def run(self, interval: float):
         """
         Coordinating loop:
-            - Get list of tasks from DB
+            - Wait for task changes, job results or new files, or at most `interval` seconds.
+              While watching task locations, `RESCAN_INTERVAL` of `FS_WATCHER` is used instead
+            - When `interval` elapsed, dispatch again work of jobs whose lease expired
+            - Get changed tasks, or all active tasks when `interval` elapsed, from DB
             - For current step of each task
                 * If step is in progress, do further check
-                    - If finished, update task data to DB ( new current step value, no longer in progress )
+                    - If all its jobs succeeded, update task data to DB ( next step, no longer in progress )
+                    - If some of its jobs failed, pause the task and record the errors
                     - Otherwise, skip
                 * If step is NOT in progress
-                    - Request `worker` to process it
+                    - Admit its jobs to the scheduler backlog
                     - And update task data in DB ( mark as in progress )
+            - Send admitted jobs of all tasks within capacity of each resource class
         """
         self.logger.info('Running Task Coordinator...\n')
 
-        color_swatch_cache = {}
+        self.reattach_jobs()
+
+        self._watch_task_changes()
+        if self._watcher:
+            self._watcher.start()
+            interval = max(interval, self._rescan_interval)
+        next_poll = 0
         while 1:
-            self.logger.debug('START coordinating tasks:')
-            tasks = self._db.ls_tasks()
-            self.logger.debug(pprint.pformat(tasks))
+            task_ids = self._wait_events(min(next_poll - time.monotonic(), self._result_interval))
+            task_ids |= self._collect_results()
+            if time.monotonic() >= next_poll:
+                # Periodic pass over active tasks, completed and paused ones are not loaded
+                self._recover_lost_jobs()
+                self.flush_updates()
+                task_ids = None
+                next_poll = time.monotonic() + interval
+            elif not task_ids:
+                continue
 
-            for task_data in tasks:
-                task = Task(task_data, self.logger, self._ext_tools, self._template_files)
-                task_id = task_data[TASK_ID_KEY]
+            self.coordinate_tasks(task_ids)
 
-                if task.cur_step.step_id == StepIndex.COMPLETED.value:
-                    continue
+    def coordinate_tasks(self, task_ids: Optional[Set[int]] = None):
+        """A coordinating pass over some active tasks, or over all of them if `task_ids` is
+        `None`, then send admitted jobs
+        """
+
+        self.logger.debug('START coordinating tasks:')
+        tasks = self._db.ls_active_tasks(task_ids)
+        self.logger.debug(pprint.pformat(tasks))
+        self._watch_tasks(tasks, task_ids is None)
 
-                if task.cur_step.step_id == StepIndex.NOT_STARTED.value:
-                    if task.cache_dir.joinpath(CC_ARW).exists():
-                        task_data[REQUIRE_KEY][REQ_COLOR_CHECKER_KEY] = False
-                        self._db.update_task(task_data)
-
-                if task.cur_step.step_id == StepIndex.DNG_CONVERSION.value:
-                    input_images_count = task.cur_step.input_images_count
-                    if input_images_count:
-                        task_data[REQUIRE_KEY][REQ_RAW_IMAGE_KEY] = False
-                        task_data[IMG_PROGRESS_KEY][IMG_PROGRESS_TOTAL_KEY] = input_images_count
-                        self._db.update_task(task_data)
-
-                if task_data[STEP_IN_PROGRESS_KEY]:
-                    if task.cur_step.is_finished:
-                        task_data[STEP_IN_PROGRESS_KEY] = False
-                        if task.cur_step.step_id < StepIndex.COMPLETED.value:
-                            task_data[TASK_STEP_KEY] += 1
-                        self._db.update_task(task_data)
-                        self.logger.info(
-                            f'Step {STEP_METADATA[task.cur_step.step_id]["name"]} is finished'
-                        )
+        for task_data in tasks:
+            try:
+                self.coordinate_task(task_data)
+            except Exception as e:
+                task_id = task_data[TASK_ID_KEY]
+                self.logger.error(f'Coordinating error, task: {task_id} :: {str(e)}')
 
+        active_task_ids = {task_data[TASK_ID_KEY] for task_data in tasks}
+        if task_ids is None:
+            self._release_inactive(set(self._backlog) - active_task_ids)
+            # Stop tracking finished jobs of deleted, completed or paused tasks. Unfinished
+            # ones still write outputs, a restart from a step waits for them
+            for task_id in set(self._jobs) - active_task_ids:
+                jobs = [job for job in self._jobs[task_id] if not job.finished]
+                if jobs:
+                    self._jobs[task_id] = jobs
                 else:
-                    sent_job = 0
-
-                    if task.cur_step.is_finished:
-                        if task.cur_step.step_id < StepIndex.COMPLETED.value:
-                            task_data[TASK_STEP_KEY] += 1
-                        self._db.update_task(task_data)
-                        self.logger.info(
-                            f'Step {STEP_METADATA[task.cur_step.step_id]["name"]} is finished'
-                        )
-                        continue
-                    if task.paused:
-                        continue
-
-                    if task.cur_step.step_id == StepIndex.NOT_STARTED.value:
-                        worker.init_task_job.send(task_data)
-                        sent_job = 1
-                        self.logger.info(f'Sent init_task_job, task: {task_id}')
-
-                    elif task.cur_step.step_id == StepIndex.DNG_CONVERSION.value:
-                        for image_name in task.cur_step.ls_input_images():
-                            worker.dng_conversion_job.send(task_data, image_name)
-                            sent_job = 1
-                            self.logger.info(
-                                f'Sent dng_conversion_job, task: {task_id}, image: {image_name}'
-                            )
-
-                    elif task.cur_step.step_id == StepIndex.COLOR_CORRECTION.value:
-                        # if task.cur_step.step_id not in color_swatch_cache:
-                        #     swatch = img_util.compute_swatch(task.cache_dir.joinpath(CC_BLUR_TIFF))
-                        #     color_swatch_cache[task.task_id] = swatch.tolist()
-                        # for image_name in task.cur_step.ls_input_images():
-                        #     worker.color_correction_job.send(
-                        #         task_data, image_name, color_swatch_cache[task.task_id]
-                        #     )
-                        #     sent_job = 1
-                        #     self.logger.info(
-                        #         f'Sent color_correction_job, task: {task_id}, image: {image_name}'
-                        #     )
-
-                        worker.color_correction_single_job.send(task_data)
-                        sent_job = 1
-                        self.logger.info(f'Sent color_correction_single_job, task: {task_id}')
-
-                    elif task.cur_step.step_id == StepIndex.PREPARE_RC.value:
-                        worker.prepare_rc_job.send(task_data)
-                        sent_job = 1
-                        self.logger.info(f'Sent prepare_rc_job, task: {task_id}')
-
-                    elif task.cur_step.step_id == StepIndex.MESH_CONSTRUCTION.value:
-                        worker.mesh_construction_job.send(task_data)
-                        sent_job = 1
-                        self.logger.info(f'Sent mesh_construction_job, task: {task_id}')
-
-                    if (
-                        StepIndex.NOT_STARTED.value
-                        <= task.cur_step.step_id
-                        <= StepIndex.MESH_CONSTRUCTION.value
-                    ) and sent_job:
-                        task_data[STEP_IN_PROGRESS_KEY] = True
-                        self._db.update_task(task_data)
-
-                    if (
-                        task.cur_step.step_id > StepIndex.COLOR_CORRECTION.value
-                        and task.task_id in color_swatch_cache
-                    ):
-                        color_swatch_cache.pop(task.task_id)
-
-                # Update image processing progress
-                if (
-                    StepIndex.DNG_CONVERSION.value
-                    <= task.cur_step.step_id
-                    <= StepIndex.COLOR_CORRECTION.value
-                ):
-                    input_images_count = task.cur_step.input_images_count
-                    output_images_count = task.cur_step.output_images_count
-                    task_data[IMG_PROGRESS_KEY][IMG_PROGRESS_COMPLETED_KEY] = output_images_count
+                    self._jobs.pop(task_id)
+        else:
+            self._release_inactive(task_ids - active_task_ids)
+
+        self.flush_updates()
+        self.dispatch()
+
+        self.logger.debug('DONE')
+        self.logger.debug('')
+
+    def flush_updates(self):
+        """Write task changes of this coordinating pass to DB in one bulk write"""
+
+        try:
+            self._db.bulk_update_tasks(self._updates)
+        except PyMongoError as e:
+            self.logger.error(f'Updating tasks error :: {str(e)}')
+        self._updates = []
+
+        # Next steps can be dispatched right away
+        for task_id in self._moved_task_ids:
+            self.notify(task_id)
+        self._moved_task_ids = set()
+
+    def coordinate_task(self, task_data: dict):
+        """Advance a single task
+
+        Changed fields are queued as a partial update for `flush_updates()`, guarded by
+        compare-and-set on step state so that concurrent pause/restart from API are not lost
+        """
+
+        invalidate_step_id = task_data.pop(INVALIDATE_STEP_KEY, None)
+        origin_task_data = copy.deepcopy(task_data)
+        task = Task(
+            task_data, self.logger, self._ext_tools, self._template_files, pipeline=self._pipeline
+        )
+        task_id = task_data[TASK_ID_KEY]
+        if invalidate_step_id is not None:
+            if self._has_running_jobs(task_id):
+                # Paused while running, outputs are only deleted once sent jobs are done
+                self._drop_backlog(task_id)
+                self.logger.debug(f'Waiting for jobs to finish before restart, task: {task_id}')
+                return
+            self._invalidate(task, invalidate_step_id)
+        step = task.cur_step
+
+        if step.step_id == StepIndex.COMPLETED.value:
+            return
+
+        # Results of jobs sent for another step, e.g. before a restart, are irrelevant
+        jobs = [job for job in self._jobs.pop(task_id, []) if job.step_id == step.step_id]
+        if jobs:
+            self._jobs[task_id] = jobs
+        if task_id in self._backlog:
+            if self._backlog[task_id][0].step_id != step.step_id:
+                self._drop_backlog(task_id)
+            elif task.paused:
+                # Admit again from pending images on resume
+                self._drop_backlog(task_id)
+                task_data[STEP_IN_PROGRESS_KEY] = False
+            else:
+                self._task_orders[task_id] = _task_order(task_data)
+
+        if step.step_id == StepIndex.NOT_STARTED.value and not task_data[STEP_IN_PROGRESS_KEY]:
+            # Init step is only dispatched once user's color checker is fully uploaded
+            task_data[REQUIRE_KEY][REQ_COLOR_CHECKER_KEY] = not self._is_settled(
+                task_id, task.cache_dir.joinpath(CC_ARW)
+            )
+
+        if step.step_id == StepIndex.DNG_CONVERSION.value:
+            if task_data[REQUIRE_KEY][REQ_RAW_IMAGE_KEY]:
+                input_images_count = step.input_images_count
+                if input_images_count:
+                    task_data[REQUIRE_KEY][REQ_RAW_IMAGE_KEY] = False
                     task_data[IMG_PROGRESS_KEY][IMG_PROGRESS_TOTAL_KEY] = input_images_count
+
+        if task_data[STEP_IN_PROGRESS_KEY]:
+            if jobs and task.streaming and step.step_id == StepIndex.DNG_CONVERSION.value:
+                self._chain_color_correction(task, jobs)
+
+            if task_id in self._backlog:
+                # Some jobs are still waiting for capacity
+                pass
+            elif jobs:
+                if all(job.finished for job in jobs):
+                    self._jobs.pop(task_id)
+                    self._finish_step(task, step, jobs)
+            elif self._is_finished(task, step):
+                # Jobs are not tracked, e.g. they were sent by a version not recording them
+                task_data[STEP_IN_PROGRESS_KEY] = False
+                if step.step_id < StepIndex.COMPLETED.value:
+                    task_data[TASK_STEP_KEY] += 1
+                self.logger.info(f'Step {STEP_METADATA[step.step_id]["name"]} is finished')
+
+        elif self._is_finished(task, step):
+            if step.step_id < StepIndex.COMPLETED.value:
+                task_data[TASK_STEP_KEY] += 1
+            self.logger.info(f'Step {STEP_METADATA[step.step_id]["name"]} is finished')
+
+        elif not task.paused:
+            # A new round of jobs, results of older ones no longer matter
+            self._jobs.pop(task_id, None)
+            self._drop_backlog(task_id)
+            task_data.pop(ERROR_KEY, None)
+
+            if step.step_id == StepIndex.NOT_STARTED.value:
+                if task_data[REQUIRE_KEY][REQ_COLOR_CHECKER_KEY]:
+                    self.logger.debug(f'Waiting for {CC_ARW} of task: {task_id}')
                 else:
-                    task_data[IMG_PROGRESS_KEY][IMG_PROGRESS_COMPLETED_KEY] = 0
-                    task_data[IMG_PROGRESS_KEY][IMG_PROGRESS_TOTAL_KEY] = 0
-                self._db.update_task(task_data)
+                    self._queue(task_id, worker.init_task_job, (task_data,), step.step_id)
+
+            elif step.step_id == StepIndex.DNG_CONVERSION.value:
+                image_names = self._pending_images(task, step)
+                batch_size = self._pipeline['DNG_CONVERSION_BATCH_SIZE']
+                for i in range(0, len(image_names), batch_size):
+                    batch = image_names[i : i + batch_size]
+                    self._queue(
+                        task_id, worker.dng_conversion_job, (task_data, batch), step.step_id, batch
+                    )
+                if task.streaming:
+                    # Images are done once color corrected, already converted ones can go now
+                    color_step = task.get_step(StepIndex.COLOR_CORRECTION.value)
+                    task_data[CC_MATRIX_KEY] = task.color_correction_matrix().tolist()
+                    color_image_names = self._pending_images(task, color_step)
+                    self._queue_color_correction(task, color_image_names)
+                    image_names = set(image_names) | set(color_image_names)
+                self._reset_image_progress(task_data, step.input_images_count, len(image_names))
+
+            elif step.step_id == StepIndex.COLOR_CORRECTION.value:
+                image_names = self._pending_images(task, step)
+                if self._pipeline['COLOR_CORRECTION_PARALLEL']:
+                    # Matrix was fitted by init step, travel with task data to all jobs
+                    ccm = task.color_correction_matrix()
+                    task_data[CC_MATRIX_KEY] = ccm.tolist()
+                    self._queue_color_correction(task, image_names)
+                else:
+                    self._queue(
+                        task_id,
+                        worker.color_correction_single_job,
+                        (task_data,),
+                        step.step_id,
+                        image_names,
+                    )
+                self._reset_image_progress(task_data, step.input_images_count, len(image_names))
+
+            elif step.step_id == StepIndex.PREPARE_RC.value:
+                self._queue(task_id, worker.prepare_rc_job, (task_data,), step.step_id)
+
+            elif step.step_id == StepIndex.MESH_CONSTRUCTION.value:
+                self._queue(task_id, worker.mesh_construction_job, (task_data,), step.step_id)
+
+            if task_id in self._backlog:
+                task_data[STEP_IN_PROGRESS_KEY] = True
+                self._admitted[task_id] = {key: task_data[key] for key in STEP_STATE_KEYS}
+                self._task_orders[task_id] = _task_order(task_data)
+                self.logger.info(
+                    f'Admitted {len(self._backlog[task_id])} jobs of step '
+                    f'{STEP_METADATA[step.step_id]["name"]}, task: {task_id}'
+                )
+
+        # Update image processing progress
+        step = task.cur_step
+        completed_inc = 0
+        if StepIndex.DNG_CONVERSION.value <= step.step_id <= StepIndex.COLOR_CORRECTION.value:
+            if task_id in self._jobs or task_id in self._backlog:
+                for job in self._jobs.get(task_id, []):
+                    if job.succeeded and not job.counted:
+                        completed_inc += len(job.image_names)
+                        job.counted = True
+            elif task_data[STEP_IN_PROGRESS_KEY] or task_data != origin_task_data:
+                # No job results to count from, fall back to listing directories
+                output_step = step
+                if task.streaming:
+                    output_step = task.get_step(StepIndex.COLOR_CORRECTION.value)
+                completed = self._completed_images(output_step)
+                task_data[IMG_PROGRESS_KEY][IMG_PROGRESS_COMPLETED_KEY] = completed
+                task_data[IMG_PROGRESS_KEY][IMG_PROGRESS_TOTAL_KEY] = step.input_images_count
+        else:
+            self._reset_image_progress(task_data, 0, 0)
+
+        set_fields, unset_fields = _changed_fields(origin_task_data, task_data)
+        if set_fields or unset_fields:
+            expected = None
+            if any(task_data.get(key) != origin_task_data.get(key) for key in STEP_STATE_KEYS):
+                expected = {key: origin_task_data[key] for key in STEP_STATE_KEYS}
+            self._updates.append(
+                self._db.task_update(task_id, set_fields, unset_fields, expected=expected)
+            )
+        if completed_inc:
+            # Only counted if step state is still the one written above
+            expected = {key: task_data[key] for key in STEP_STATE_KEYS}
+            self._updates.append(
+                self._db.image_progress_update(task_id, completed_inc, expected=expected)
+            )
+        if task_data[TASK_STEP_KEY] != origin_task_data[TASK_STEP_KEY]:
+            self._moved_task_ids.add(task_id)
+
+    def _is_settled(self, task_id: int, path: Path) -> bool:
+        """Whether `path` exists and kept its size and mtime for `_settle_time` seconds,
+        i.e. it is not being uploaded anymore
+
+        The task is coordinated again once a newly seen file may have settled
+        """
+
+        key = path.as_posix()
+        try:
+            st = path.stat()
+        except OSError:
+            self._file_stats.pop(key, None)
+            return False
+        stat = (st.st_size, st.st_mtime_ns)
+        seen = self._file_stats.get(key)
+        if not seen or seen[0] != stat:
+            self._file_stats[key] = (stat, time.monotonic())
+            timer = Timer(self._settle_time, self.notify, (task_id,))
+            timer.daemon = True
+            timer.start()
+            return False
+        return time.monotonic() - seen[1] >= self._settle_time
+
+    def _has_running_jobs(self, task_id: int) -> bool:
+        """Whether jobs of a task may still write outputs: sent without a result yet, or
+        holding a lease
+        """
+        if any(not job.finished for job in self._jobs.get(task_id, [])):
+            return True
+        return bool(self._db.leased_task_ids([task_id]))
+
+    def _invalidate(self, task: Task, step_id: int):
+        """Restarted from `step_id`: forget its jobs, delete outputs of the step and later
+        ones, then clear the restart flag
+        """
+
+        task_id = task.task_id
+        self._jobs.pop(task_id, None)
+        self._drop_backlog(task_id)
+        for invalidated_step_id in range(step_id, StepIndex.COMPLETED.value):
+            task.get_step(invalidated_step_id).clear_outputs()
+        self._db.delete_images(task_id, step_id)
+        self._updates.append(
+            self._db.task_update(
+                task_id, unset_fields=[INVALIDATE_STEP_KEY], expected={INVALIDATE_STEP_KEY: step_id}
+            )
+        )
+        self.logger.info(f'Restarted from step {STEP_METADATA[step_id]["name"]}, task: {task_id}')
+
+    def _queue_color_correction(self, task: Task, image_names: List[str]):
+        """Admit `color_correction_job` batches, owned by the task's current step"""
+        batch_size = self._pipeline['COLOR_CORRECTION_BATCH_SIZE']
+        for i in range(0, len(image_names), batch_size):
+            batch = image_names[i : i + batch_size]
+            self._queue(
+                task.task_id,
+                worker.color_correction_job,
+                (task.task_data, batch),
+                task.cur_step.step_id,
+                batch,
+            )
+
+    def _chain_color_correction(self, task: Task, jobs: List[Job]):
+        """Streaming: color correct images of DNG conversion jobs which just finished"""
+        dng_step = task.get_step(StepIndex.DNG_CONVERSION.value)
+        for job in jobs:
+            if job.chained or not job.finished:
+                continue
+            if job.message.actor_name != worker.dng_conversion_job.actor_name:
+                continue
+            image_names = job.image_names
+            if not job.succeeded:
+                # Images of the batch which were converted before it gave up
+                image_names = [name for name in image_names if dng_step.is_image_done(name)]
+            self._queue_color_correction(task, image_names)
+            job.chained = True
+            # Progress is counted once images are color corrected
+            job.counted = True
+        if task.task_id in self._backlog:
+            self._task_orders[task.task_id] = _task_order(task.task_data)
+
+    @staticmethod
+    def _failed_images(task: Task, step: Step) -> Set[str]:
+        """Images of a step given up after all retries"""
+        return set(task.task_data.get(FAILED_IMAGES_KEY, {}).get(StepIndex(step.step_id).name, []))
+
+    def _pending_images(self, task: Task, step: Step) -> List[str]:
+        failed_images = self._failed_images(task, step)
+        return [name for name in step.pending_images() if name not in failed_images]
+
+    def _is_finished(self, task: Task, step: Step) -> bool:
+        """`step.is_finished`, without waiting for images given up on"""
+        if step.is_finished:
+            return True
+        if not self._failed_images(task, step) or not step.output_images_count:
+            return False
+        return not self._pending_images(task, step)
+
+    def _completed_images(self, step: Step) -> int:
+        """Completed images of a step from per-image states, by listing its output folder
+        only if no state was recorded
+        """
+        task_id = step.task.task_id
+        if self._db.count_images(task_id, step.step_id):
+            return self._db.count_images(task_id, step.step_id, ImageState.DONE)
+        return step.output_images_count
+
+    def _reset_image_progress(self, task_data: dict, total: int, pending: int):
+        task_data[IMG_PROGRESS_KEY][IMG_PROGRESS_COMPLETED_KEY] = total - pending
+        task_data[IMG_PROGRESS_KEY][IMG_PROGRESS_TOTAL_KEY] = total
+
+    def _finish_step(self, task: Task, step: Step, jobs: List[Job]):
+        """Move to next step if all jobs of current step succeeded
+
+        Images still failing after all retries are given up on if `COMPLETE_WITH_FAILED_IMAGES`
+        and some images of the step succeeded, otherwise the task is paused
+        """
+
+        task_data = task.task_data
+        task_id = task.task_id
+        task_data[STEP_IN_PROGRESS_KEY] = False
+
+        failed_jobs = [job for job in jobs if not job.succeeded]
+        if failed_jobs:
+            failed_images: Dict[int, Set[str]] = {}
+            errors = {job.result.get(JOB_ERROR_KEY, '') for job in failed_jobs}
+            for job in failed_jobs:
+                image_step_id = ACTOR_IMAGE_STEPS.get(job.message.actor_name, step.step_id)
+                # Narrow down to the images of the job which actually failed
+                images = self._db.find_images(
+                    task_id, image_step_id, job.image_names, ImageState.FAILED
+                )
+                failed_images.setdefault(image_step_id, set()).update(
+                    [image[IMAGE_NAME_KEY] for image in images] or job.image_names
+                )
+                errors |= {image[IMAGE_ERROR_KEY] or '' for image in images}
+            all_failed_images = sorted(set().union(*failed_images.values()))
+            errors = sorted(errors - {''})
+            message = f'Step {step.name} failed'
+            if all_failed_images:
+                message += f', images: {", ".join(all_failed_images)}'
+            if errors:
+                message += f' :: {"; ".join(errors)}'
+
+            give_up = (
+                self._pipeline.get('COMPLETE_WITH_FAILED_IMAGES')
+                and all(job.message.actor_name in ACTOR_IMAGE_STEPS for job in failed_jobs)
+                and step.output_images_count > 0
+            )
+            if not give_up:
+                task_data[PAUSED_KEY] = True
+                task_data[ERROR_KEY] = message
+                self.logger.error(f'{message}, task: {task_id}')
+                return
+
+            given_up = task_data.setdefault(FAILED_IMAGES_KEY, {})
+            for image_step_id, images in failed_images.items():
+                key = StepIndex(image_step_id).name
+                given_up[key] = sorted(set(given_up.get(key, [])) | images)
+            self.logger.warning(f'{message}, continue without them, task: {task_id}')
 
-            self.logger.debug('DONE')
-            self.logger.debug('')
-            time.sleep(interval)
+        task_data[TASK_STEP_KEY] += 1
+        self.logger.info(f'Step {step.name} is finished, task: {task_id}')
@@ -1,17 +1,123 @@
+import builtins
 import logging
+import os
+import socket
+import time
+from functools import partial
+from threading import Event, Lock, Thread
 from types import ModuleType
+from typing import Callable, Dict, List, Tuple, Type
 from pathlib import Path
 import dramatiq
 from dramatiq.brokers.redis import RedisBroker
-
-from .img_util import ColourCheckerSwatchesData
-from .task import Task
+from dramatiq.results import Results
+from dramatiq.results.backends import RedisBackend
+
+from . import process_runner
+from . import result_cache
+from .db import DB
+from .process_pool import ImageProcessPool
+from .task import (
+    CC_MATRIX_KEY,
+    JOB_IMAGES_KEY,
+    JOB_SUCCEEDED_KEY,
+    TASK_ID_KEY,
+    ImageProcessingError,
+    TASK_STEP_KEY,
+    Step,
+    StepIndex,
+    Task,
+)
 
 LOGGER = None
 EXT_TOOLS = None
 TEMPLATE_FILES = None
+PROCESS_POOL = None
+PIPELINE = None
+TASK_DB = None
+WORKER_ID = None
+# Seconds between lease renewals, and lease duration per key of `QUEUES` of config
+HEARTBEAT_INTERVAL = 30
+LEASE_HORIZONS: Dict[str, float] = {}
+
+# Key of `QUEUES` of config each actor is routed to
+ACTOR_QUEUES = {
+    'init_task_job': 'INIT',
+    'dng_conversion_job': 'DNG',
+    'color_correction_job': 'COLOR',
+    'color_correction_single_job': 'COLOR',
+    'prepare_rc_job': 'RC',
+    'mesh_construction_job': 'RC',
+}
+
+# Keep job results long enough for a restarted coordinator to pick them up from its
+# recorded jobs (ms)
+RESULT_TTL = 24 * 60 * 60 * 1000
+
+
+class ProcessPoolShutdown(dramatiq.Middleware):
+    """Stop the worker's process pool together with the worker"""
+
+    def before_worker_shutdown(self, broker, worker):
+        if PROCESS_POOL:
+            PROCESS_POOL.shutdown()
+
+
+class LeaseHeartbeat(dramatiq.Middleware):
+    """Hold a lease in DB for every running job, renewed every `HEARTBEAT_INTERVAL` seconds.
+
+    A lease the coordinator finds expired means the worker running the job is gone.
+    """
+
+    def __init__(self):
+        super(LeaseHeartbeat, self).__init__()
+        self._leases: Dict[str, Tuple[int, int, float]] = {}
+        self._lock = Lock()
+        self._stop = Event()
+
+    def _renew(self, message_id: str, lease: Tuple[int, int, float]):
+        try:
+            TASK_DB.renew_lease(message_id, *lease[:2], WORKER_ID, lease[2])
+        except Exception as e:
+            LOGGER.warning(f'Renewing lease of job {message_id} failed :: {str(e)}')
+
+    def _heartbeat(self):
+        while not self._stop.wait(HEARTBEAT_INTERVAL):
+            with self._lock:
+                leases = list(self._leases.items())
+            for message_id, lease in leases:
+                self._renew(message_id, lease)
+
+    def after_worker_boot(self, broker, worker):
+        Thread(target=self._heartbeat, name='lease-heartbeat', daemon=True).start()
+
+    def before_worker_shutdown(self, broker, worker):
+        self._stop.set()
+
+    def before_process_message(self, broker, message):
+        horizon = LEASE_HORIZONS.get(ACTOR_QUEUES.get(message.actor_name))
+        if not (TASK_DB and horizon and message.args):
+            return
+        task_data = message.args[0]
+        lease = (task_data[TASK_ID_KEY], task_data[TASK_STEP_KEY], horizon)
+        with self._lock:
+            self._leases[message.message_id] = lease
+        self._renew(message.message_id, lease)
+
+    def after_process_message(self, broker, message, *, result=None, exception=None):
+        with self._lock:
+            lease = self._leases.pop(message.message_id, None)
+        if lease:
+            TASK_DB.release_lease(message.message_id)
+
+    after_skip_message = after_process_message
+
 
 redis_broker = RedisBroker(host="localhost", port=6379)
+result_backend = RedisBackend(host="localhost", port=6379)
+redis_broker.add_middleware(Results(backend=result_backend, result_ttl=RESULT_TTL))
+redis_broker.add_middleware(ProcessPoolShutdown())
+redis_broker.add_middleware(LeaseHeartbeat())
 dramatiq.set_broker(redis_broker)
 
 
@@ -49,43 +155,189 @@ def _load_template_files(cfg: ModuleType):
     TEMPLATE_FILES = cfg.TEMPLATE_FILES
 
 
-def setup_worker(cfg: ModuleType):
-    _setup_logger(cfg)
-    _load_ext_tools(cfg)
-    _load_template_files(cfg)
+def _load_pipeline(cfg: ModuleType):
+    global PIPELINE
+
+    PIPELINE = cfg.PIPELINE
+
+
+def _setup_db(cfg: ModuleType):
+    global TASK_DB, WORKER_ID
+
+    TASK_DB = DB(cfg.MONGO_URI)
+    WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _setup_leases(cfg: ModuleType):
+    global HEARTBEAT_INTERVAL, LEASE_HORIZONS
+
+    HEARTBEAT_INTERVAL = cfg.LEASES['HEARTBEAT_INTERVAL']
+    LEASE_HORIZONS = cfg.LEASES['HORIZONS']
+
+
+def _setup_ext_tool_limits(cfg: ModuleType):
+    process_runner.configure(cfg.EXT_TOOL_LIMITS, cfg.EXT_TOOL_LOCK_DIR)
+
 
+def _setup_time_limits(cfg: ModuleType):
+    for actor_name, time_limit in cfg.JOB_TIME_LIMITS.items():
+        redis_broker.get_actor(actor_name).options['time_limit'] = time_limit * 1000
 
-@dramatiq.actor(time_limit=48000000, max_retries=0)
-def init_task_job(task_data: dict):
-    task = Task(task_data, LOGGER, EXT_TOOLS, TEMPLATE_FILES)
-    task.cur_step.process()
 
+def _error_class(name: str) -> Type[Exception]:
+    error_class = getattr(builtins, name, None) or getattr(process_runner, name, None)
+    if not (isinstance(error_class, type) and issubclass(error_class, Exception)):
+        raise ValueError(f'Unknown retryable error: {name}')
+    return error_class
 
-@dramatiq.actor(time_limit=48000000, max_retries=0)
-def dng_conversion_job(task_data: dict, image_name: str):
-    task = Task(task_data, LOGGER, EXT_TOOLS, TEMPLATE_FILES)
-    task.cur_step.process_image(image_name)
 
+def _should_retry(
+    max_retries: int, retryable: Tuple[Type[Exception]], retries: int, exception: Exception
+) -> bool:
+    """`retry_when` of actors, a batch is retried only if all its failures are retryable
 
-@dramatiq.actor(time_limit=48000000, max_retries=0)
-def color_correction_job(task_data: dict, image_name: str, swatch: ColourCheckerSwatchesData):
-    task = Task(task_data, LOGGER, EXT_TOOLS, TEMPLATE_FILES)
-    task.cur_step.process_image(image_name, swatch)
+    `retries` counts the retries done so far, 0 when the first attempt failed
+    """
+    if retries >= max_retries:
+        return False
+    if isinstance(exception, ImageProcessingError):
+        return all(isinstance(e, retryable) for e in exception.errors.values())
+    return isinstance(exception, retryable)
 
 
-@dramatiq.actor(time_limit=48000000, max_retries=0)
-def color_correction_single_job(task_data: dict):
-    task = Task(task_data, LOGGER, EXT_TOOLS, TEMPLATE_FILES)
-    task.cur_step.process()
+def _setup_retries(cfg: ModuleType):
+    for actor_name, policy in cfg.RETRY_POLICIES.items():
+        retryable = tuple(_error_class(name) for name in policy['RETRY_ON'])
+        options = redis_broker.get_actor(actor_name).options
+        options['max_retries'] = policy['MAX_RETRIES']
+        options['min_backoff'] = policy['MIN_BACKOFF'] * 1000
+        options['max_backoff'] = policy['MAX_BACKOFF'] * 1000
+        options['retry_when'] = partial(_should_retry, policy['MAX_RETRIES'], retryable)
 
 
-@dramatiq.actor(time_limit=48000000, max_retries=0)
-def prepare_rc_job(task_data: dict):
-    task = Task(task_data, LOGGER, EXT_TOOLS, TEMPLATE_FILES)
-    task.cur_step.process()
+def _setup_result_cache(cfg: ModuleType):
+    result_cache.configure(cfg.RESULT_CACHE['ROOT'], cfg.RESULT_CACHE['MAX_SIZE'])
 
 
-@dramatiq.actor(time_limit=48000000, max_retries=0)
-def mesh_construction_job(task_data: dict):
-    task = Task(task_data, LOGGER, EXT_TOOLS, TEMPLATE_FILES)
-    task.cur_step.process()
+def _setup_process_pool(cfg: ModuleType):
+    global PROCESS_POOL
+
+    if cfg.WORKER_PROCESS_POOL_SIZE:
+        PROCESS_POOL = ImageProcessPool(cfg.WORKER_PROCESS_POOL_SIZE)
+
+
+def setup_queues(cfg: ModuleType):
+    """Route actors to their queue of config, must run before sending or consuming jobs"""
+    for actor_name, queue_key in ACTOR_QUEUES.items():
+        queue_name = cfg.QUEUES[queue_key]
+        redis_broker.declare_queue(queue_name)
+        redis_broker.get_actor(actor_name).queue_name = queue_name
+
+
+def worker_command(cfg: ModuleType, pool: str, module: str = 'worker') -> List[str]:
+    """`dramatiq` command line starting worker `pool` of config on `module`"""
+    pool_cfg = cfg.WORKER_POOLS[pool]
+    return (
+        ['dramatiq', module]
+        + ['--processes', str(pool_cfg['PROCESSES'])]
+        + ['--threads', str(pool_cfg['THREADS'])]
+        + ['--queues'] + [cfg.QUEUES[key] for key in pool_cfg['QUEUES']]
+    )
+
+
+def _job_result(step: Step, succeeded: bool, image_names: List[str] = None) -> dict:
+    """Structured result of an actor, consumed by the coordinator"""
+    return {
+        TASK_ID_KEY: step.task.task_id,
+        TASK_STEP_KEY: step.step_id,
+        JOB_SUCCEEDED_KEY: bool(succeeded),
+        JOB_IMAGES_KEY: image_names or [],
+    }
+
+
+def _track_images(step: Step, image_names: List[str], process: Callable[[], bool]) -> bool:
+    """Run `process` over `image_names` of `step`, recording state of each image in DB"""
+
+    task_id = step.task.task_id
+    TASK_DB.images_started(task_id, step.step_id, image_names, WORKER_ID)
+    start = time.monotonic()
+    error = None
+    try:
+        return process()
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        # Images of a batch are processed together, e.g. by one DNG converter process
+        duration = (time.monotonic() - start) / max(len(image_names), 1)
+        errors = {}
+        for image_name in image_names:
+            if step.is_image_done(image_name):
+                errors[image_name] = None
+            elif isinstance(error, ImageProcessingError) and image_name in error.errors:
+                errors[image_name] = str(error.errors[image_name])
+            else:
+                errors[image_name] = str(error) if error else 'No valid output'
+        TASK_DB.images_finished(task_id, step.step_id, errors, duration)
+
+
+def setup_worker(cfg: ModuleType):
+    _setup_logger(cfg)
+    _load_ext_tools(cfg)
+    _load_template_files(cfg)
+    _load_pipeline(cfg)
+    _setup_db(cfg)
+    _setup_leases(cfg)
+    setup_queues(cfg)
+    _setup_ext_tool_limits(cfg)
+    _setup_time_limits(cfg)
+    _setup_retries(cfg)
+    _setup_result_cache(cfg)
+    _setup_process_pool(cfg)
+
+
+@dramatiq.actor(time_limit=48000000, max_retries=0, store_results=True)
+def init_task_job(task_data: dict) -> dict:
+    task = Task(task_data, LOGGER, EXT_TOOLS, TEMPLATE_FILES, PROCESS_POOL, PIPELINE)
+    step = task.cur_step
+    return _job_result(step, step.process())
+
+
+@dramatiq.actor(time_limit=48000000, max_retries=0, store_results=True)
+def dng_conversion_job(task_data: dict, image_names: List[str]) -> dict:
+    task = Task(task_data, LOGGER, EXT_TOOLS, TEMPLATE_FILES, PROCESS_POOL, PIPELINE)
+    step = task.get_step(StepIndex.DNG_CONVERSION.value)
+    succeeded = _track_images(step, image_names, lambda: step.process_images(image_names))
+    return _job_result(step, succeeded, image_names)
+
+
+@dramatiq.actor(time_limit=48000000, max_retries=0, store_results=True)
+def color_correction_job(task_data: dict, image_names: List[str]) -> dict:
+    task = Task(task_data, LOGGER, EXT_TOOLS, TEMPLATE_FILES, PROCESS_POOL, PIPELINE)
+    # Explicit step, the task may still be at DNG conversion when streaming
+    step = task.get_step(StepIndex.COLOR_CORRECTION.value)
+    succeeded = _track_images(
+        step, image_names, lambda: step.process_images(image_names, task_data[CC_MATRIX_KEY])
+    )
+    return _job_result(step, succeeded, image_names)
+
+
+@dramatiq.actor(time_limit=48000000, max_retries=0, store_results=True)
+def color_correction_single_job(task_data: dict) -> dict:
+    task = Task(task_data, LOGGER, EXT_TOOLS, TEMPLATE_FILES, PROCESS_POOL, PIPELINE)
+    step = task.cur_step
+    return _job_result(step, _track_images(step, step.pending_images(), step.process))
+
+
+@dramatiq.actor(time_limit=48000000, max_retries=0, store_results=True)
+def prepare_rc_job(task_data: dict) -> dict:
+    task = Task(task_data, LOGGER, EXT_TOOLS, TEMPLATE_FILES, PROCESS_POOL, PIPELINE)
+    step = task.cur_step
+    return _job_result(step, step.process())
+
+
+@dramatiq.actor(time_limit=48000000, max_retries=0, store_results=True)
+def mesh_construction_job(task_data: dict) -> dict:
+    task = Task(task_data, LOGGER, EXT_TOOLS, TEMPLATE_FILES, PROCESS_POOL, PIPELINE)
+    step = task.cur_step
+    return _job_result(step, step.process())
@@ -0,0 +1,34 @@
+import importlib.util
+from pathlib import Path
+
+import mongomock
+import pytest
+
+from photogrammetry_service import db as db_module
+
+MONGO_URI = 'mongodb://localhost:27017/'
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # Every `DB` of a test shares the same in-memory server
+    mongo_client = mongomock.MongoClient(MONGO_URI)
+    monkeypatch.setattr(db_module, 'MongoClient', lambda uri: mongo_client)
+    return mongo_client
+
+
+@pytest.fixture
+def cfg(tmp_path):
+    """`config` of the repository, writing logs and locks under `tmp_path`"""
+    spec = importlib.util.spec_from_file_location(
+        'config', Path(__file__).parents[1].joinpath('config.py')
+    )
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    config.LOG_DIR = tmp_path.joinpath('log').as_posix()
+    config.COORDINATOR_LOG = f'{config.LOG_DIR}/coordinator.log'
+    config.WORKER_LOG = f'{config.LOG_DIR}/worker.log'
+    config.EXT_TOOL_LOCK_DIR = tmp_path.joinpath('lock').as_posix()
+    config.MONGO_URI = MONGO_URI
+    config.FS_WATCHER = dict(config.FS_WATCHER, ENABLED=False, DEBOUNCE=0)
+    return config
@@ -0,0 +1,206 @@
+import pytest
+
+from photogrammetry_service.db import DB, InvalidCursor
+from photogrammetry_service.task import (
+    DEADLINE_KEY,
+    FAILED_IMAGES_KEY,
+    IMG_PROGRESS_COMPLETED_KEY,
+    IMG_PROGRESS_KEY,
+    INVALIDATE_STEP_KEY,
+    LATEST_TASK_ID_KEY,
+    PAUSED_KEY,
+    PRIORITY_KEY,
+    STEP_IN_PROGRESS_KEY,
+    TASK_ID_KEY,
+    TASK_STEP_KEY,
+    StepIndex,
+)
+
+MONGO_URI = 'mongodb://localhost:27017/'
+
+
+@pytest.fixture
+def db(client):
+    return DB(MONGO_URI)
+
+
+def _task(step=0, priority=0):
+    return {
+        TASK_STEP_KEY: step,
+        STEP_IN_PROGRESS_KEY: False,
+        PAUSED_KEY: False,
+        PRIORITY_KEY: priority,
+    }
+
+
+def test_add_tasks_allocates_ids(db):
+    assert db.add_task(_task()) == 0
+    assert db.add_tasks([_task(), _task()]) == [1, 2]
+    assert db.get_latest_task_id() == 2
+
+
+def test_duplicate_task_ids_are_moved(client):
+    tasks = client.photogrammetry_service.tasks
+    tasks.insert_many([{TASK_ID_KEY: 0}, {TASK_ID_KEY: 1, 'location': 'a'}])
+    tasks.insert_many([{TASK_ID_KEY: 1, 'location': 'b'}, {TASK_ID_KEY: 1, 'location': 'c'}])
+    client.photogrammetry_service.state.insert_one({LATEST_TASK_ID_KEY: 1})
+
+    db = DB(MONGO_URI)
+    ids = {t['location']: t[TASK_ID_KEY] for t in db.ls_tasks() if 'location' in t}
+    assert ids == {'a': 1, 'b': 2, 'c': 3}
+    assert db.add_task(_task()) == 4
+
+
+def test_concurrent_duplicate_migration(client, monkeypatch):
+    tasks = client.photogrammetry_service.tasks
+    tasks.create_index(TASK_ID_KEY)
+    tasks.insert_many([{TASK_ID_KEY: 0, 'location': 'a'}, {TASK_ID_KEY: 0, 'location': 'b'}])
+    index_information = tasks.index_information()
+    duplicates = list(
+        tasks.aggregate([{'$group': {'_id': f'${TASK_ID_KEY}', 'ids': {'$push': '$_id'}}}])
+    )
+
+    DB(MONGO_URI)
+    # Another process started at the same time, it saw the old index and duplicates
+    with monkeypatch.context() as m:
+        m.setattr(type(tasks), 'index_information', lambda self: index_information)
+        m.setattr(type(tasks), 'aggregate', lambda self, pipeline: iter(duplicates))
+        db = DB(MONGO_URI)
+
+    assert {t['location']: t[TASK_ID_KEY] for t in db.ls_tasks()} == {'a': 0, 'b': 1}
+    assert 'unique' in tasks.index_information()[f'{TASK_ID_KEY}_1']
+
+
+def test_state_is_not_behind_existing_tasks(client):
+    client.photogrammetry_service.tasks.insert_one({TASK_ID_KEY: 7})
+    assert DB(MONGO_URI).add_task(_task()) == 8
+
+
+def test_find_tasks_pages(db):
+    db.add_tasks([_task(priority=i % 3) for i in range(7)])
+
+    pages, cursor = [], None
+    while 1:
+        tasks, cursor = db.find_tasks(
+            sort_key=PRIORITY_KEY, descending=True, limit=3, cursor=cursor
+        )
+        pages.append([t[TASK_ID_KEY] for t in tasks])
+        if not cursor:
+            break
+    # Ties on priority are ordered by task ID, in the sort direction
+    assert pages == [[5, 2, 4], [1, 6, 3], [0]]
+
+
+def _pages(db, **kwargs):
+    pages, cursor = [], None
+    while 1:
+        tasks, cursor = db.find_tasks(limit=2, cursor=cursor, **kwargs)
+        pages.append([t[TASK_ID_KEY] for t in tasks])
+        if not cursor:
+            return pages
+
+
+def test_find_tasks_pages_null_values(client, db):
+    # Tasks without deadline, and older tasks without priority
+    db.add_tasks([{**_task(), DEADLINE_KEY: deadline} for deadline in [None, 3, None, 1, None, 2]])
+    client.photogrammetry_service.tasks.update_many(
+        {TASK_ID_KEY: {'$in': [1, 4]}}, {'$unset': {PRIORITY_KEY: ''}}
+    )
+
+    assert _pages(db, sort_key=DEADLINE_KEY) == [[0, 2], [4, 3], [5, 1], []]
+    assert _pages(db, sort_key=DEADLINE_KEY, descending=True) == [[1, 5], [3, 4], [2, 0], []]
+    assert _pages(db, sort_key=PRIORITY_KEY) == [[1, 4], [0, 2], [3, 5], []]
+
+
+def test_find_tasks_filters_and_fields(db):
+    db.add_tasks([_task(step=1), _task(step=2), _task(step=2)])
+    tasks, cursor = db.find_tasks({TASK_STEP_KEY: 2}, fields=[PAUSED_KEY])
+    assert tasks == [{TASK_ID_KEY: 1, PAUSED_KEY: False}, {TASK_ID_KEY: 2, PAUSED_KEY: False}]
+    assert cursor is None
+
+
+def test_find_tasks_invalid_args(db):
+    with pytest.raises(ValueError):
+        db.find_tasks(sort_key='task_location')
+    with pytest.raises(ValueError):
+        db.find_tasks(limit=-1)
+    with pytest.raises(InvalidCursor):
+        db.find_tasks(cursor='not a cursor')
+
+
+def _apply(client, operations):
+    """`DB.bulk_update_tasks()`, one operation at a time as mongomock lacks `bulk_write()`
+    of recent pymongo
+    """
+    for op in operations:
+        client.photogrammetry_service.tasks.update_one(op._filter, op._doc)
+
+
+def test_task_update_compare_and_set(client, db):
+    task_id = db.add_task(_task(step=3))
+    state = {TASK_STEP_KEY: 3, STEP_IN_PROGRESS_KEY: False, PAUSED_KEY: False}
+    admit = db.task_update(task_id, {STEP_IN_PROGRESS_KEY: True}, expected=state)
+    progress = db.image_progress_update(
+        task_id, 2, expected={**state, STEP_IN_PROGRESS_KEY: True}
+    )
+
+    # Paused by API in between, neither update applies
+    db.set_task_fields(task_id, {PAUSED_KEY: True})
+    _apply(client, [admit, progress])
+    task_data = db.get_task(task_id)
+    assert not task_data[STEP_IN_PROGRESS_KEY]
+    assert IMG_PROGRESS_KEY not in task_data
+
+    db.set_task_fields(task_id, {PAUSED_KEY: False})
+    _apply(client, [admit, progress])
+    task_data = db.get_task(task_id)
+    assert task_data[STEP_IN_PROGRESS_KEY]
+    assert task_data[IMG_PROGRESS_KEY] == {IMG_PROGRESS_COMPLETED_KEY: 2}
+
+
+def test_restart_tasks_from_scratch(db):
+    db.add_tasks([_task(step=3), _task(step=5)])
+    failed_images = {'DNG_CONVERSION': ['a']}
+    db.set_task_fields(0, {STEP_IN_PROGRESS_KEY: True, FAILED_IMAGES_KEY: failed_images})
+
+    assert db.restart_tasks([0]) == 1
+    task_data = db.get_task(0)
+    assert task_data[TASK_STEP_KEY] == StepIndex.NOT_STARTED.value
+    assert not task_data[STEP_IN_PROGRESS_KEY]
+    assert task_data[FAILED_IMAGES_KEY] == {}
+    assert INVALIDATE_STEP_KEY not in task_data
+    assert db.get_task(1)[TASK_STEP_KEY] == 5
+
+
+def test_restart_tasks_from_step(db):
+    db.add_tasks([_task(step=4), _task(step=1), _task(step=5), _task(step=4)])
+    failed_images = {'DNG_CONVERSION': ['a'], 'COLOR_CORRECTION': ['b']}
+    db.set_task_fields(0, {PAUSED_KEY: True, FAILED_IMAGES_KEY: failed_images})
+    db.set_task_fields(3, {STEP_IN_PROGRESS_KEY: True})
+
+    # Task 1 did not reach the step, task 3 is running one
+    step_id = StepIndex.COLOR_CORRECTION.value
+    assert db.restart_tasks(None, step_id) == 2
+    task_data = db.get_task(0)
+    assert task_data[TASK_STEP_KEY] == step_id
+    assert task_data[INVALIDATE_STEP_KEY] == step_id
+    assert not task_data[PAUSED_KEY]
+    assert task_data[FAILED_IMAGES_KEY] == {'DNG_CONVERSION': ['a']}
+    assert db.get_task(2)[INVALIDATE_STEP_KEY] == step_id
+    assert db.get_task(1)[TASK_STEP_KEY] == 1
+    assert db.get_task(3)[TASK_STEP_KEY] == 4
+    assert db.restart_tasks([3], step_id) == 0
+
+
+def test_restart_tasks_from_step_waits_for_running_jobs(db):
+    db.add_tasks([_task(step=4), _task(step=4)])
+    db.renew_lease('message0', 0, 4, 'worker0', 60)
+    db.renew_lease('message1', 1, 4, 'worker0', -1)
+
+    # Lease of task 1 expired, its worker is gone
+    assert db.leased_task_ids() == {0}
+    assert db.restart_tasks([0, 1], StepIndex.PREPARE_RC.value) == 1
+    assert db.get_task(0)[TASK_STEP_KEY] == 4
+    assert db.get_task(1)[TASK_STEP_KEY] == StepIndex.PREPARE_RC.value
+    # Restarting from scratch keeps outputs, it does not need to wait
+    assert db.restart_tasks([0]) == 1
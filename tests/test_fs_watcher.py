@@ -0,0 +1,91 @@
+import time
+
+from photogrammetry_service.fs_watcher import TaskWatcher
+
+
+def _watcher(changes, debounce=0):
+    # Not started, so locations are polled and `_poll()`/`_flush()` are driven by the test
+    return TaskWatcher(lambda task_id, directory: changes.append((task_id, directory)), debounce)
+
+
+def test_poll_reports_new_files(tmp_path):
+    raw_dir = tmp_path.joinpath('task0', '1_RAW')
+    raw_dir.mkdir(parents=True)
+    changes = []
+    watcher = _watcher(changes)
+    watcher.watch(0, tmp_path.joinpath('task0'))
+
+    watcher._poll()
+    watcher._flush()
+    assert changes == []
+
+    raw_dir.joinpath('DSC0.ARW').write_bytes(b'raw')
+    raw_dir.joinpath('DSC1.ARW').write_bytes(b'raw')
+    watcher._poll()
+    watcher._flush()
+    # A single notification per changed folder
+    assert changes == [(0, raw_dir)]
+
+    # Deleted files bring nothing to process
+    raw_dir.joinpath('DSC0.ARW').unlink()
+    watcher._poll()
+    watcher._flush()
+    assert changes == [(0, raw_dir)]
+
+
+def test_poll_reports_new_step_folder(tmp_path):
+    location = tmp_path.joinpath('task0')
+    location.mkdir()
+    changes = []
+    watcher = _watcher(changes)
+    watcher.watch(0, location)
+
+    location.joinpath('1_RAW').mkdir()
+    watcher._poll()
+    watcher._flush()
+    assert changes == [(0, location)]
+
+
+def test_debounce(tmp_path):
+    location = tmp_path.joinpath('task0')
+    location.mkdir()
+    changes = []
+    watcher = _watcher(changes, debounce=0.2)
+    watcher.watch(0, location)
+
+    location.joinpath('color_checker.ARW').write_bytes(b'raw')
+    watcher._poll()
+    watcher._flush()
+    assert changes == []
+    time.sleep(0.2)
+    watcher._flush()
+    assert changes == [(0, location)]
+
+
+def test_sync_unwatches_other_tasks(tmp_path):
+    for task_id in range(2):
+        tmp_path.joinpath(f'task{task_id}').mkdir()
+    changes = []
+    watcher = _watcher(changes)
+    watcher.sync({task_id: tmp_path.joinpath(f'task{task_id}') for task_id in range(2)})
+    watcher.sync({1: tmp_path.joinpath('task1')})
+
+    for task_id in range(2):
+        tmp_path.joinpath(f'task{task_id}', 'DSC0.ARW').write_bytes(b'raw')
+    watcher._poll()
+    watcher._flush()
+    assert changes == [(1, tmp_path.joinpath('task1'))]
+
+
+def test_missing_location_is_watched_once_created(tmp_path):
+    location = tmp_path.joinpath('task0')
+    changes = []
+    watcher = _watcher(changes)
+    watcher.sync({0: location})
+
+    location.mkdir()
+    watcher.sync({0: location})
+    location.joinpath('DSC0.ARW').write_bytes(b'raw')
+    watcher._poll()
+    watcher._flush()
+    assert changes == [(0, location)]
@@ -0,0 +1,99 @@
+import ctypes
+import logging
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from photogrammetry_service import process_runner
+from photogrammetry_service.process_runner import ToolSlot, ToolTimeoutError, run_tool
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture(autouse=True)
+def limits(tmp_path, monkeypatch):
+    monkeypatch.setattr(process_runner, 'TOOL_LIMITS', {})
+    monkeypatch.setattr(process_runner, 'MONITOR_INTERVAL', 0.05)
+    monkeypatch.setattr(process_runner, 'LOCK_POLL_INTERVAL', 0.05)
+    process_runner.configure(
+        {'STUB': {'MAX_INSTANCES': 1, 'TIMEOUT': 5}, 'SLOW': {'TIMEOUT': 0.2}},
+        tmp_path.joinpath('lock'),
+    )
+
+
+def _python(code):
+    return [sys.executable, '-c', code]
+
+
+def _wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_run_tool(caplog):
+    logger = logging.getLogger(__name__)
+    with caplog.at_level(logging.INFO, logger=__name__):
+        result = run_tool('STUB', _python('print("converted"); exit(3)'), logger)
+    assert result.returncode == 3
+    assert result.wall_time > 0
+    assert '[STUB] converted' in caplog.messages
+
+
+def test_run_tool_timeout():
+    start = time.monotonic()
+    with pytest.raises(ToolTimeoutError):
+        run_tool('SLOW', _python('import time; time.sleep(30)'))
+    assert time.monotonic() - start < 5
+
+
+def test_slot_is_shared():
+    acquired = threading.Event()
+
+    def acquire():
+        with ToolSlot('STUB', 1):
+            acquired.set()
+
+    with ToolSlot('STUB', 1):
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        assert not acquired.wait(0.3)
+    thread.join(5)
+    assert acquired.is_set()
+    # Another slot is free when more instances are allowed
+    with ToolSlot('STUB', 2), ToolSlot('STUB', 2):
+        pass
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='checks the process with a null signal')
+def test_interrupted_run_kills_process(tmp_path):
+    # Job time limit and worker shutdown are raised asynchronously into the job's thread
+    pid_file = tmp_path.joinpath('pid')
+    code = f'import os, time; open({str(pid_file)!r}, "w").write(str(os.getpid())); time.sleep(30)'
+    errors = []
+
+    def run():
+        try:
+            run_tool('STUB', _python(code))
+        except Interrupted as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    _wait_for(lambda: pid_file.exists() and pid_file.read_text())
+    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+        ctypes.c_ulong(thread.ident), ctypes.py_object(Interrupted)
+    )
+    thread.join(5)
+
+    assert errors
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+    with ToolSlot('STUB', 1):
+        pass
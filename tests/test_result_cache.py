@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from photogrammetry_service import result_cache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    result_cache.configure(tmp_path.joinpath('cache'), 10 ** 6)
+    result_cache._last_evict = 0.0
+    yield tmp_path.joinpath('cache')
+    result_cache.configure(None, 0)
+
+
+def _write(path, content: bytes):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return path
+
+
+def test_key(tmp_path, cache):
+    a = _write(tmp_path.joinpath('a', 'DSC0.ARW'), b'raw')
+    b = _write(tmp_path.joinpath('b', 'DSC9.ARW'), b'raw')
+    c = _write(tmp_path.joinpath('c', 'DSC0.ARW'), b'other raw')
+
+    # Same content under another name or folder shares the key
+    assert result_cache.key(a, {'ccm': '1'}) == result_cache.key(b, {'ccm': '1'})
+    assert result_cache.key(a, {'ccm': '1'}) != result_cache.key(c, {'ccm': '1'})
+    assert result_cache.key(a, {'ccm': '1'}) != result_cache.key(a, {'ccm': '2'})
+
+
+def test_key_follows_content_change(tmp_path, cache):
+    a = _write(tmp_path.joinpath('DSC0.ARW'), b'raw')
+    old_key = result_cache.key(a, {})
+    _write(a, b'new raw')
+    os.utime(a, ns=(os.stat(a).st_atime_ns, os.stat(a).st_mtime_ns + 10 ** 9))
+    assert result_cache.key(a, {}) != old_key
+
+
+def test_store_fetch(tmp_path, cache):
+    output = _write(tmp_path.joinpath('task0', 'DSC0.dng'), b'dng')
+    target = tmp_path.joinpath('task1', 'DSC0.dng')
+
+    assert not result_cache.fetch('ab' * 32, target)
+    result_cache.store('ab' * 32, output)
+    assert result_cache.fetch('ab' * 32, target)
+    assert target.read_bytes() == b'dng'
+    assert not list(target.parent.glob('.*.tmp'))
+
+
+def test_disabled(tmp_path):
+    result_cache.configure(None, 0)
+    output = _write(tmp_path.joinpath('DSC0.dng'), b'dng')
+    result_cache.store('ab' * 32, output)
+    assert not result_cache.enabled()
+    assert not result_cache.fetch('ab' * 32, tmp_path.joinpath('other.dng'))
+
+
+def test_evict_least_recently_used(tmp_path, cache):
+    result_cache.configure(cache, 25)
+    for i, name in enumerate(['aa', 'bb', 'cc']):
+        output = _write(tmp_path.joinpath(f'{name}.jpg'), b'x' * 10)
+        result_cache.store(name * 32, output)
+        entry = cache.joinpath(name, f'{name * 32}.jpg')
+        os.utime(entry, ns=(i * 10 ** 9, i * 10 ** 9))
+    # Fetching marks `aa` as the most recently used
+    assert result_cache.fetch('aa' * 32, tmp_path.joinpath('fetched.jpg'))
+
+    result_cache.evict()
+    assert result_cache.fetch('aa' * 32, tmp_path.joinpath('aa2.jpg'))
+    assert not result_cache.fetch('bb' * 32, tmp_path.joinpath('bb2.jpg'))
+    assert result_cache.fetch('cc' * 32, tmp_path.joinpath('cc2.jpg'))
@@ -0,0 +1,124 @@
+import logging
+import os
+import sys
+from collections import OrderedDict
+
+import pytest
+
+from photogrammetry_service import task as task_module
+from photogrammetry_service.task import (
+    PAUSED_KEY,
+    TASK_ID_KEY,
+    TASK_LOCATION_KEY,
+    TASK_STEP_KEY,
+    DirectoryInventory,
+    ImageProcessingError,
+    StepIndex,
+    Task,
+)
+
+# Stands in for the DNG converter: `-d <output dir> <raw images>...`, fails on FAIL images
+STUB_CONVERTER = f'''#!{sys.executable}
+import os, shutil, sys
+args = sys.argv[1:]
+output_dir = args[args.index('-d') + 1]
+for raw in args[args.index('-d') + 2:]:
+    if 'FAIL' not in raw:
+        name = os.path.splitext(os.path.basename(raw))[0]
+        shutil.copy(raw, os.path.join(output_dir, name + '.dng'))
+'''
+
+
+def _write(path, content: bytes = b'raw'):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    return path
+
+
+def test_inventory_groups_images_by_extension(tmp_path):
+    _write(tmp_path.joinpath('DSC0.ARW'))
+    _write(tmp_path.joinpath('DSC1.ARW'))
+    _write(tmp_path.joinpath('DSC0.dng'))
+    _write(tmp_path.joinpath('notes.txt.bak'))
+    tmp_path.joinpath('DSC2.ARW').mkdir()
+
+    inventory = DirectoryInventory(tmp_path)
+    assert inventory.names('ARW') == {'DSC0', 'DSC1'}
+    assert inventory.images('dng') == {'DSC0': tmp_path.joinpath('DSC0.dng')}
+    assert inventory.files('ARW')['DSC1'].size == 3
+    assert inventory.count('jpg') == 0
+
+
+def test_inventory_sees_new_images(tmp_path):
+    inventory = DirectoryInventory(tmp_path)
+    assert inventory.count('ARW') == 0
+    # Within mtime resolution of the last listing, the directory is listed again
+    _write(tmp_path.joinpath('DSC0.ARW'))
+    assert inventory.names('ARW') == {'DSC0'}
+
+
+def test_inventory_missing_directory(tmp_path):
+    inventory = DirectoryInventory(tmp_path.joinpath('missing'))
+    assert inventory.names('ARW') == set()
+
+
+def test_inventory_cache_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(task_module, 'INVENTORY_CACHE_SIZE', 2)
+    monkeypatch.setattr(DirectoryInventory, '_inventories', OrderedDict())
+    inventories = [DirectoryInventory.of(tmp_path.joinpath(f'task{i}')) for i in range(2)]
+    DirectoryInventory.of(tmp_path.joinpath('task0'))
+
+    # Least recently used `task1` is dropped
+    DirectoryInventory.of(tmp_path.joinpath('task2'))
+    assert DirectoryInventory.of(tmp_path.joinpath('task0')) is inventories[0]
+    assert DirectoryInventory.of(tmp_path.joinpath('task1')) is not inventories[1]
+
+
+def test_inventory_of_is_shared(tmp_path):
+    inventory = DirectoryInventory.of(tmp_path)
+    assert DirectoryInventory.of(tmp_path.joinpath('.')) is inventory
+    DirectoryInventory.invalidate(tmp_path)
+    assert DirectoryInventory.of(tmp_path) is not inventory
+
+
+@pytest.fixture
+def converter(tmp_path):
+    path = tmp_path.joinpath('dng_converter')
+    path.write_text(STUB_CONVERTER)
+    os.chmod(path, 0o755)
+    return path
+
+
+def _dng_conversion_step(location, converter):
+    task_data = {
+        TASK_ID_KEY: 0,
+        TASK_LOCATION_KEY: location.as_posix(),
+        TASK_STEP_KEY: StepIndex.DNG_CONVERSION.value,
+        PAUSED_KEY: False,
+    }
+    task = Task(task_data, logging.getLogger(__name__), {'DNG_CONVERTER': converter}, {})
+    return task.cur_step
+
+
+def test_dng_conversion_batch(tmp_path, converter):
+    location = tmp_path.joinpath('task0')
+    step = _dng_conversion_step(location, converter)
+    for name in ['DSC0', 'DSC1', 'DSC2']:
+        _write(step.input_dir.joinpath(f'{name}.ARW'))
+
+    assert step.process_images(['DSC0', 'DSC1'])
+    assert step.pending_images() == ['DSC2']
+    assert sorted(os.listdir(step.output_dir)) == ['DSC0.dng', 'DSC1.dng']
+
+
+def test_dng_conversion_batch_partial_failure(tmp_path, converter):
+    location = tmp_path.joinpath('task0')
+    step = _dng_conversion_step(location, converter)
+    for name in ['DSC0', 'FAIL1']:
+        _write(step.input_dir.joinpath(f'{name}.ARW'))
+
+    with pytest.raises(ImageProcessingError) as exc_info:
+        step.process_images(['DSC0', 'FAIL1'])
+    # Converted images of the batch are kept, no temporary folder is left
+    assert list(exc_info.value.errors) == ['FAIL1']
+    assert os.listdir(step.output_dir) == ['DSC0.dng']
@@ -0,0 +1,365 @@
+import numpy as np
+import pytest
+from dramatiq.results import ResultMissing
+
+from photogrammetry_service import worker
+from photogrammetry_service.db import DB
+from photogrammetry_service.task import (
+    ERROR_KEY,
+    FAILED_IMAGES_KEY,
+    IMG_PROGRESS_COMPLETED_KEY,
+    IMG_PROGRESS_KEY,
+    IMG_PROGRESS_TOTAL_KEY,
+    JOB_IMAGES_KEY,
+    JOB_SUCCEEDED_KEY,
+    PAUSED_KEY,
+    PRIORITY_KEY,
+    REQ_COLOR_CHECKER_KEY,
+    REQ_RAW_IMAGE_KEY,
+    REQUIRE_KEY,
+    STEP_IN_PROGRESS_KEY,
+    TASK_ID_KEY,
+    TASK_LOCATION_KEY,
+    TASK_STEP_KEY,
+    StepIndex,
+)
+from photogrammetry_service.task_coordinator import (
+    Coordinator,
+    DatabaseAdapter,
+    _changed_fields,
+)
+
+
+class StubBroker(object):
+    """Messages sent by the coordinator, and results of their actors"""
+
+    def __init__(self):
+        self.sent = []
+        self.results = {}
+
+    def send(self, actor, *args):
+        message = actor.message(*args)
+        self.sent.append(message)
+        return message
+
+    def get_result(self, message, block=False, timeout=None):
+        if message.message_id not in self.results:
+            raise ResultMissing(message)
+        result = self.results[message.message_id]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def sent_jobs(self, actor_name=None):
+        """`(actor name, images)` of sent messages"""
+        return [
+            (m.actor_name, m.args[1] if len(m.args) > 1 else [])
+            for m in self.sent
+            if actor_name in (None, m.actor_name)
+        ]
+
+    def finish(self, message, succeeded=True):
+        task_data = message.args[0]
+        self.results[message.message_id] = {
+            TASK_ID_KEY: task_data[TASK_ID_KEY],
+            TASK_STEP_KEY: task_data[TASK_STEP_KEY],
+            JOB_SUCCEEDED_KEY: succeeded,
+            JOB_IMAGES_KEY: message.args[1] if len(message.args) > 1 else [],
+        }
+
+
+def _bulk_update_tasks(self, operations):
+    # mongomock lacks `bulk_write()` of recent pymongo
+    for op in operations:
+        self._db.tasks.update_one(op._filter, op._doc)
+
+
+@pytest.fixture
+def broker(monkeypatch):
+    stub = StubBroker()
+    for actor_name in worker.ACTOR_QUEUES:
+        actor = worker.redis_broker.get_actor(actor_name)
+        monkeypatch.setattr(actor, 'send', lambda *args, actor=actor: stub.send(actor, *args))
+    monkeypatch.setattr(worker.result_backend, 'get_result', stub.get_result)
+    return stub
+
+
+@pytest.fixture
+def make_coordinator(client, cfg, broker, monkeypatch):
+    """Build a coordinator from `cfg`, as changed by the test"""
+    monkeypatch.setattr(DB, 'bulk_update_tasks', _bulk_update_tasks)
+    return lambda: Coordinator(cfg)
+
+
+@pytest.fixture
+def coordinator(make_coordinator):
+    return make_coordinator()
+
+
+def _add_task(coordinator, location, step, priority=0, **fields):
+    task_data = {
+        TASK_LOCATION_KEY: location.as_posix(),
+        PRIORITY_KEY: priority,
+        TASK_STEP_KEY: step,
+        STEP_IN_PROGRESS_KEY: False,
+        REQUIRE_KEY: {REQ_COLOR_CHECKER_KEY: False, REQ_RAW_IMAGE_KEY: False},
+        PAUSED_KEY: False,
+        IMG_PROGRESS_KEY: {IMG_PROGRESS_COMPLETED_KEY: 0, IMG_PROGRESS_TOTAL_KEY: 0},
+        **fields,
+    }
+    return coordinator._db.add_task(task_data)
+
+
+def _write_images(directory, names, ext):
+    directory.mkdir(parents=True, exist_ok=True)
+    for name in names:
+        directory.joinpath(f'{name}.{ext}').write_bytes(b'image')
+
+
+def _pass(coordinator, task_ids=None):
+    """A pass of `Coordinator.run()`"""
+    coordinator._collect_results()
+    coordinator.coordinate_tasks(task_ids)
+
+
+def test_changed_fields():
+    old = {'step': 1, 'paused': False, 'error': 'x', 'progress': {'completed': 1, 'total': 9}}
+    new = {'step': 2, 'paused': False, 'progress': {'completed': 3, 'total': 9}}
+    assert _changed_fields(old, new) == ({'step': 2, 'progress.completed': 3}, ['error'])
+
+
+def test_changed_fields_nested():
+    old = {'require': {'raw_image': True}, 'failed_images': {'DNG_CONVERSION': ['a']}}
+    new = {'require': {'raw_image': False, 'color_checker': False}, 'failed_images': {}}
+    set_fields, unset_fields = _changed_fields(old, new)
+    assert set_fields == {'require.raw_image': False, 'require.color_checker': False}
+    assert unset_fields == ['failed_images.DNG_CONVERSION']
+
+
+def test_changed_fields_replaced_value():
+    # A dict replacing a scalar, or the opposite, is set as a whole
+    assert _changed_fields({'a': 1, 'b': {'c': 1}}, {'a': {'c': 1}, 'b': 2}) == (
+        {'a': {'c': 1}, 'b': 2},
+        [],
+    )
+    assert _changed_fields({'a': [1]}, {'a': [1]}) == ({}, [])
+
+
+def test_jobs_are_reattached_after_restart(tmp_path, make_coordinator, broker):
+    coordinator = make_coordinator()
+    task_id = _add_task(coordinator, tmp_path.joinpath('task0'), StepIndex.PREPARE_RC.value)
+    _pass(coordinator)
+    assert broker.sent_jobs() == [('prepare_rc_job', [])]
+    assert [job[TASK_ID_KEY] for job in coordinator._db.ls_jobs()] == [task_id]
+
+    # The job fails while the coordinator is down
+    broker.results[broker.sent[0].message_id] = RuntimeError('RealityCapture crashed')
+    restarted = make_coordinator()
+    restarted.reattach_jobs()
+    _pass(restarted)
+
+    task_data = restarted._db.get_task(task_id)
+    assert task_data[PAUSED_KEY]
+    assert not task_data[STEP_IN_PROGRESS_KEY]
+    assert 'RealityCapture crashed' in task_data[ERROR_KEY]
+    assert restarted._db.ls_jobs() == []
+
+
+def test_restart_from_step_waits_for_running_jobs(tmp_path, coordinator, broker):
+    location = tmp_path.joinpath('task0')
+    task_id = _add_task(coordinator, location, StepIndex.PREPARE_RC.value)
+    adapter = DatabaseAdapter(coordinator._db)
+    _pass(coordinator)
+    rc_project = location.joinpath('4_PREPARE_RC', 'project.rcproj')
+    rc_project.write_bytes(b'being written')
+
+    status, _, message = adapter.restart_task(task_id, step_id=StepIndex.PREPARE_RC.value)
+    assert (status, message) == ('error', f'Task {task_id} is running a step, pause it first')
+
+    adapter.pause_task(task_id)
+    _pass(coordinator)
+    status, _, _ = adapter.restart_task(task_id, step_id=StepIndex.PREPARE_RC.value)
+    assert status == 'success'
+    _pass(coordinator)
+    # Job of the paused task still runs, its outputs are kept and nothing is sent
+    assert rc_project.exists()
+    assert len(broker.sent) == 1
+
+    broker.finish(broker.sent[0])
+    _pass(coordinator)
+    assert not rc_project.exists()
+    assert broker.sent_jobs() == [('prepare_rc_job', []), ('prepare_rc_job', [])]
+
+
+def test_dispatch_by_capacity_and_priority(tmp_path, cfg, make_coordinator, broker):
+    cfg.SCHEDULER_CAPACITY = dict(cfg.SCHEDULER_CAPACITY, RC=1)
+    cfg.PIPELINE = dict(cfg.PIPELINE, STREAMING=False)
+    coordinator = make_coordinator()
+    low = _add_task(coordinator, tmp_path.joinpath('low'), StepIndex.PREPARE_RC.value)
+    high = _add_task(coordinator, tmp_path.joinpath('high'), StepIndex.PREPARE_RC.value, 5)
+    location = tmp_path.joinpath('dng')
+    _write_images(location.joinpath('1_RAW'), ['DSC0'], 'ARW')
+    dng = _add_task(coordinator, location, StepIndex.DNG_CONVERSION.value)
+
+    _pass(coordinator)
+    # A single RealityCapture job at a time, DNG conversion does not wait behind it
+    assert [(m.actor_name, m.args[0][TASK_ID_KEY]) for m in broker.sent] == [
+        ('prepare_rc_job', high),
+        ('dng_conversion_job', dng),
+    ]
+    assert coordinator._db.get_task(low)[STEP_IN_PROGRESS_KEY]
+
+    broker.finish(broker.sent[0])
+    _pass(coordinator)
+    assert broker.sent[-1].actor_name == 'prepare_rc_job'
+    assert broker.sent[-1].args[0][TASK_ID_KEY] == low
+
+
+def test_streaming_chains_color_correction(tmp_path, cfg, make_coordinator, broker):
+    cfg.PIPELINE = dict(
+        cfg.PIPELINE, STREAMING=True, DNG_CONVERSION_BATCH_SIZE=2, COLOR_CORRECTION_BATCH_SIZE=2
+    )
+    coordinator = make_coordinator()
+    location = tmp_path.joinpath('task0')
+    location.joinpath('cache').mkdir(parents=True)
+    np.save(location.joinpath('cache', 'color_correction_matrix.npy').as_posix(), np.eye(3))
+    images = ['DSC0', 'DSC1', 'DSC2']
+    _write_images(location.joinpath('1_RAW'), images, 'ARW')
+    task_id = _add_task(coordinator, location, StepIndex.DNG_CONVERSION.value)
+
+    _pass(coordinator)
+    assert broker.sent_jobs() == [
+        ('dng_conversion_job', ['DSC0', 'DSC1']),
+        ('dng_conversion_job', ['DSC2']),
+    ]
+    dng_jobs = list(broker.sent)
+
+    # Converted images are color corrected without waiting for the whole step
+    _write_images(location.joinpath('2_DNG'), ['DSC0', 'DSC1'], 'dng')
+    broker.finish(dng_jobs[0])
+    _pass(coordinator)
+    assert broker.sent_jobs('color_correction_job') == [('color_correction_job', ['DSC0', 'DSC1'])]
+    task_data = coordinator._db.get_task(task_id)
+    assert task_data[TASK_STEP_KEY] == StepIndex.DNG_CONVERSION.value
+    assert task_data[IMG_PROGRESS_KEY] == {
+        IMG_PROGRESS_COMPLETED_KEY: 0,
+        IMG_PROGRESS_TOTAL_KEY: 3,
+    }
+
+    _write_images(location.joinpath('2_DNG'), ['DSC2'], 'dng')
+    broker.finish(dng_jobs[1])
+    _pass(coordinator)
+    assert broker.sent_jobs('color_correction_job') == [
+        ('color_correction_job', ['DSC0', 'DSC1']),
+        ('color_correction_job', ['DSC2']),
+    ]
+
+    _write_images(location.joinpath('3_COLOR_CORRECTED'), images, 'jpg')
+    broker.finish(broker.sent[2])
+    _pass(coordinator)
+    task_data = coordinator._db.get_task(task_id)
+    assert task_data[STEP_IN_PROGRESS_KEY]
+    assert task_data[IMG_PROGRESS_KEY][IMG_PROGRESS_COMPLETED_KEY] == 2
+
+    broker.finish(broker.sent[3])
+    _pass(coordinator)
+    task_data = coordinator._db.get_task(task_id)
+    assert task_data[TASK_STEP_KEY] == StepIndex.COLOR_CORRECTION.value
+    assert not task_data[STEP_IN_PROGRESS_KEY]
+    assert task_data[IMG_PROGRESS_KEY][IMG_PROGRESS_COMPLETED_KEY] == 3
+
+    # Images are already color corrected, nothing is sent again
+    _pass(coordinator)
+    _pass(coordinator)
+    assert coordinator._db.get_task(task_id)[TASK_STEP_KEY] == StepIndex.PREPARE_RC.value
+    assert broker.sent_jobs()[4:] == [('prepare_rc_job', [])]
+
+
+def _fail_dng_conversion(tmp_path, cfg, make_coordinator, broker, converted):
+    """Run DNG conversion of DSC0 and DSC1 one by one, only `converted` images succeed"""
+    cfg.PIPELINE = dict(cfg.PIPELINE, STREAMING=False, DNG_CONVERSION_BATCH_SIZE=1)
+    coordinator = make_coordinator()
+    location = tmp_path.joinpath('task0')
+    _write_images(location.joinpath('1_RAW'), ['DSC0', 'DSC1'], 'ARW')
+    task_id = _add_task(coordinator, location, StepIndex.DNG_CONVERSION.value)
+    _pass(coordinator)
+
+    _write_images(location.joinpath('2_DNG'), converted, 'dng')
+    for message in broker.sent:
+        if message.args[1][0] in converted:
+            broker.finish(message)
+        else:
+            broker.results[message.message_id] = RuntimeError('DNG converter crashed')
+    _pass(coordinator)
+    return coordinator._db.get_task(task_id)
+
+
+def test_failed_images_are_given_up(tmp_path, cfg, make_coordinator, broker):
+    task_data = _fail_dng_conversion(tmp_path, cfg, make_coordinator, broker, ['DSC0'])
+    assert task_data[TASK_STEP_KEY] == StepIndex.COLOR_CORRECTION.value
+    assert not task_data[PAUSED_KEY]
+    assert task_data[FAILED_IMAGES_KEY] == {'DNG_CONVERSION': ['DSC1']}
+    assert ERROR_KEY not in task_data
+
+
+@pytest.mark.parametrize('converted, complete_with_failed_images', [([], True), (['DSC0'], False)])
+def test_failed_step_pauses_task(
+    tmp_path, cfg, make_coordinator, broker, converted, complete_with_failed_images
+):
+    # Nothing to go on with, or giving up on images is disabled
+    cfg.PIPELINE = dict(cfg.PIPELINE, COMPLETE_WITH_FAILED_IMAGES=complete_with_failed_images)
+    task_data = _fail_dng_conversion(tmp_path, cfg, make_coordinator, broker, converted)
+    assert task_data[TASK_STEP_KEY] == StepIndex.DNG_CONVERSION.value
+    assert task_data[PAUSED_KEY]
+    assert not task_data[STEP_IN_PROGRESS_KEY]
+    assert FAILED_IMAGES_KEY not in task_data
+    assert task_data[ERROR_KEY].endswith('DSC1 :: DNG converter crashed')
+
+
+def _poll(coordinator):
+    """A periodic pass of `Coordinator.run()`, over all active tasks"""
+    coordinator._collect_results()
+    coordinator._recover_lost_jobs()
+    coordinator.flush_updates()
+    coordinator.coordinate_tasks()
+
+
+def test_expired_lease_admits_tracked_job_again(tmp_path, coordinator, broker):
+    task_id = _add_task(coordinator, tmp_path.joinpath('task0'), StepIndex.PREPARE_RC.value)
+    _poll(coordinator)
+    message_id = broker.sent[0].message_id
+    coordinator._db.renew_lease(message_id, task_id, StepIndex.PREPARE_RC.value, 'worker0', 60)
+    _poll(coordinator)
+    assert len(broker.sent) == 1
+
+    # Worker died without releasing its lease
+    coordinator._db.renew_lease(message_id, task_id, StepIndex.PREPARE_RC.value, 'worker0', -1)
+    _poll(coordinator)
+    assert broker.sent_jobs() == [('prepare_rc_job', []), ('prepare_rc_job', [])]
+    assert broker.sent[1].message_id != message_id
+    assert coordinator._db.expired_leases() == []
+    assert coordinator._db.get_task(task_id)[STEP_IN_PROGRESS_KEY]
+
+    # Only the job sent again counts
+    broker.finish(broker.sent[1])
+    _poll(coordinator)
+    assert coordinator._db.get_task(task_id)[TASK_STEP_KEY] == StepIndex.MESH_CONSTRUCTION.value
+
+
+def test_expired_lease_dispatches_untracked_step_again(tmp_path, coordinator, broker):
+    # In progress before the coordinator started, its job is not tracked
+    task_id = _add_task(
+        coordinator,
+        tmp_path.joinpath('task0'),
+        StepIndex.PREPARE_RC.value,
+        **{STEP_IN_PROGRESS_KEY: True},
+    )
+    coordinator._db.renew_lease('lost', task_id, StepIndex.PREPARE_RC.value, 'worker0', 60)
+    _poll(coordinator)
+    assert broker.sent == []
+
+    coordinator._db.renew_lease('lost', task_id, StepIndex.PREPARE_RC.value, 'worker0', -1)
+    _poll(coordinator)
+    assert broker.sent_jobs() == [('prepare_rc_job', [])]
+    assert coordinator._db.expired_leases() == []
+    assert coordinator._db.get_task(task_id)[STEP_IN_PROGRESS_KEY]
@@ -0,0 +1,29 @@
+from photogrammetry_service.process_runner import ToolTimeoutError
+from photogrammetry_service.task import ImageProcessingError
+from photogrammetry_service.worker import _should_retry
+
+RETRYABLE = (OSError, ToolTimeoutError)
+
+
+def test_should_retry_max_retries():
+    # `retries` is 0 when the first attempt failed
+    assert [_should_retry(3, RETRYABLE, retries, OSError()) for retries in range(5)] == [
+        True,
+        True,
+        True,
+        False,
+        False,
+    ]
+    assert not _should_retry(0, RETRYABLE, 0, OSError())
+
+
+def test_should_retry_retryable_errors():
+    assert _should_retry(1, RETRYABLE, 0, ToolTimeoutError())
+    assert not _should_retry(1, RETRYABLE, 0, ValueError())
+
+
+def test_should_retry_image_batch():
+    retryable = ImageProcessingError({'DSC0': OSError(), 'DSC1': FileNotFoundError()})
+    assert _should_retry(1, RETRYABLE, 0, retryable)
+    mixed = ImageProcessingError({'DSC0': OSError(), 'DSC1': ValueError()})
+    assert not _should_retry(1, RETRYABLE, 0, mixed)
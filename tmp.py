@@ -59,5 +59,5 @@ img_util.color_correct(
     Path(
         '/Users/duyyudus/Git/photogrammetry-service/sample_data/task5/3_COLOR_CORRECTED/DSC05670.jpg'
     ),
-    swatch,
+    img_util.compute_color_correction_matrix(swatch),
 )
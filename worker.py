@@ -1,4 +1,11 @@
+"""
+`python worker.py [pool]` starts dramatiq workers of `pool` in `WORKER_POOLS` of config,
+`default` if omitted
+"""
+
 import importlib.util
+import subprocess
+import sys
 from pathlib import Path
 
 from photogrammetry_service.worker import (
@@ -7,6 +14,7 @@ from photogrammetry_service.worker import (
     mesh_construction_job,
     prepare_rc_job,
     setup_worker,
+    worker_command,
 )
 
 spec = importlib.util.spec_from_file_location(
@@ -15,4 +23,11 @@ spec = importlib.util.spec_from_file_location(
 cfg = importlib.util.module_from_spec(spec)
 spec.loader.exec_module(cfg)
 
+if __name__ == '__main__':
+    pool = sys.argv[1] if len(sys.argv) > 1 else 'default'
+    cmd = worker_command(cfg, pool, Path(__file__).stem)
+    # Run dramatiq of the current environment
+    cmd = [sys.executable, '-m'] + cmd
+    sys.exit(subprocess.call(cmd, cwd=Path(__file__).parent))
+
 setup_worker(cfg)